@@ -38,8 +38,12 @@
 #include <sys/file.h>
 #include <unistd.h>
 
+#include <cstdio>
 #include <filesystem>
+#include <fstream>
 #include <map>
+#include <set>
+#include <sstream>
 #include <string>
 #include <vector>
 
@@ -52,8 +56,96 @@ using namespace llvm;
 
 const char kTrecModuleCtorName[] = "trec.module_ctor";
 const char kTrecInitName[] = "__trec_init";
+const char kTrecFilterEnv[] = "TREC_PERF_FILTER";
 
 namespace {
+/// InstrFilter: functions to instrument or not, read from the file named by
+/// TREC_PERF_FILTER (see perf_filter.py).
+///
+/// Each line is `allow|deny name|fid VALUE`, `#` starts a comment line.
+/// A name is either the symbol shown in reports (`func: line`) or the bare
+/// function name. Denied functions are never instrumented; if anything is
+/// allowed, only the allowed functions are.
+struct InstrFilter {
+  std::set<std::string> AllowNames, DenyNames;
+  std::set<uint64_t> AllowFids, DenyFids;
+
+  void load(const char* path);
+  int byName(const std::string& symbol, StringRef name) const;
+  bool instrument(const std::string& symbol, StringRef name, uint64_t fid) const;
+};
+
+void InstrFilter::load(const char* path) {
+  std::ifstream in(path);
+  if (!in) {
+    printf("ERROR: cannot open filter file %s set by `%s`!\n", path, kTrecFilterEnv);
+    exit(-1);
+  }
+  std::string line;
+  for (int lineno = 1; std::getline(in, line); lineno++) {
+    std::istringstream fields(line);
+    std::string action, kind, value;
+    fields >> action;
+    if (action.empty() || action[0] == '#')
+      continue;
+    fields >> kind >> std::ws;
+    std::getline(fields, value);
+    // names may contain spaces, but not trailing ones
+    value.erase(value.find_last_not_of(" \t\r") + 1);
+
+    bool allow = action == "allow";
+    if ((!allow && action != "deny") || (kind != "name" && kind != "fid") || value.empty()) {
+      printf("ERROR: %s:%d: expect `allow|deny name|fid VALUE`, got `%s`\n", path, lineno, line.c_str());
+      exit(-1);
+    }
+    if (kind == "name") {
+      (allow ? AllowNames : DenyNames).insert(value);
+    } else {
+      uint64_t fid;
+      // decimal or 0x-prefixed hex
+      if (StringRef(value).getAsInteger(0, fid)) {
+        printf("ERROR: %s:%d: bad fid `%s`\n", path, lineno, value.c_str());
+        exit(-1);
+      }
+      (allow ? AllowFids : DenyFids).insert(fid);
+    }
+  }
+}
+
+/// Decide by the name alone where possible: 1 to instrument, 0 not to, -1 if
+/// the fid is needed. The fid is crafted from the debuginfo rows of the
+/// function, which are only written for functions that may be instrumented.
+int InstrFilter::byName(const std::string& symbol, StringRef name) const {
+  std::string bare = name.str();
+  if (DenyNames.count(symbol) || DenyNames.count(bare))
+    return 0;
+  if (DenyFids.empty() && AllowFids.empty())
+    return AllowNames.empty() || AllowNames.count(symbol) || AllowNames.count(bare);
+  if (AllowFids.empty() && !AllowNames.count(symbol) && !AllowNames.count(bare) && !AllowNames.empty())
+    return 0;
+  return -1;
+}
+
+bool InstrFilter::instrument(const std::string& symbol, StringRef name, uint64_t fid) const {
+  std::string bare = name.str();
+  if (DenyFids.count(fid) || DenyNames.count(symbol) || DenyNames.count(bare))
+    return false;
+  if (AllowFids.empty() && AllowNames.empty())
+    return true;
+  return AllowFids.count(fid) || AllowNames.count(symbol) || AllowNames.count(bare);
+}
+
+// read once per compiler process
+const InstrFilter& getInstrFilter() {
+  static InstrFilter filter = [] {
+    InstrFilter f;
+    if (const char* path = getenv(kTrecFilterEnv))
+      f.load(path);
+    return f;
+  }();
+  return filter;
+}
+
 /// TraceRecorder: instrument the code in module to record traces.
 ///
 /// Instantiating TraceRecorder inserts the trec runtime library API
@@ -67,6 +159,9 @@ struct PerfInstr {
 
   ~PerfInstr() {}
   bool instrmentFunction(Function& F);
+  // debug info of a whole translation unit is written in one transaction
+  void beginDebugInfo() { debugger.beginSQL(); }
+  void commitDebugInfo() { debugger.commitSQL(); }
   std::vector<BasicBlock *> copyBasicBlocks(Function &F);
   void instrumentBasicBlocks(std::vector<BasicBlock *> blocks, uint64_t fid);
 
@@ -102,7 +197,9 @@ void insertModuleCtor(Module& M) {
 PreservedAnalyses PerfInstrPass::run(Function& F,
                                      FunctionAnalysisManager& FAM) {
   PerfInstr pi;
+  pi.beginDebugInfo();
   pi.instrmentFunction(F);
+  pi.commitDebugInfo();
   return PreservedAnalyses::none();
 }
 
@@ -110,9 +207,11 @@ PreservedAnalyses ModulePerfInstrPass::run(Module& M,
                                            ModuleAnalysisManager& MAM) {
   insertModuleCtor(M);
   PerfInstr pi;
+  pi.beginDebugInfo();
   for (auto& F : M) {
     pi.instrmentFunction(F);
   }
+  pi.commitDebugInfo();
   return PreservedAnalyses::none();
 }
 
@@ -159,7 +258,6 @@ bool PerfInstr::instrmentFunction(Function& F) {
   if (F.getSubprogram()->getFilename().contains("include/c++"))
     return false;
 
-  debugger.beginSQL();
   initialize(*F.getParent());
 
   // deal with cpp name mangling
@@ -177,11 +275,18 @@ bool PerfInstr::instrmentFunction(Function& F) {
   }
 
   int line = F.getSubprogram()->getLine();
+  std::string symbol = funcName.str().append(": ").append(std::to_string(line));
+  int filtered = getInstrFilter().byName(symbol, funcName);
+  if (filtered == 0)
+    return false;
+
   int fileID = debugger.getFileID(fileName.c_str());
-  int funcID = debugger.getFuncID(funcName.str()
-    .append(": ").append(std::to_string(line)).c_str());
+  int funcID = debugger.getFuncID(symbol.c_str());
   uint64_t fid = debugger.craftFID(fileID, funcID);
 
+  if (filtered == -1 && !getInstrFilter().instrument(symbol, funcName, fid))
+    return false;
+
   // llvm::dbgs() << "instr " << funcName << "() line " << line << " fid " << fid << "\n";
   // llvm::dbgs() << "\t filename: " << F.getSubprogram()->getFilename() << "\n";
 
@@ -193,8 +298,6 @@ bool PerfInstr::instrmentFunction(Function& F) {
     escapes.push_back(AtExit);
   }
 
-  debugger.commitSQL();
-
   auto newBlocks = copyBasicBlocks(F);
 
   // insert the dispatcher conditional block
@@ -5,32 +5,40 @@
 
 #include "SqliteDebugWriter.h"
 
-const char * SQL_TABLE_FILENAMES = "FILENAMES";
-const char * SQL_TABLE_FUNCNAMES = "FUNCNAMES";
-const char * SQL_TABLE_BBLS      = "BBLS";
+// compilers of a parallel build wait for each other on the manager database
+// for at most this long (ms)
+const int SQL_BUSY_TIMEOUT = 60000;
 
-const char * SQL_CREATE_MANAGER = 
-  "CREATE TABLE MANAGER ("
+const char * SQL_CREATE_MANAGER =
+  "CREATE TABLE IF NOT EXISTS MANAGER ("
     "ID INTEGER PRIMARY KEY AUTOINCREMENT,"
     "PID INTEGER);";
 
-const char * SQL_CREATE_TABLES = 
-  "CREATE TABLE FILENAMES ("
+const char * SQL_CREATE_TABLES =
+  "CREATE TABLE IF NOT EXISTS FILENAMES ("
     "ID INTEGER PRIMARY KEY AUTOINCREMENT,"
     "NAME CHAR(2048));"
-  "CREATE TABLE FUNCNAMES ("
+  "CREATE TABLE IF NOT EXISTS FUNCNAMES ("
     "ID INTEGER PRIMARY KEY AUTOINCREMENT,"
     "NAME CHAR(256));"
-  "CREATE TABLE BBLS ("
+  "CREATE TABLE IF NOT EXISTS BBLS ("
     "ID  INTEGER PRIMARY KEY AUTOINCREMENT,"
     "FID INTEGER,"
     "LINESTART INTEGER,"
-    "LINEEND   INTEGER);";
+    "LINEEND   INTEGER);"
+  // a database is reused by later compilers, which look up names already in it
+  "CREATE INDEX IF NOT EXISTS FILENAMES_NAME ON FILENAMES (NAME);"
+  "CREATE INDEX IF NOT EXISTS FUNCNAMES_NAME ON FUNCNAMES (NAME);";
 
-static int query_callback(void* ret, int argc, char** argv, char** azColName) {
-  assert(argc == 1);
-  *(int*)ret = atoi(argv[0]);
-  return 0;
+static void checkStatus(sqlite3* db, int status, const char* what) {
+  if (status != SQLITE_OK && status != SQLITE_DONE && status != SQLITE_ROW) {
+    printf("%s error(%d): %s\n", what, status, sqlite3_errmsg(db));
+    exit(status);
+  }
+}
+
+static void exec(sqlite3* db, const char* sql, const char* what) {
+  checkStatus(db, sqlite3_exec(db, sql, nullptr, nullptr, nullptr), what);
 }
 
 SqliteDebugWriter::SqliteDebugWriter() : db(nullptr), dbID(-1) {
@@ -41,157 +49,109 @@ SqliteDebugWriter::SqliteDebugWriter() : db(nullptr), dbID(-1) {
   }
   DBDirPath = std::filesystem::path(DatabaseDir);
   int pid = getpid();
-  std::filesystem::path managerDBPath =
-      DBDirPath / std::filesystem::path("manager.db");
   int status;
-  char* errmsg;
-
-  // open sqlite database
-  status = sqlite3_open(managerDBPath.c_str(), &db);
-  if (status) {
-    printf("Open manager databased %s failed(%d): %s\n", managerDBPath.c_str(),
-           status, sqlite3_errmsg(db));
-    exit(status);
-  }
-
-  // acquire flock
-  int database_fd = open(managerDBPath.c_str(), O_RDONLY);
-  if ((status = flock(database_fd, LOCK_EX)) != 0) {
-    printf("ERROR: acquire flock for manager database %s failed(%d)\n",
-           managerDBPath.c_str(), status);
-    exit(status);
-  }
 
-  status = sqlite3_exec(db, SQL_CREATE_MANAGER, nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK &&
-      !(status == SQLITE_ERROR &&
-        strcmp(errmsg, "table MANAGER already exists") == 0)) {
-    printf("create table error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
-
-  /// try to get a db id from pid
-  bool isCreated = false;
-  char buffer[256];
-  snprintf(buffer, sizeof(buffer), "SELECT ID from MANAGER where PID=%d;", pid);
-  status = sqlite3_exec(db, buffer, query_callback, &dbID, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("query manager table error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  while (dbID == -1) {
-    // If there's a null pid, it's key can be the db id.
-    snprintf(buffer, sizeof(buffer),
-             "SELECT ID from MANAGER where PID IS NULL;");
-    status = sqlite3_exec(db, buffer, query_callback, &dbID, &errmsg);
-    if (status != SQLITE_OK) {
-      printf("query manager table error(%d): %s\n", status, errmsg);
-      exit(status);
-    };
-    sqlite3_free(errmsg);
-
-    // try to make a row with null pid
-    if (dbID == -1) {
-      // no empty entry
-      isCreated = true;
-      snprintf(buffer, sizeof(buffer),
-               "INSERT INTO MANAGER VALUES (NULL, NULL);");
-      while ((status = sqlite3_exec(db, buffer, nullptr, nullptr, &errmsg)) ==
-             SQLITE_BUSY)
-        sqlite3_free(errmsg);
-      sqlite3_free(errmsg);
-      if (status != SQLITE_OK) {
-        printf("insert manager table error(%d): %s\n", status, errmsg);
-        exit(status);
-      };
-      sqlite3_free(errmsg);
-    }
+  // Take a db id with the manager database write-locked by BEGIN IMMEDIATE,
+  // other compilers wait in the busy handler.
+  sqlite3* manager = openManager();
+  exec(manager, "BEGIN IMMEDIATE;", "begin manager transaction");
+
+  sqlite3_stmt* stmt;
+  checkStatus(manager, sqlite3_prepare_v2(manager,
+    // the id taken by this process, or a free one
+    "SELECT ID from MANAGER where PID=?1 OR PID IS NULL ORDER BY PID IS NULL LIMIT 1;",
+    -1, &stmt, nullptr), "query manager table");
+  sqlite3_bind_int(stmt, 1, pid);
+  status = sqlite3_step(stmt);
+  checkStatus(manager, status, "query manager table");
+  if (status == SQLITE_ROW) {
+    dbID = sqlite3_column_int(stmt, 0);
   }
-
-  snprintf(buffer, sizeof(buffer), "UPDATE MANAGER SET PID=%d where ID=%d;",
-           pid, dbID);
-  status = sqlite3_exec(db, buffer, nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("update manager table error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
-
-  // release flock
-  if ((status = flock(database_fd, LOCK_UN)) != 0) {
-    printf("ERROR: release flock failed\n");
-    exit(status);
+  sqlite3_finalize(stmt);
+
+  if (dbID == -1) {
+    // no free id, make a new one
+    checkStatus(manager, sqlite3_prepare_v2(manager,
+      "INSERT INTO MANAGER VALUES (NULL, ?1);", -1, &stmt, nullptr), "insert manager table");
+    sqlite3_bind_int(stmt, 1, pid);
+    checkStatus(manager, sqlite3_step(stmt), "insert manager table");
+    sqlite3_finalize(stmt);
+    dbID = sqlite3_last_insert_rowid(manager);
+  } else {
+    checkStatus(manager, sqlite3_prepare_v2(manager,
+      "UPDATE MANAGER SET PID=?1 where ID=?2;", -1, &stmt, nullptr), "update manager table");
+    sqlite3_bind_int(stmt, 1, pid);
+    sqlite3_bind_int(stmt, 2, dbID);
+    checkStatus(manager, sqlite3_step(stmt), "update manager table");
+    sqlite3_finalize(stmt);
   }
-  close(database_fd);
 
-  // close manager database
-  sqlite3_close(db);
+  exec(manager, "COMMIT;", "commit manager transaction");
+  sqlite3_close(manager);
 
+  char buffer[4096];
   snprintf(buffer, sizeof(buffer), "%s/debuginfo%d.db", DBDirPath.c_str(),
            dbID);
-  sqlite3_open(buffer, &db);
+  status = sqlite3_open(buffer, &db);
   if (status) {
     printf("open %s file failed(%d): %s\n", buffer, status, sqlite3_errmsg(db));
     exit(status);
   }
 
   // speedup querying
-  status =
-      sqlite3_exec(db, "PRAGMA synchronous=OFF;", nullptr, nullptr, nullptr);
-  if (status != SQLITE_OK) {
-    printf("trun off synchronous mode failed: %s\n", sqlite3_errmsg(db));
-    exit(status);
-  }
+  // the database is only used by this process, and is rebuilt with the program anyway
+  exec(db, "PRAGMA synchronous=OFF;", "trun off synchronous mode");
+  exec(db, "PRAGMA journal_mode=WAL;", "set WAL mode");
 
   // printf("creating subtables\n");
-  if (isCreated) {
-    status = sqlite3_exec(db, SQL_CREATE_TABLES, nullptr, nullptr, &errmsg);
-    if (status) {
-      printf("create debuginfo tables failed %d:%s\n", status, sqlite3_errmsg(db));
-      exit(status);
-    }
-    sqlite3_free(errmsg);
-  }
+  exec(db, SQL_CREATE_TABLES, "create debuginfo tables");
+
+  QueryFileStmt  = prepare("SELECT ID from FILENAMES where NAME=?1;");
+  QueryFuncStmt  = prepare("SELECT ID from FUNCNAMES where NAME=?1;");
+  InsertFileStmt = prepare("INSERT INTO FILENAMES VALUES (NULL, ?1);");
+  InsertFuncStmt = prepare("INSERT INTO FUNCNAMES VALUES (NULL, ?1);");
+  InsertBBLStmt  = prepare("INSERT INTO BBLS VALUES (NULL, ?1, ?2, ?3);");
 }
 
 SqliteDebugWriter::~SqliteDebugWriter() {
+  for (auto stmt : {QueryFileStmt, QueryFuncStmt, InsertFileStmt, InsertFuncStmt, InsertBBLStmt})
+    sqlite3_finalize(stmt);
   sqlite3_close(db);
 
+  // Release the dbID.
+  sqlite3* manager = openManager();
+  sqlite3_stmt* stmt;
+  checkStatus(manager, sqlite3_prepare_v2(manager,
+    "UPDATE MANAGER SET PID=NULL where ID=?1;", -1, &stmt, nullptr), "update manager table");
+  sqlite3_bind_int(stmt, 1, dbID);
+  checkStatus(manager, sqlite3_step(stmt), "update manager table");
+  sqlite3_finalize(stmt);
+  sqlite3_close(manager);
+}
+
+sqlite3* SqliteDebugWriter::openManager() {
   std::filesystem::path managerDBPath =
       DBDirPath / std::filesystem::path("manager.db");
-  int status;
-  char* errmsg;
-  int database_fd = open(managerDBPath.c_str(), O_RDONLY);
-  if ((status = flock(database_fd, LOCK_EX)) != 0) {
-    printf("ERROR: acquire flock failed\n");
-    exit(status);
-  }
+  sqlite3* manager;
 
-  status = sqlite3_open(managerDBPath.c_str(), &db);
+  // open sqlite database
+  int status = sqlite3_open(managerDBPath.c_str(), &manager);
   if (status) {
     printf("Open manager databased %s failed(%d): %s\n", managerDBPath.c_str(),
-           status, sqlite3_errmsg(db));
+           status, sqlite3_errmsg(manager));
     exit(status);
   }
+  sqlite3_busy_timeout(manager, SQL_BUSY_TIMEOUT);
+  // readers and the writer do not block each other
+  exec(manager, "PRAGMA journal_mode=WAL;", "set WAL mode");
+  exec(manager, SQL_CREATE_MANAGER, "create table");
+  return manager;
+}
 
-  // Release the dbID.
-  char buffer[256];
-  snprintf(buffer, sizeof(buffer), "UPDATE MANAGER SET PID=NULL where ID=%d;",
-           dbID);
-  status = sqlite3_exec(db, buffer, nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("update manager table error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
-
-  sqlite3_close(db);
-  if ((status = flock(database_fd, LOCK_UN)) != 0) {
-    printf("ERROR: release flock failed\n");
-    exit(status);
-  }
-  close(database_fd);
+sqlite3_stmt* SqliteDebugWriter::prepare(const char* sql) {
+  sqlite3_stmt* stmt;
+  checkStatus(db, sqlite3_prepare_v3(db, sql, -1, SQLITE_PREPARE_PERSISTENT, &stmt, nullptr), "prepare");
+  return stmt;
 }
 
 int SqliteDebugWriter::getFileID(const char* name) {
@@ -217,23 +177,19 @@ int SqliteDebugWriter::getFuncID(const char* name) {
 }
 
 int SqliteDebugWriter::queryFileID(const char* name) {
-  return queryID(SQL_TABLE_FILENAMES, name);
+  return queryID(QueryFileStmt, name);
 }
 
 int SqliteDebugWriter::queryFuncID(const char* name) {
-  return queryID(SQL_TABLE_FUNCNAMES, name);
+  return queryID(QueryFuncStmt, name);
 }
 
 uint64_t SqliteDebugWriter::getBBLID(uint64_t fid, int linestart, int lineend) {
-  char buf[4096];
-  snprintf(buf, 4095, "INSERT INTO %s VALUES (NULL, %ld, %d, %d);", SQL_TABLE_BBLS, fid, linestart, lineend);
-  char* errmsg;
-  int status = sqlite3_exec(db, buf, nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("query error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
+  sqlite3_bind_int64(InsertBBLStmt, 1, fid);
+  sqlite3_bind_int(InsertBBLStmt, 2, linestart);
+  sqlite3_bind_int(InsertBBLStmt, 3, lineend);
+  checkStatus(db, sqlite3_step(InsertBBLStmt), "insert");
+  sqlite3_reset(InsertBBLStmt);
 
   int id = sqlite3_last_insert_rowid(db);
   auto bblid = ((uint64_t) (dbID & 0xffff) << 48) | ((uint64_t) (id & 0xffffffffffff));
@@ -242,42 +198,24 @@ uint64_t SqliteDebugWriter::getBBLID(uint64_t fid, int linestart, int lineend) {
   return bblid;
 }
 
-int SqliteDebugWriter::queryID(const char* table, const char* name) {
-  char* errmsg;
-  char buf[4096];
+int SqliteDebugWriter::queryID(sqlite3_stmt* stmt, const char* name) {
   int ID = -1;
-  snprintf(buf, 4095, "SELECT ID from %s where NAME=\"%s\";", table, name);
-  int status = sqlite3_exec(db, buf, query_callback, &ID, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("query error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
+  sqlite3_bind_text(stmt, 1, name, -1, SQLITE_STATIC);
+  int status = sqlite3_step(stmt);
+  checkStatus(db, status, "query");
+  if (status == SQLITE_ROW) {
+    ID = sqlite3_column_int(stmt, 0);
+  }
+  sqlite3_reset(stmt);
   return ID;
 }
 
 void SqliteDebugWriter::commitSQL() {
-  char* errmsg;
-  int status;
-  while ((status = sqlite3_exec(db, "COMMIT;", nullptr, nullptr, &errmsg)) ==
-         SQLITE_BUSY)
-    sqlite3_free(errmsg);
-  sqlite3_free(errmsg);
-  if (status != SQLITE_OK) {
-    printf("commit sqlite error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
+  exec(db, "COMMIT;", "commit sqlite");
 }
 
 void SqliteDebugWriter::beginSQL() {
-  char* errmsg;
-  int status = sqlite3_exec(db, "BEGIN;", nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("begin sqlite error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
+  exec(db, "BEGIN;", "begin sqlite");
 }
 
 uint64_t SqliteDebugWriter::craftFID(int fileID, int funcID) {
@@ -289,23 +227,17 @@ uint64_t SqliteDebugWriter::craftFID(int fileID, int funcID) {
 }
 
 int SqliteDebugWriter::insertFileName(const char* name) {
-  return insert(SQL_TABLE_FILENAMES, name);
+  return insert(InsertFileStmt, name);
 }
 
 int SqliteDebugWriter::insertFuncName(const char* name) {
-  return insert(SQL_TABLE_FUNCNAMES, name);
+  return insert(InsertFuncStmt, name);
 }
 
-int SqliteDebugWriter::insert(const char* table, const char* name) {
-  char buf[4096];
-  snprintf(buf, 2047, "INSERT INTO %s VALUES (NULL, \"%s\");", table, name);
-  char* errmsg;
-  int status = sqlite3_exec(db, buf, nullptr, nullptr, &errmsg);
-  if (status != SQLITE_OK) {
-    printf("query error(%d): %s\n", status, errmsg);
-    exit(status);
-  };
-  sqlite3_free(errmsg);
+int SqliteDebugWriter::insert(sqlite3_stmt* stmt, const char* name) {
+  sqlite3_bind_text(stmt, 1, name, -1, SQLITE_STATIC);
+  checkStatus(db, sqlite3_step(stmt), "insert");
+  sqlite3_reset(stmt);
 
-  return queryID(table, name);
-}
\ No newline at end of file
+  return sqlite3_last_insert_rowid(db);
+}
@@ -1,5 +1,4 @@
 #include <sqlite3.h>
-#include <sys/file.h>
 #include <unistd.h>
 
 #include <bit>
@@ -11,12 +10,17 @@ class SqliteDebugWriter {
   int dbID;
   std::filesystem::path DBDirPath;
   std::map<std::string, uint32_t> KnownFileNames, KnownFuncNames;
-  int insert(const char* table, const char* name);
+  // prepared once, reused for every row
+  sqlite3_stmt *QueryFileStmt, *QueryFuncStmt;
+  sqlite3_stmt *InsertFileStmt, *InsertFuncStmt, *InsertBBLStmt;
+  sqlite3* openManager();
+  sqlite3_stmt* prepare(const char* sql);
+  int insert(sqlite3_stmt* stmt, const char* name);
   int insertFileName(const char* name);
   int insertFuncName(const char* name);
   int queryFileID(const char* name);
   int queryFuncID(const char* name);
-  int queryID(const char* table, const char* name);
+  int queryID(sqlite3_stmt* stmt, const char* name);
 
  public:
   SqliteDebugWriter();
@@ -0,0 +1,42 @@
+// Compile one synthetic translation unit with SqliteDebugWriter, as PerfInstrPass does:
+//   debug_writer FILE FUNCS BBLS [per-function]
+// writes FUNCS functions of FILE with BBLS basic blocks each.
+// With `per-function`, each function is written in its own transaction
+// and BBLs outside of any transaction, as the pass used to do.
+
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+
+#include "SqliteDebugWriter.h"
+
+int main(int argc, char** argv) {
+  if (argc < 4) {
+    printf("usage: %s FILE FUNCS BBLS [per-function]\n", argv[0]);
+    return 1;
+  }
+  const char* file = argv[1];
+  int funcs = atoi(argv[2]);
+  int bbls = atoi(argv[3]);
+  bool perFunction = argc > 4 && strcmp(argv[4], "per-function") == 0;
+
+  SqliteDebugWriter debugger;
+  if (!perFunction)
+    debugger.beginSQL();
+  for (int i = 0; i < funcs; i++) {
+    if (perFunction)
+      debugger.beginSQL();
+    int fileID = debugger.getFileID(file);
+    std::string name = std::string(file) + "_func" + std::to_string(i) + ": " + std::to_string(10 + i * 20);
+    int funcID = debugger.getFuncID(name.c_str());
+    uint64_t fid = debugger.craftFID(fileID, funcID);
+    if (perFunction)
+      debugger.commitSQL();
+    for (int j = 0; j < bbls; j++)
+      debugger.getBBLID(fid, 10 + i * 20 + j, 11 + i * 20 + j);
+  }
+  if (!perFunction)
+    debugger.commitSQL();
+  return 0;
+}
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# build-time benchmark of SqliteDebugWriter
+#
+# A synthetic project of many translation units is "compiled" by running
+# `debug_writer.cpp` once per TU, like the compiler processes of a parallel build,
+# with the writer of the working tree and that of an older revision.
+#
+####################################################
+
+
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+
+g_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+g_driver = os.path.join(g_root, 'bench', 'debug_writer.cpp')
+g_writer_files = ['Pass/SqliteDebugWriter.h', 'Pass/SqliteDebugWriter.cpp']
+
+
+def git(*args) -> str:
+    proc = subprocess.run(['git', *args], cwd=g_root, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr)
+        exit(-1)
+    return proc.stdout
+
+
+def default_old_rev() -> str:
+    # the revision before the last change of the writer
+    return git('log', '-1', '--format=%H', '--', *g_writer_files).strip() + '^'
+
+
+def build(src_dir: str, out: str, cxx: str):
+    cmd = [cxx, '-std=c++20', '-O2', f'-I{src_dir}', g_driver,
+           os.path.join(src_dir, 'SqliteDebugWriter.cpp'), '-lsqlite3', '-o', out]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(' '.join(cmd))
+        print(proc.stderr)
+        exit(-1)
+
+
+def run_build(exe: str, db_dir: str, tus: int, funcs: int, bbls: int, jobs: int, per_function: bool) -> float:
+    """
+    Run `exe` for each of `tus` TUs, `jobs` at a time. Return the wall time in seconds.
+    """
+    env = dict(os.environ, TREC_DATABASE_DIR=db_dir)
+    mode = ['per-function'] if per_function else []
+
+    def compile_tu(i):
+        proc = subprocess.run([exe, f'src/file{i}.c', str(funcs), str(bbls), *mode],
+                              env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stdout, proc.stderr)
+            exit(-1)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(compile_tu, range(tus)))
+    return time.perf_counter() - start
+
+
+def count_rows(db_dir: str) -> tuple[int, int]:
+    funcs = 0
+    bbls = 0
+    for name in os.listdir(db_dir):
+        if name.startswith('debuginfo') and name.endswith('.db'):
+            with closing(sqlite3.connect(os.path.join(db_dir, name))) as connection:
+                funcs += connection.execute('select count(*) from FUNCNAMES').fetchone()[0]
+                bbls  += connection.execute('select count(*) from BBLS').fetchone()[0]
+    return funcs, bbls
+
+
+def main(old_rev: str, tus: int, funcs: int, bbls: int, jobs: int, cxx: str):
+    with tempfile.TemporaryDirectory() as tmp:
+        old_dir = os.path.join(tmp, 'old')
+        os.makedirs(old_dir)
+        for f in g_writer_files:
+            with open(os.path.join(old_dir, os.path.basename(f)), 'w') as out:
+                out.write(git('show', f'{old_rev}:{f}'))
+
+        print(f'Building writers of {old_rev} and the working tree...')
+        variants = [
+            # name, writer sources, transaction per function as the pass of that revision did
+            (f'old ({old_rev})', old_dir, True),
+            ('new', os.path.join(g_root, 'Pass'), False),
+        ]
+        times = []
+        for i, (name, src_dir, per_function) in enumerate(variants):
+            exe = os.path.join(tmp, f'writer{i}')
+            build(src_dir, exe, cxx)
+            db_dir = os.path.join(tmp, f'db{i}')
+            os.makedirs(db_dir)
+            t = run_build(exe, db_dir, tus, funcs, bbls, jobs, per_function)
+            rows = count_rows(db_dir)
+            if rows != (tus * funcs, tus * funcs * bbls):
+                print(f'{name}: expected {tus * funcs} functions and {tus * funcs * bbls} BBLs, got {rows}')
+                exit(-1)
+            times.append(t)
+
+        print(f'{tus} TUs, {funcs} functions and {bbls} BBLs per function, {jobs} jobs')
+        print(f'{"writer":<30} {"total s":>8} {"ms/TU":>8}')
+        for (name, _, _), t in zip(variants, times):
+            print(f'{name:<30} {t:>8.2f} {t * 1000 / tus:>8.2f}')
+        print(f'speedup: {times[0] / times[1]:.2f}x')
+
+
+###
+### start of program
+###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the build time of SqliteDebugWriter with that of an older revision on a synthetic project.')
+    parser.add_argument('--old', type=str, help='git revision of the old writer, default: the one before its last change')
+    parser.add_argument('--tus', type=int, default=256, help='number of translation units, default: 256')
+    parser.add_argument('--funcs', type=int, default=50, help='functions per translation unit, default: 50')
+    parser.add_argument('--bbls', type=int, default=20, help='basic blocks per function, default: 20')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='parallel compilers, default: number of CPUs')
+    parser.add_argument('--cxx', type=str, default='c++', help='C++ compiler, default: c++')
+
+    args = parser.parse_args()
+    main(args.old if args.old is not None else default_old_rev(),
+         args.tus, args.funcs, args.bbls, args.jobs, args.cxx)
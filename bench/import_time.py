@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# import time benchmark of the analysis scripts
+#
+# Each entry point is imported in a fresh interpreter with `python -X importtime`,
+# and the cumulative import time of the module is compared with its budget
+# in `import_time_budget.json`.
+# Exit with 1 if any entry point is over budget.
+#
+####################################################
+
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+g_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+g_budget_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_time_budget.json')
+
+g_entry_points = [
+    'perflib',
+    'perf_func',
+    'perf_dump',
+    'perf_bbl',
+    'perf_data',
+    'rvbench_test',
+    'rvbench_test_star',
+    'rvbench_summarize',
+    'perf_server',
+    'perf_filter',
+    'perf_flame',
+    'perf_debuginfo_merge',
+]
+
+
+def import_time_us(module: str) -> int:
+    """
+    Cumulative import time of `module` in microseconds, measured in a fresh interpreter.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=g_root, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr)
+        print(f'Failed to import {module}')
+        exit(-1)
+
+    # import time: self [us] | cumulative | imported package
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if fields[2].strip() == module:
+            return int(fields[1])
+
+    print(f'No import time of {module} found')
+    exit(-1)
+
+
+def main(runs: int, update: bool, slack: float):
+    budgets = {}
+    if os.path.exists(g_budget_file):
+        with open(g_budget_file, 'r') as f:
+            budgets = json.load(f)
+
+    over = False
+    measured = {}
+    print(f'{'module':<20} {'ms':>8} {'budget':>8}')
+    for m in g_entry_points:
+        # the fastest run is the least noisy
+        t = min(import_time_us(m) for i in range(runs)) / 1000
+        measured[m] = t
+        budget = budgets.get(m)
+        status = ''
+        if budget is not None and t > budget:
+            status = 'OVER BUDGET'
+            over = True
+        print(f'{m:<20} {t:>8.1f} {budget if budget is not None else '-':>8} {status}')
+
+    if update:
+        with open(g_budget_file, 'w') as f:
+            json.dump({ m: round(t * slack) for m, t in measured.items() }, f, indent=2)
+            f.write('\n')
+        print(f'Budgets written to {g_budget_file}')
+        return
+
+    if over:
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure import time of the entry points and check it against budgets.')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='runs per entry point, default: 5')
+    parser.add_argument('--update', action='store_true', help='write measured times times SLACK as new budgets')
+    parser.add_argument('--slack', type=float, default=2.0, help='budget factor over measured times with --update, default: 2.0')
+
+    args = parser.parse_args()
+    main(args.runs, args.update, args.slack)
@@ -9,12 +9,14 @@
 #include <filesystem>
 #include <iostream>
 #include <fstream>
+#include <cstdint>
 #include <cstdlib>
 #include <map>
 #include <sstream>
 #include <string>
 #include <thread>
 #include <unordered_map>
+#include <unordered_set>
 #include <vector>
 #include <mutex>
 #include <atomic>
@@ -30,12 +32,15 @@
 #include <time.h>
 #include <errno.h>
 #include <signal.h>
+#include <pthread.h>
 #include <linux/perf_event.h>    /* Definition of PERF_* constants */
 #include <linux/hw_breakpoint.h> /* Definition of HW_* constants */
 #include <sys/syscall.h>         /* Definition of SYS_* constants */
 #include <sys/types.h>
 #include <sys/ioctl.h>
+#include <sys/mman.h>
 #include <sys/utsname.h>
+#include <sys/stat.h>
 
 constexpr bool debug = false;
 #define DEBUG(body) if (debug) { do { body } while (0); }
@@ -53,11 +58,16 @@ void __trec_init();
 }
 
 static long currentTime();
-static void flushImpl();
+static void calibrate();
+static void requestSnapshot(int);
+static bool controlFileTouched();
+static void takeSnapshot();
+static void flushImpl(const char * path);
 static void flushData();
 static void initTimeIntervals();
 static int  computeIndexFromDelta(unsigned int);
-std::unordered_map<long, long> * getLastCallTimeMap();
+struct ThreadState;
+ThreadState * getThreadState();
 
 enum Mode : unsigned char {
   TIME  = 0,
@@ -67,6 +77,10 @@ enum Mode : unsigned char {
   NONE
 };
 
+// set in the mode byte of extended data files,
+// whose records are counted and followed by sections
+constexpr unsigned char g_extendedFormat = 0x80;
+
 enum Arch : unsigned char {
   X64     = 0,
   RISCV64 = 1,
@@ -78,6 +92,23 @@ constexpr char g_envDataPath[] = "TREC_PERF_DIR";
 constexpr char g_envMode[]     = "TREC_PERF_MODE";
 constexpr char g_envInterval[] = "TREC_PERF_INTERVAL";
 constexpr char g_envBucketCount[] = "TREC_PERF_BUCKET_COUNT";
+// record self time (time minus children) too, if set to 1
+constexpr char g_envSelfTime[] = "TREC_PERF_SELF_TIME";
+// record caller -> callee call counts and time, if set to 1
+constexpr char g_envCallGraph[] = "TREC_PERF_CALL_GRAPH";
+// keep the changes of counters in each flush interval, if set to 1
+constexpr char g_envEpochs[] = "TREC_PERF_EPOCHS";
+// keep counters of the first N threads separately, those of later threads together
+constexpr char g_envThreads[] = "TREC_PERF_THREADS";
+constexpr int g_maxThreads = 256;
+// measure the cost of the probes at start and count the calls made by each function, if set to 1
+constexpr char g_envCalibrate[] = "TREC_PERF_CALIBRATE";
+// flush only for snapshots and at exit instead of every second, if set to "demand"
+constexpr char g_envFlush[] = "TREC_PERF_FLUSH";
+// take a snapshot on SIGUSR2 or when the control file is touched, if set to 1
+constexpr char g_envSnapshot[] = "TREC_PERF_SNAPSHOT";
+// in TREC_PERF_DIR, shared by all processes writing there
+constexpr char g_snapshotControlFile[] = "trec_ctl_snapshot";
 // constexpr int idxInfinity = defaultNumOfBuckets - 1;
 // constexpr int lengthOfTimeIntervals = defaultNumOfBuckets - 1;
 
@@ -96,6 +127,71 @@ static int g_interval = 250;
 
 // fid -> buckets
 static std::unordered_map<long, std::vector<long>> * g_funcCallCounter;
+// fid -> buckets of self time, if g_recordSelfTime
+static std::unordered_map<long, std::vector<long>> * g_selfTimeCounter;
+static bool g_recordSelfTime = false;
+static bool g_recordCallGraph = false;
+// the shadow stack is needed by self time and the call graph
+static bool g_keepStack = false;
+static bool g_recordEpochs = false;
+// counters at the end of the last epoch, fid -> buckets
+static std::unordered_map<long, std::vector<long>> * g_epochBase;
+// fids called since the last epoch
+static std::unordered_set<long> * g_epochDirty;
+// closed epochs are appended to trec_epoch_comm_pid.bin, see closeEpoch()
+static std::string * g_epochPath;
+// number of threads with their own counters, 0 if not recording per thread,
+// threads after them share index g_numThreads ("other")
+static int g_numThreads = 0;
+// thread index -> fid -> buckets
+static std::vector<std::unordered_map<long, std::vector<long>>> * g_threadCounters;
+static bool g_calibrate = false;
+// probe cost of a call as seen by its caller, in the unit of currentTime()
+static double g_probeCost = 0;
+constexpr int g_calibrationRuns = 7;
+constexpr int g_calibrationIterations = 1000;
+
+// calls made by the calls of a function, if g_calibrate
+struct ChildCalls {
+  long calls;
+  // direct callees
+  long callees;
+  // all calls below
+  long descendants;
+};
+
+// fid -> child calls
+static std::unordered_map<long, ChildCalls> * g_childCalls;
+// record cycles and instructions along with time (TREC_PERF_MODE=multi)
+static bool g_multiCounter = false;
+// fid -> buckets of cycles and of instructions, if g_multiCounter
+static std::unordered_map<long, std::vector<long>> * g_cycleCounter;
+static std::unordered_map<long, std::vector<long>> * g_insnCounter;
+
+// hardware counters of a thread
+struct Counts {
+  long cycles;
+  long instructions;
+};
+
+// totals of the calls of a function, if g_multiCounter
+struct CountTotals {
+  long calls;
+  long cycles;
+  long instructions;
+};
+
+// fid -> totals
+static std::unordered_map<long, CountTotals> * g_countTotals;
+static bool g_flushOnDemand = false;
+static bool g_snapshots = false;
+// set by the SIGUSR2 handler, served by the flusher
+static volatile sig_atomic_t g_snapshotRequested = 0;
+// snapshot file name without the timestamp and extension
+static std::string * g_snapshotPrefix;
+static std::string * g_controlPath;
+// mtime of the control file at the last check
+static struct timespec g_controlMtime;
 static std::mutex  * g_lock;
 static std::thread * g_flusher;
 // tell the flush thread to quit
@@ -161,6 +257,102 @@ struct perfFD {
 static thread_local struct perfFD tl_perffd;
 #endif
 
+// A perf_event group of cycles and instructions of the calling thread.
+// The counters are read with rdpmc from the mmap'd user pages of the events where
+// the kernel allows it, otherwise with one read() of the whole group.
+struct CounterGroup {
+  int fds[2] = {-1, -1};
+  perf_event_mmap_page * pages[2] = {nullptr, nullptr};
+
+  // false if the counters are not available, e.g., no PMU in a VM or perf_event_paranoid too high
+  bool open() {
+    // core cycles rather than the reference cycles of the cycle mode, for IPC
+    unsigned long configs[2] = {PERF_COUNT_HW_CPU_CYCLES, PERF_COUNT_HW_INSTRUCTIONS};
+    for (int i = 0; i < 2; i++) {
+      struct perf_event_attr pe;
+      memset(&pe, 0, sizeof(pe));
+      pe.size = sizeof(pe);
+      pe.type = PERF_TYPE_HARDWARE;
+      pe.config = configs[i];
+      // the leader starts the whole group
+      pe.disabled = i == 0;
+      pe.exclude_kernel = 1;
+      pe.exclude_hv = 1;
+      pe.read_format = PERF_FORMAT_GROUP;
+      fds[i] = syscall(SYS_perf_event_open, &pe, 0, -1, fds[0], 0);
+      if (fds[i] == -1) {
+        return false;
+      }
+    }
+#if defined (__x86_64__)
+    for (int i = 0; i < 2; i++) {
+      void * page = mmap(nullptr, sysconf(_SC_PAGESIZE), PROT_READ, MAP_SHARED, fds[i], 0);
+      if (page == MAP_FAILED || !((perf_event_mmap_page *) page)->cap_user_rdpmc) {
+        if (page != MAP_FAILED) {
+          munmap(page, sysconf(_SC_PAGESIZE));
+        }
+        break;
+      }
+      pages[i] = (perf_event_mmap_page *) page;
+    }
+#endif
+    ioctl(fds[0], PERF_EVENT_IOC_RESET, PERF_IOC_FLAG_GROUP);
+    ioctl(fds[0], PERF_EVENT_IOC_ENABLE, PERF_IOC_FLAG_GROUP);
+    return true;
+  }
+
+  ~CounterGroup() {
+    for (int i = 0; i < 2; i++) {
+      if (pages[i] != nullptr) {
+        munmap(pages[i], sysconf(_SC_PAGESIZE));
+      }
+      if (fds[i] != -1) {
+        close(fds[i]);
+      }
+    }
+  }
+
+  // false if the event is not on a hardware counter at the moment
+  static bool readUserPage(perf_event_mmap_page * pc, long & value) {
+#if defined (__x86_64__)
+    uint32_t seq;
+    do {
+      seq = pc->lock;
+      std::atomic_signal_fence(std::memory_order_seq_cst);
+      uint32_t index = pc->index;
+      if (index == 0) {
+        return false;
+      }
+      uint32_t lo, hi;
+      asm volatile("rdpmc" : "=a" (lo), "=d" (hi) : "c" (index - 1));
+      // sign extend the counter of pmc_width bits
+      int shift = 64 - pc->pmc_width;
+      long pmc = (long) ((((unsigned long) hi << 32) | lo) << shift) >> shift;
+      value = pc->offset + pmc;
+      std::atomic_signal_fence(std::memory_order_seq_cst);
+    } while (pc->lock != seq);
+    return true;
+#else
+    return false;
+#endif
+  }
+
+  void read(Counts & counts) {
+    if (pages[1] != nullptr &&
+        readUserPage(pages[0], counts.cycles) && readUserPage(pages[1], counts.instructions)) {
+      return;
+    }
+    // nr, then the value of each event
+    long values[3] = {0, 0, 0};
+    ::read(fds[0], values, sizeof(values));
+    counts.cycles = values[1];
+    counts.instructions = values[2];
+  }
+};
+
+// set once a thread fails to open its counters
+static std::atomic_bool g_countersUnavailable(false);
+
 // Note: the thread-local TL_lastCallTimePerFunc may be destructed if the thread is terminating,
 // leading to segfault.
 // This is usually because there are other functions registered via `atexit()`.
@@ -168,11 +360,112 @@ static thread_local struct perfFD tl_perffd;
 // calling functions registered via `atexit()`, hence invalidating the data.
 // So do not use thread-local data.
 
+// An edge of the call graph, the caller is 0 for calls at the bottom of a stack.
+struct CallEdge {
+  long caller;
+  long callee;
+  long count;
+  // inclusive time of the callee
+  long time;
+};
+
+// Call graph edges in an open addressing hash table with linear probing,
+// empty slots have count 0.
+class EdgeTable {
+  std::vector<CallEdge> slots;
+  size_t used = 0;
+
+  size_t slot(long caller, long callee) const {
+    size_t mask = slots.size() - 1;
+    size_t i = (((unsigned long) caller * 0x9e3779b97f4a7c15UL) ^ (unsigned long) callee) * 0xbf58476d1ce4e5b9UL;
+    i = (i ^ (i >> 31)) & mask;
+    while (slots[i].count != 0 && (slots[i].caller != caller || slots[i].callee != callee)) {
+      i = (i + 1) & mask;
+    }
+    return i;
+  }
+
+  void grow() {
+    std::vector<CallEdge> old(slots.size() * 2, CallEdge{0, 0, 0, 0});
+    old.swap(slots);
+    for (auto & e : old) {
+      if (e.count != 0) {
+        slots[slot(e.caller, e.callee)] = e;
+      }
+    }
+  }
+
+public:
+  EdgeTable() : slots(1024, CallEdge{0, 0, 0, 0}) {}
+
+  void add(long caller, long callee, long time) {
+    // at most half full
+    if ((used + 1) * 2 > slots.size()) {
+      grow();
+    }
+    auto & e = slots[slot(caller, callee)];
+    if (e.count == 0) {
+      e.caller = caller;
+      e.callee = callee;
+      used++;
+    }
+    e.count++;
+    e.time += time;
+  }
+
+  template <typename F>
+  void forEach(F f) const {
+    for (auto & e : slots) {
+      if (e.count != 0) {
+        f(e);
+      }
+    }
+  }
+};
+
+// if g_recordCallGraph
+static EdgeTable * g_callGraph;
+
 // per thread, fid -> time
 // static thread_local std::unordered_map<long, long> TL_lastCallTimePerFunc;
 
-static std::unordered_map<pid_t, std::unordered_map<long, long> *> * g_lastCallTimePerFuncPerThread;
-static std::mutex  * g_lastCallTimeMapLock;
+// a call on the shadow stack
+struct Frame {
+  long fid;
+  long start;
+  // inclusive time of the finished callees
+  long children;
+  // number of the finished direct callees, and of all calls below
+  long callees;
+  long descendants;
+};
+
+struct ThreadState {
+  // fid -> time
+  std::unordered_map<long, long> lastCallTime;
+  // calls not returned yet, only kept if g_keepStack
+  std::vector<Frame> stack;
+  // index into g_threadCounters
+  int index;
+  // hardware counters if g_multiCounter and available, and their values at the last call of each fid
+  CounterGroup * counters = nullptr;
+  std::unordered_map<long, Counts> lastCounts;
+
+  ~ThreadState() {
+    delete counters;
+  }
+};
+
+// a thread with its own counters
+struct ThreadInfo {
+  pid_t tid;
+  char name[16];
+};
+
+static std::unordered_map<pid_t, ThreadState *> * g_threadStates;
+// by thread index
+static std::vector<ThreadInfo> * g_threadTable;
+static std::mutex  * g_threadStateLock;
 
 //===----------------------------------------------------------------------===//
 //
@@ -185,8 +478,60 @@ void __trec_enter(long fid) {
   DEBUG(printf("[perfRT] enter %ld\n", fid););
 
   long t = currentTime();
-  auto map = getLastCallTimeMap();
-  (*map)[fid] = t;
+  auto state = getThreadState();
+  state->lastCallTime[fid] = t;
+  if (g_keepStack) {
+    state->stack.push_back({fid, t, 0, 0, 0});
+  }
+  // read last, so that less of the probe is counted
+  if (state->counters != nullptr) {
+    state->counters->read(state->lastCounts[fid]);
+  }
+}
+
+static void addCount(std::unordered_map<long, std::vector<long>> * counter, long fid, int i) {
+  if (counter->count(fid) == 0) {
+    std::vector<long> newVec(g_defaultNumOfBuckets, 0);
+    counter->insert({fid, std::move(newVec)});
+  }
+
+  auto & bucket = counter->at(fid).at(i);
+  bucket++;
+}
+
+// A call popped from the shadow stack.
+struct Return {
+  long inclusive;
+  long self;
+  // 0 at the bottom of the stack
+  long caller;
+  long callees;
+  long descendants;
+};
+
+// Pop the call of `fid` from the shadow stack, false if it is not on the stack.
+static bool popFrame(ThreadState * state, long fid, long t, Return & ret) {
+  auto & stack = state->stack;
+  // calls above it have been left without exit, e.g., by longjmp()
+  auto it = std::find_if(stack.rbegin(), stack.rend(), [fid](const Frame & f) { return f.fid == fid; });
+  if (it == stack.rend()) {
+    return false;
+  }
+  Frame frame = *it;
+  stack.erase(std::prev(it.base()), stack.end());
+
+  ret.inclusive = t - frame.start;
+  ret.self = std::max(ret.inclusive - frame.children, 0L);
+  ret.caller = 0;
+  ret.callees = frame.callees;
+  ret.descendants = frame.descendants;
+  if (!stack.empty()) {
+    stack.back().children += ret.inclusive;
+    stack.back().callees++;
+    stack.back().descendants += frame.descendants + 1;
+    ret.caller = stack.back().fid;
+  }
+  return true;
 }
 
 void __trec_exit(long fid) {
@@ -197,21 +542,50 @@ void __trec_exit(long fid) {
   // E.g., sed when run as `sed '~1d'`
   // Maybe it's because another function is registered by `aexit()`?
 
+  Counts counts = {0, 0};
+  auto state = getThreadState();
+  if (state->counters != nullptr) {
+    state->counters->read(counts);
+  }
   long t   = currentTime();
-  auto map = getLastCallTimeMap();
-  long val = map->at(fid);
+  long val = state->lastCallTime.at(fid);
   long delta = t - val;
   int i = computeIndexFromDelta((unsigned int) delta);
+  Return ret;
+  bool popped = g_keepStack && popFrame(state, fid, t, ret);
   
   g_lock->lock();
 
-  if (g_funcCallCounter->count(fid) == 0) {
-    std::vector<long> newVec(g_defaultNumOfBuckets, 0);
-    g_funcCallCounter->insert({fid, std::move(newVec)});
+  addCount(g_funcCallCounter, fid, i);
+  if (g_recordEpochs) {
+    g_epochDirty->insert(fid);
+  }
+  if (popped && g_recordSelfTime) {
+    addCount(g_selfTimeCounter, fid, computeIndexFromDelta((unsigned int) ret.self));
+  }
+  if (popped && g_recordCallGraph) {
+    g_callGraph->add(ret.caller, fid, ret.inclusive);
+  }
+  if (g_numThreads > 0) {
+    addCount(&(*g_threadCounters)[state->index], fid, i);
+  }
+  if (state->counters != nullptr) {
+    auto & last = state->lastCounts.at(fid);
+    long cycles = counts.cycles - last.cycles;
+    long instructions = counts.instructions - last.instructions;
+    addCount(g_cycleCounter, fid, computeIndexFromDelta((unsigned int) cycles));
+    addCount(g_insnCounter, fid, computeIndexFromDelta((unsigned int) instructions));
+    auto & totals = (*g_countTotals)[fid];
+    totals.calls++;
+    totals.cycles += cycles;
+    totals.instructions += instructions;
+  }
+  if (popped && g_calibrate) {
+    auto & c = (*g_childCalls)[fid];
+    c.calls++;
+    c.callees += ret.callees;
+    c.descendants += ret.descendants;
   }
-
-  auto & bucket = g_funcCallCounter->at(fid).at(i);
-  bucket++;
   DEBUG(printf("[perfRT] exit %ld delta %ld\n", fid, delta););
 
   g_lock->unlock();
@@ -266,19 +640,32 @@ void __trec_deinit() {
   g_flusher->join();
 
   delete g_funcCallCounter;
+  delete g_selfTimeCounter;
+  delete g_callGraph;
+  delete g_epochBase;
+  delete g_epochDirty;
+  delete g_epochPath;
+  delete g_threadCounters;
+  delete g_threadTable;
+  delete g_childCalls;
+  delete g_cycleCounter;
+  delete g_insnCounter;
+  delete g_countTotals;
   delete g_lock;
   delete g_shouldQuit;
   delete g_flusher;
   delete g_dataPath;
+  delete g_snapshotPrefix;
+  delete g_controlPath;
   delete g_binPath;
   delete g_cmdline;
   delete g_pwd;
   delete g_timeIntervals;
-  for (auto kv : *g_lastCallTimePerFuncPerThread) {
+  for (auto kv : *g_threadStates) {
     delete kv.second;
   }
-  delete g_lastCallTimePerFuncPerThread;
-  delete g_lastCallTimeMapLock;
+  delete g_threadStates;
+  delete g_threadStateLock;
   delete g_fids;
 }
 
@@ -300,6 +687,10 @@ void __trec_init() {
     g_mode = CYCLE;
   } else if (strcmp(env, "insn") == 0) {
     g_mode = INSN;
+  } else if (strcmp(env, "multi") == 0) {
+    // time in the main records, cycles and instructions in sections
+    g_mode = TIME;
+    g_multiCounter = true;
   } else {
     std::string v = std::string(env);
     if (v.starts_with("fid=")) {
@@ -318,7 +709,7 @@ void __trec_init() {
       g_fids = new std::vector<unsigned long>(fids);
     } else {
       fprintf(stderr, 
-        "[perfRT] Unknown value for env %s: %s, available ones: time, cycle, insn, fid=xx,...\n", g_envMode, env);
+        "[perfRT] Unknown value for env %s: %s, available ones: time, cycle, insn, multi, fid=xx,...\n", g_envMode, env);
       abort();
     }
   }
@@ -342,6 +733,9 @@ void __trec_init() {
   // generate data file name: trec_perf_comm_pid.bin
   std::string comm(program_invocation_short_name);
   std::string pidStr(std::to_string(g_pid));
+  g_snapshotPrefix = new std::string(std::filesystem::path(p) / ("trec_snap_" + comm + "_" + pidStr + "_"));
+  g_controlPath = new std::string(std::filesystem::path(p) / g_snapshotControlFile);
+  g_epochPath = new std::string(std::filesystem::path(p) / ("trec_epoch_" + comm + "_" + pidStr + ".bin"));
   g_dataPath = new std::string(p.append("trec_perf_" + comm + "_" + pidStr + ".bin"));
   DEBUG(printf("[perfRT] data file: %s\n", g_dataPath->c_str()););
 
@@ -365,6 +759,48 @@ void __trec_init() {
     }
   }
 
+  // BBLs do not call each other
+  if (g_mode != TIME_BBL) {
+    env = getenv(g_envSelfTime);
+    g_recordSelfTime = env != nullptr && strcmp(env, "1") == 0;
+    env = getenv(g_envCallGraph);
+    g_recordCallGraph = env != nullptr && strcmp(env, "1") == 0;
+    env = getenv(g_envCalibrate);
+    g_calibrate = env != nullptr && strcmp(env, "1") == 0;
+    g_keepStack = g_recordSelfTime || g_recordCallGraph || g_calibrate;
+  }
+  env = getenv(g_envEpochs);
+  g_recordEpochs = env != nullptr && strcmp(env, "1") == 0;
+  if (g_recordEpochs) {
+    // from an earlier process of the same pid
+    std::filesystem::remove(*g_epochPath);
+  }
+
+  env = getenv(g_envThreads);
+  if (env != nullptr) {
+    int count = atoi(env);
+    if (count <= 0 || count >= g_maxThreads) {
+      fprintf(stderr, "[perfRT] Invalid thread count %s, must be in [1, %d), not recording per thread\n", env, g_maxThreads);
+    } else {
+      g_numThreads = count;
+    }
+  }
+
+  env = getenv(g_envFlush);
+  g_flushOnDemand = env != nullptr && strcmp(env, "demand") == 0;
+  env = getenv(g_envSnapshot);
+  g_snapshots = env != nullptr && strcmp(env, "1") == 0;
+  if (g_snapshots) {
+    // an existing control file does not trigger a snapshot
+    controlFileTouched();
+    struct sigaction sa;
+    memset(&sa, 0, sizeof(sa));
+    sa.sa_handler = requestSnapshot;
+    sa.sa_flags = SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    sigaction(SIGUSR2, &sa, nullptr);
+  }
+
   struct utsname uts;
   if (uname(&uts)) {
     fprintf(stderr, "[perfRT] Fail to get machine arch\n");
@@ -423,10 +859,24 @@ void __trec_init() {
   initTimeIntervals();
   
   g_funcCallCounter = new std::unordered_map<long, std::vector<long>>();
+  g_selfTimeCounter = new std::unordered_map<long, std::vector<long>>();
+  g_callGraph = new EdgeTable();
+  g_epochBase = new std::unordered_map<long, std::vector<long>>();
+  g_epochDirty = new std::unordered_set<long>();
+  // one more for "other"
+  g_threadCounters = new std::vector<std::unordered_map<long, std::vector<long>>>(g_numThreads + 1);
+  g_threadTable = new std::vector<ThreadInfo>();
+  g_childCalls = new std::unordered_map<long, ChildCalls>();
+  g_cycleCounter = new std::unordered_map<long, std::vector<long>>();
+  g_insnCounter = new std::unordered_map<long, std::vector<long>>();
+  g_countTotals = new std::unordered_map<long, CountTotals>();
   g_lock = new std::mutex();
-  g_lastCallTimePerFuncPerThread = new std::unordered_map<pid_t, std::unordered_map<long, long> *>();
-  g_lastCallTimeMapLock = new std::mutex();
+  g_threadStates = new std::unordered_map<pid_t, ThreadState *>();
+  g_threadStateLock = new std::mutex();
   g_shouldQuit  = new std::atomic_bool(false);
+  if (g_calibrate) {
+    calibrate();
+  }
   // spawn a thread for syncing data
   g_flusher = new std::thread(flushData);
 
@@ -441,21 +891,71 @@ void __trec_init() {
 //
 //===----------------------------------------------------------------------===//
 
-std::unordered_map<long, long> * getLastCallTimeMap() {
-  g_lastCallTimeMapLock->lock();
+ThreadState * getThreadState() {
+  g_threadStateLock->lock();
 
-  std::unordered_map<long, long> * theMap;
+  ThreadState * state;
   pid_t tid = gettid();
-  if (!g_lastCallTimePerFuncPerThread->contains(tid)) {
-    theMap = new std::unordered_map<long, long>();
-    (*g_lastCallTimePerFuncPerThread)[tid] = theMap;
+  if (!g_threadStates->contains(tid)) {
+    state = new ThreadState();
+    state->index = std::min((int) g_threadTable->size(), g_numThreads);
+    if (state->index < g_numThreads) {
+      ThreadInfo info = {tid, {0}};
+      pthread_getname_np(pthread_self(), info.name, sizeof(info.name));
+      g_threadTable->push_back(info);
+    }
+    if (g_multiCounter) {
+      state->counters = new CounterGroup();
+      if (!state->counters->open()) {
+        if (!g_countersUnavailable.exchange(true)) {
+          fprintf(stderr, "[perfRT] Failed to open hardware counters: %s, recording time only\n", strerror(errno));
+        }
+        delete state->counters;
+        state->counters = nullptr;
+      }
+    }
+    (*g_threadStates)[tid] = state;
   } else {
-    theMap = g_lastCallTimePerFuncPerThread->at(tid);
+    state = g_threadStates->at(tid);
   }
 
-  g_lastCallTimeMapLock->unlock();
+  g_threadStateLock->unlock();
 
-  return theMap;
+  return state;
+}
+
+// Measure the probe cost of a call as seen by its caller, i.e., the time of an empty
+// instrumented call, as the median of several runs on a fid no function has.
+// The counters are cleared afterwards.
+static void calibrate() {
+  constexpr long calibrationFid = -1;
+  double costs[g_calibrationRuns];
+  for (int r = 0; r < g_calibrationRuns; r++) {
+    long start = currentTime();
+    for (int i = 0; i < g_calibrationIterations; i++) {
+      __trec_enter(calibrationFid);
+      __trec_exit(calibrationFid);
+    }
+    costs[r] = (double) (currentTime() - start) / g_calibrationIterations;
+  }
+  std::sort(costs, costs + g_calibrationRuns);
+  g_probeCost = costs[g_calibrationRuns / 2];
+  DEBUG(printf("[perfRT] probe cost %f\n", g_probeCost););
+
+  g_funcCallCounter->clear();
+  g_selfTimeCounter->clear();
+  delete g_callGraph;
+  g_callGraph = new EdgeTable();
+  for (auto & c : *g_threadCounters) {
+    c.clear();
+  }
+  g_childCalls->clear();
+  g_epochDirty->clear();
+  g_cycleCounter->clear();
+  g_insnCounter->clear();
+  g_countTotals->clear();
+  getThreadState()->lastCallTime.clear();
+  getThreadState()->lastCounts.clear();
 }
 
 inline static long currentTimeClock() {
@@ -482,7 +982,73 @@ inline static long currentTime() {
   return currentTimeClock();
 }
 
-static void flushImpl() {
+static void writeRecords(std::ofstream & ofs, const std::unordered_map<long, std::vector<long>> & counter) {
+  for (auto & kv : counter) {
+    // fid
+    ofs.write((const char *)&kv.first, sizeof(kv.first));
+    for (auto & c : kv.second) {
+      // buckets
+      ofs.write((const char *)&c, sizeof(c));
+    }
+  }
+}
+
+// A section: 4-byte tag, payload size (u64), payload written by `writePayload`.
+template <typename F>
+static void writeSection(std::ofstream & ofs, const char (&tag)[5], F writePayload) {
+  ofs.write(tag, 4);
+  auto sizePos = ofs.tellp();
+  uint64_t size = 0;
+  ofs.write((const char *)&size, sizeof(size));
+  writePayload();
+  auto end = ofs.tellp();
+  size = end - sizePos - (std::streamoff) sizeof(size);
+  ofs.seekp(sizePos);
+  ofs.write((const char *)&size, sizeof(size));
+  ofs.seekp(end);
+}
+
+template <typename T>
+static void append(std::string & buf, T v) {
+  buf.append((const char *)&v, sizeof(v));
+}
+
+// Append the changes of counters since the last epoch to the epoch file, so that a flush
+// writes only the new epoch however long the program runs:
+// end time of the epoch (ns, u64), number of changes (u32),
+// and each change as fid (u64), bucket (u32), count (u32),
+// a change over UINT32_MAX is split.
+// Only the fids called since the last epoch are compared.
+static void closeEpoch() {
+  std::string epoch;
+  std::string changes;
+  uint32_t n = 0;
+  for (long fid : *g_epochDirty) {
+    auto & counts = g_funcCallCounter->at(fid);
+    auto & base = (*g_epochBase)[fid];
+    if (base.empty()) {
+      base.assign(g_defaultNumOfBuckets, 0);
+    }
+    for (uint32_t i = 0; i < (uint32_t) g_defaultNumOfBuckets; i++) {
+      for (long d = counts[i] - base[i]; d > 0; d -= UINT32_MAX) {
+        append<uint64_t>(changes, fid);
+        append<uint32_t>(changes, i);
+        append<uint32_t>(changes, std::min(d, (long) UINT32_MAX));
+        n++;
+      }
+    }
+    base = counts;
+  }
+  g_epochDirty->clear();
+  append<uint64_t>(epoch, currentTimeClock());
+  append<uint32_t>(epoch, n);
+  epoch.append(changes);
+
+  std::ofstream ofs(g_epochPath->c_str(), std::ios::out | std::ios::binary | std::ios::app);
+  ofs.write(epoch.data(), epoch.size());
+}
+
+static void flushImpl(const char * path) {
   if (getpid() != g_pid) {
     // TODO write to a new file
     fprintf(stderr, "[perfRT] Program %s has forked, trec perf data is nor recorded in the child process\n", program_invocation_short_name);
@@ -491,7 +1057,7 @@ static void flushImpl() {
 
   g_lock->lock();
 
-  std::ofstream ofs(g_dataPath->c_str(), std::ios::out | std::ios::binary | std::ios::trunc);
+  std::ofstream ofs(path, std::ios::out | std::ios::binary | std::ios::trunc);
   ofs.write(g_cmdline->c_str(), g_cmdline->length());
   // End of Text: delimitor
   ofs.put('\3');
@@ -500,7 +1066,9 @@ static void flushImpl() {
   ofs.write(g_pwd->c_str(), g_pwd->length());
   ofs.put('\3');
   // write mode
-  ofs.write((const char *)&g_mode, sizeof(g_mode));
+  bool extended = g_recordSelfTime || g_recordCallGraph || g_numThreads > 0 || g_calibrate || g_multiCounter;
+  unsigned char mode = extended ? (g_mode | g_extendedFormat) : g_mode;
+  ofs.write((const char *)&mode, sizeof(mode));
   // write arch
   ofs.write((const char *)&g_arch, sizeof(g_arch));
   // write vector length
@@ -508,13 +1076,75 @@ static void flushImpl() {
   // write time interval
   ofs.write((const char *)&g_interval, sizeof(g_interval));
   // write data
-  for (auto & kv : *g_funcCallCounter) {
-    // fid
-    ofs.write((const char *)&kv.first, sizeof(kv.first));
-    for (auto & c : kv.second) {
-      // buckets
-      ofs.write((const char *)&c, sizeof(c));
-    }
+  if (extended) {
+    uint32_t n = g_funcCallCounter->size();
+    ofs.write((const char *)&n, sizeof(n));
+  }
+  writeRecords(ofs, *g_funcCallCounter);
+
+  if (g_recordSelfTime) {
+    // records of self time, in the same layout
+    writeSection(ofs, "SELF", [&] { writeRecords(ofs, *g_selfTimeCounter); });
+  }
+  if (g_recordCallGraph) {
+    // caller, callee, count, time of each edge
+    writeSection(ofs, "CGRF", [&] {
+      g_callGraph->forEach([&](const CallEdge & e) { ofs.write((const char *)&e, sizeof(e)); });
+    });
+  }
+  if (g_calibrate) {
+    // probe cost (f64), runs and iterations of the calibration (u32)
+    writeSection(ofs, "CALB", [&] {
+      uint32_t runs = g_calibrationRuns, iterations = g_calibrationIterations;
+      ofs.write((const char *)&g_probeCost, sizeof(g_probeCost));
+      ofs.write((const char *)&runs, sizeof(runs));
+      ofs.write((const char *)&iterations, sizeof(iterations));
+    });
+    // fid, calls, direct callees and all calls below (i64)
+    writeSection(ofs, "CHLD", [&] {
+      for (auto & kv : *g_childCalls) {
+        ofs.write((const char *)&kv.first, sizeof(kv.first));
+        ofs.write((const char *)&kv.second, sizeof(kv.second));
+      }
+    });
+  }
+  if (g_multiCounter) {
+    // records of cycles and of instructions, in the same layout
+    writeSection(ofs, "CYCL", [&] { writeRecords(ofs, *g_cycleCounter); });
+    writeSection(ofs, "INST", [&] { writeRecords(ofs, *g_insnCounter); });
+    // fid, calls, total cycles and instructions (i64)
+    writeSection(ofs, "CSUM", [&] {
+      for (auto & kv : *g_countTotals) {
+        ofs.write((const char *)&kv.first, sizeof(kv.first));
+        ofs.write((const char *)&kv.second, sizeof(kv.second));
+      }
+    });
+  }
+  if (g_recordEpochs) {
+    closeEpoch();
+  }
+  if (g_numThreads > 0) {
+    // index of other threads (u32), then tid (i32) and name (16 bytes) of each thread index before it
+    writeSection(ofs, "THRD", [&] {
+      uint32_t other = g_numThreads;
+      ofs.write((const char *)&other, sizeof(other));
+      g_threadStateLock->lock();
+      for (auto & t : *g_threadTable) {
+        ofs.write((const char *)&t.tid, sizeof(t.tid));
+        ofs.write(t.name, sizeof(t.name));
+      }
+      g_threadStateLock->unlock();
+    });
+    // thread index (i64) followed by a record in the main layout
+    writeSection(ofs, "TCNT", [&] {
+      for (long t = 0; t <= g_numThreads; t++) {
+        for (auto & kv : (*g_threadCounters)[t]) {
+          ofs.write((const char *)&t, sizeof(t));
+          ofs.write((const char *)&kv.first, sizeof(kv.first));
+          ofs.write((const char *)kv.second.data(), kv.second.size() * sizeof(long));
+        }
+      }
+    });
   }
 
   ofs.close();
@@ -522,6 +1152,28 @@ static void flushImpl() {
   g_lock->unlock();
 }
 
+static void requestSnapshot(int) {
+  g_snapshotRequested = 1;
+}
+
+// true if the control file has been touched since the last check
+static bool controlFileTouched() {
+  struct stat st;
+  if (stat(g_controlPath->c_str(), &st) != 0) {
+    return false;
+  }
+  bool touched = st.st_mtim.tv_sec != g_controlMtime.tv_sec || st.st_mtim.tv_nsec != g_controlMtime.tv_nsec;
+  g_controlMtime = st.st_mtim;
+  return touched;
+}
+
+// Write the counters so far to trec_snap_comm_pid_time.bin, time in ns since the epoch.
+static void takeSnapshot() {
+  std::string path = *g_snapshotPrefix + std::to_string(currentTimeClock()) + ".bin";
+  flushImpl(path.c_str());
+  DEBUG(printf("[perfRT] snapshot %s\n", path.c_str()););
+}
+
 static void flushData() {
   // Shouldn't handle signals on behalf of normal threads.
   sigset_t set;
@@ -532,17 +1184,23 @@ static void flushData() {
   DEBUG(printf("[perfRT] flusher started\n"););
 
   while (true) {
-    // Sleep for 1s, but check for quit signal frequently.
+    // Sleep for 1s, but check for quit signal and snapshot requests frequently.
     for (int i = 0; i < 20; i++) {
       if (*g_shouldQuit) {
-        flushImpl();
+        flushImpl(g_dataPath->c_str());
         DEBUG(printf("[perfRT] flusher quit\n"););
         return;
       }
+      if (g_snapshots && (g_snapshotRequested || controlFileTouched())) {
+        g_snapshotRequested = 0;
+        takeSnapshot();
+      }
       std::this_thread::sleep_for(std::chrono::milliseconds(50));
     }
 
-    flushImpl();   
+    if (!g_flushOnDemand) {
+      flushImpl(g_dataPath->c_str());
+    }
   }
 }
 
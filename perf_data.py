@@ -13,7 +13,6 @@
 import shutil
 import os
 import subprocess
-import yaml
 import argparse
 import sqlite3
 from contextlib import closing
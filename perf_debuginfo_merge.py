@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# merge debuginfo{dbID}.db written by the compiler into one database
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+
+
+import os
+import sys
+import argparse
+import sqlite3
+from contextlib import closing
+from perflib import *
+
+
+# the tables of debuginfo{dbID}.db with the dbID added to the primary key,
+# WITHOUT ROWID so that the rows are stored in key order and lookups by dbID need no extra index;
+# the mtime (ns) and size of each merged database tell whether it has been rebuilt since
+SQL_CREATE_MERGED = \
+    "CREATE TABLE SHARDS (" \
+        "DBID  INTEGER PRIMARY KEY," \
+        "MTIME INTEGER," \
+        "SIZE  INTEGER);" \
+    "CREATE TABLE FILENAMES (" \
+        "DBID INTEGER," \
+        "ID   INTEGER," \
+        "NAME TEXT," \
+        "PRIMARY KEY (DBID, ID)) WITHOUT ROWID;" \
+    "CREATE TABLE FUNCNAMES (" \
+        "DBID INTEGER," \
+        "ID   INTEGER," \
+        "NAME TEXT," \
+        "PRIMARY KEY (DBID, ID)) WITHOUT ROWID;" \
+    "CREATE TABLE BBLS (" \
+        "DBID      INTEGER," \
+        "ID        INTEGER," \
+        "FID       INTEGER," \
+        "LINESTART INTEGER," \
+        "LINEEND   INTEGER," \
+        "PRIMARY KEY (DBID, ID)) WITHOUT ROWID;"
+
+
+def list_shards(db_dir: str) -> list[tuple[int, str]]:
+    shards = []
+    for name in os.listdir(db_dir):
+        m = g_debuginfo_shard.fullmatch(name)
+        if m is not None:
+            shards.append((int(m.group(1)), os.path.join(db_dir, name)))
+    shards.sort()
+    return shards
+
+
+def merge_debuginfo(db_dir: str, out: str):
+    """
+    Merge all debuginfo{dbID}.db under `db_dir` into `out`.
+    The database is written to a temporary file and renamed,
+    so readers never see a partial one.
+    """
+    shards = list_shards(db_dir)
+    if shards == []:
+        print(f'No debuginfo databases under {db_dir}')
+        exit(-1)
+
+    tmp = out + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    with closing(sqlite3.connect(tmp)) as connection:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.executescript(SQL_CREATE_MERGED)
+        # inserted in key order
+        for i, (dbID, path) in enumerate(shards):
+            checkDB(path)
+            # before reading, so that a database changed meanwhile is seen as out of date
+            st = os.stat(path)
+            with closing(sqlite3.connect(f'file:{path}?mode=ro', uri=True)) as shard:
+                files = shard.execute("select ID,NAME from FILENAMES order by ID").fetchall()
+                funcs = shard.execute("select ID,NAME from FUNCNAMES order by ID").fetchall()
+                bbls  = shard.execute("select ID,FID,LINESTART,LINEEND from BBLS order by ID").fetchall()
+            connection.execute("insert into SHARDS values (?, ?, ?)", (dbID, st.st_mtime_ns, st.st_size))
+            connection.executemany("insert into FILENAMES values (?, ?, ?)", ((dbID, *r) for r in files))
+            connection.executemany("insert into FUNCNAMES values (?, ?, ?)", ((dbID, *r) for r in funcs))
+            connection.executemany("insert into BBLS values (?, ?, ?, ?, ?)", ((dbID, *r) for r in bbls))
+            print(f'\rMerged {i + 1}/{len(shards)} databases', end='', flush=True)
+        print()
+        connection.commit()
+        connection.execute('VACUUM')
+
+    os.replace(tmp, out)
+    return len(shards)
+
+
+###
+### start of program
+###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge the debuginfo databases of a build into one, which perflib then uses instead.')
+    parser.add_argument('dbDir', type=str, help='directory of debuginfo databases')
+    parser.add_argument('-o', '--output', type=str, help=f'path to merged database, default: DBDIR/{g_merged_debuginfo}')
+
+    args = parser.parse_args()
+    checkDir(args.dbDir)
+    out = args.output if args.output is not None else os.path.join(args.dbDir, g_merged_debuginfo)
+    n = merge_debuginfo(args.dbDir, out)
+    print(f'{n} databases merged into {out}')
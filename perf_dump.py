@@ -30,8 +30,24 @@ if __name__ == '__main__':
         description='Dump perf data.')
     parser.add_argument('src_dir', type=str, help='path to src dir')
     parser.add_argument('debuginfo', type=str, help='path to debuginfo dir')
-    parser.add_argument('data_file', type=str, help='path to perf data file')
+    parser.add_argument('data_file', type=str, help='path to perf data file, or perf data dir with --top')
+    parser.add_argument('--top', type=int, help='dump only the top N records (by time unless --sort is given); '
+                        'for a perf data dir, show the top N functions by weighted time over all files')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes scanning perf data with --top, default: number of CPUs')
+    parser.add_argument('-f', '--format', type=str, choices=['text', 'jsonl', 'csv', 'bin'], default='text', help='output format, default: text')
+    parser.add_argument('-s', '--sort', type=str, choices=['fid', 'count', 'time', 'name'], help='sort records by this key')
+    parser.add_argument('-m', '--mode', type=str, choices=list(g_mode_names.values()), help='dump only if data is in this mode')
+    parser.add_argument('--fid', type=int, action='append', help='dump only this fid (or bblid in BBL mode), can be repeated')
+    parser.add_argument('--name', type=str, help='dump only functions whose names match this regex')
+    parser.add_argument('-o', '--output', type=str, help='output file, default: stdout')
 
     args = parser.parse_args()
-    if os.path.isfile(args.data_file) and os.path.isdir(args.src_dir) and os.path.isdir(args.debuginfo):
-        dump_perf_data(args.data_file, args.src_dir, args.debuginfo)
\ No newline at end of file
+    if os.path.isdir(args.data_file):
+        if args.top is None:
+            print('--top is required for a perf data dir')
+            exit(-1)
+        if os.path.isdir(args.debuginfo):
+            dump_top_k(args.data_file, args.debuginfo, args.top, args.jobs)
+    elif os.path.isfile(args.data_file) and os.path.isdir(args.src_dir) and os.path.isdir(args.debuginfo):
+        dump_perf_data(args.data_file, args.src_dir, args.debuginfo, args.format, args.sort, args.top,
+                       args.mode, args.fid, args.name, args.output)
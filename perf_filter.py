@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# generate an instrumentation filter (TREC_PERF_FILTER) from a previous profile
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+
+
+import os
+import sys
+import argparse
+from perflib import *
+
+
+def list_perf_data(data_dir: str) -> list[str]:
+    # name must be aligned with that in perfRT
+    files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.startswith('trec_perf_')]
+    if files == []:
+        print(f"{data_dir} has no data files")
+        exit(0)
+    return files
+
+
+def main(dir1: str, dir2: str, out: str, min_calls: int, max_mean: float, jobs: int):
+    dataDir1 = dir1 + "/perf_data"
+    dbDir1   = dir1 + "/debuginfo"
+    checkDir(dataDir1)
+    checkDir(dbDir1)
+    files1 = list_perf_data(dataDir1)
+
+    # symbol -> reason
+    denied: dict[str, str] = {}
+    cheap = cheap_hot_functions(files1, dbDir1, min_calls, max_mean, jobs)
+    for name, calls, mean in cheap:
+        denied[name] = f'{calls} calls, mean {mean:.1f} ns'
+    print(f'{len(cheap)} frequently called functions with a mean time of at most {max_mean:g} ns')
+
+    if dir2 is not None:
+        dataDir2 = dir2 + "/perf_data"
+        dbDir2   = dir2 + "/debuginfo"
+        checkDir(dataDir2)
+        checkDir(dbDir2)
+        files2 = list_perf_data(dataDir2)
+
+        perfDatas1, perfDatas2 = read_perf_data_lists([files1, files2], jobs)
+        for pds, dbDir in [(perfDatas1, dbDir1), (perfDatas2, dbDir2)]:
+            for pd in pds:
+                pd.dbDir = dbDir
+        stable = never_regressed_functions(perfDatas1, perfDatas2)
+        for name in stable:
+            denied.setdefault(name, f'never regressed against {dir2}')
+        print(f'{len(stable)} functions never regressed')
+
+    write_instr_filter(out, sorted(denied.items()), f'generated from {dir1}')
+    print(f'{len(denied)} functions denied in {out}')
+
+
+###
+### start of program
+###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate an instrumentation filter from a previous profile, for a low-overhead instrumented build.')
+    parser.add_argument('dataDir', type=str, help='directory of perf data and debuginfo of the previous profile')
+    parser.add_argument('-c', '--compare', type=str, help='directory of perf data and debuginfo to compare with, '
+                                                          'functions never regressed against it are also denied')
+    parser.add_argument('-o', '--output', type=str, default='perf_filter.txt', help='filter file, default: perf_filter.txt')
+    parser.add_argument('--min-calls', type=int, default=100000, help='deny functions called at least this many times, default: 100000')
+    parser.add_argument('--max-mean', type=float, default=250, help='and whose mean time is at most this many ns, default: 250')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes reading perf data, default: number of CPUs')
+
+    args = parser.parse_args()
+    main(args.dataDir, args.compare, args.output, args.min_calls, args.max_mean, args.jobs)
@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# export the call graph of instrumented runs as flame graphs
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+
+
+import os
+import sys
+import argparse
+from perflib import *
+
+
+def list_perf_data(paths: list[str]) -> list[str]:
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            # name must be aligned with that in perfRT
+            files += [os.path.join(p, f) for f in sorted(os.listdir(p)) if f.startswith('trec_perf_')]
+        else:
+            checkFile(p)
+            files.append(p)
+    return files
+
+
+###
+### start of program
+###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the call graph recorded with TREC_PERF_CALL_GRAPH=1 as collapsed stacks or speedscope JSON.')
+    parser.add_argument('debuginfo', type=str, help='path to debuginfo dir')
+    parser.add_argument('data', nargs='+', type=str, help='perf data files or dirs, whose call graphs are summed')
+    parser.add_argument('-f', '--format', type=str, choices=['collapsed', 'speedscope'], default='collapsed',
+                        help='output format, default: collapsed')
+    parser.add_argument('-o', '--output', type=str, help='output file, default: stdout')
+    parser.add_argument('--min-fraction', type=float, default=1e-4,
+                        help='drop subtrees below this fraction of the total time, default: 0.0001')
+    parser.add_argument('--max-depth', type=int, default=64, help='maximum stack depth, default: 64')
+
+    args = parser.parse_args()
+    checkDir(args.debuginfo)
+    files = list_perf_data(args.data)
+    edges = read_call_graph(files)
+    if len(edges) == 0:
+        print('No call graph found')
+        exit(-1)
+
+    symtab = get_symbol_table(args.debuginfo)
+    walk_args = { 'min_fraction': args.min_fraction, 'max_depth': args.max_depth }
+    f = open(args.output, 'w', buffering=1 << 20) if args.output is not None else sys.stdout
+    if args.format == 'collapsed':
+        write_collapsed_stacks(edges, symtab.get_symbol_name, f, **walk_args)
+    else:
+        name = os.path.basename(files[0]) if len(files) == 1 else os.path.basename(os.path.normpath(args.data[0]))
+        write_speedscope(edges, symtab.get_symbol_name, f, name, **walk_args)
+    if args.output is not None:
+        f.close()
@@ -21,7 +21,6 @@ import argparse
 # import seaborn as sns
 import sqlite3
 from contextlib import closing
-import yaml
 from perflib import *
 
 # Apply the default theme
@@ -32,6 +31,16 @@ from perflib import *
 # draw diagram
 
 g_dump = False
+g_merge = False
+# [{ 'label', 'files', 'testcases' }] of each dataset when runs are merged
+g_merge_stats = None
+# compare self time (time minus callees) instead of time
+g_self_time = False
+# take the probe cost out of the times
+g_compensate = False
+# compare this metric recorded with TREC_PERF_MODE=multi instead of time
+g_metric = 'time'
+g_metric_labels = { 'cycles': '周期数', 'instructions': '指令数' }
 
 
 def dedup_reports(results: list[PerfResult]):
@@ -44,7 +53,8 @@ def dedup_reports(results: list[PerfResult]):
 
 
 class ReportItemNew:
-    def __init__(self, func: str, fid1, fid2, code: str, file: str, plot_id: int, ratio):
+    def __init__(self, func: str, fid1, fid2, code: str, file: str, plot_id: int, ratio,
+                 plot_offset = 0, plot_points = 0, plot_step = 1):
         self.func = func
         self.fid1 = fid1
         self.fid2 = fid2
@@ -52,92 +62,214 @@ class ReportItemNew:
         self.file = file
         self.plot_id = plot_id
         self.ratio = round(ratio*100, 2)
+        # where the plot of this function is in the plot file of its page
+        self.plot_offset = plot_offset
+        self.plot_points = plot_points
+        self.plot_step = plot_step
+
+
+class ReportItemStar:
+    def __init__(self, func: str, fids: list, code: str, file: str, plot_id: int, ratio, ratios, times,
+                 plot_offset = 0, plot_points = 0, plot_step = 1):
+        self.func = func
+        self.fids = fids
+        self.code = code
+        self.file = file
+        self.plot_id = plot_id
+        self.ratio = round(ratio*100, 2)
+        # per dataset
+        self.ratios = [round(r*100, 2) for r in ratios]
+        self.times = times
+        self.plot_offset = plot_offset
+        self.plot_points = plot_points
+        self.plot_step = plot_step
 
 
 class FuncPlot:
-    def __init__(self, plot_id, interval, dist1: list[int], dist2: list[int]):
+    """
+    The distributions of a function downsampled to at most `g_plot_points` points,
+    each point being the sum of `step` buckets; trailing empty buckets are dropped.
+    """
+    def __init__(self, plot_id, interval, dist1: list[int], dist2: list[int], *dists: list[int]):
         self.plot_id = plot_id
         self.interval = interval
 
-        self.xs1= []
-        self.xs2= []
-        self.ys1= []
-        self.ys2= []
+        dists = [dist1, dist2, *dists]
+        # counts rebinned onto a grid with a non-multiple interval are fractional
+        d = np.zeros((len(dists), max(map(len, dists))), dtype=np.float64)
+        for i, dist in enumerate(dists):
+            d[i, :len(dist)] = dist
+        nz = np.flatnonzero(d.any(axis=0))
+        n = nz[-1].item() + 1 if len(nz) > 0 else 1
+
+        self.step = -(-n // g_plot_points)
+        self.points = -(-n // self.step)
+        d = np.pad(d[:, :n], ((0, 0), (0, self.points * self.step - n)))
+        self.ys = d.reshape(len(dists), self.points, self.step).sum(axis=2).astype(np.float32)
+
 
-        t = 0
-        for c in dist1:
-            self.ys1.append(c)
-            self.xs1.append(t)
-            t += 1
-        t = 0
-        for c in dist2:
-            self.ys2.append(c)
-            self.xs2.append(t)
-            t += 1
+# functions per page of the report
+g_page_size = 200
+# max points per plot
+g_plot_points = 512
 
 
-def dump_result(res, name, path):
-    with open(f'{path}/{name}.yaml', 'w') as f:
-        yaml.dump(res, f)
+def page_file(name, i):
+    return f'{name}.html' if i == 0 else f'{name}_{i}.html'
+
+
+def write_plot_file(path: str, plots: list[FuncPlot]):
+    """
+    Write plots of a page as base64 of their float32 data, loaded by the page with a <script> tag,
+    which works for pages opened from file:// as well.
+    """
+    import base64
+
+    data = b''.join(p.ys.tobytes() for p in plots)
+    with open(path, 'w') as f:
+        f.write('window.PLOT_DATA = "')
+        f.write(base64.b64encode(data).decode('ascii'))
+        f.write('";\n')
+
+
+def render_pages(template, results: list, filename, path, make_report, **args):
+    """
+    Render `results` with `template` into pages of `g_page_size` functions, `filename.html` being the first page,
+    and the plots of each page into `filename[_N]_plots.js`.
+    `make_report(plot_id, res, code, src_file)` returns the report item and plot of a result,
+    the item is given the position of the plot in the plot file.
+    """
+    pages = [page_file(filename, i) for i in range(-(-len(results) // g_page_size))]
+
+    print('Rendering report...')
+    for page in range(len(pages)):
+        reports = []
+        plots: list[FuncPlot] = []
+        offset = 0
+        first = page * g_page_size
+        page_results = results[first:first + g_page_size]
+        for plot_id, res, (srcs, src_file) in zip(range(first, first + len(page_results)),
+                                                   page_results, fetch_source_codes(page_results)):
+            item, plot = make_report(plot_id, res, ''.join(srcs), src_file)
+            item.plot_offset = offset
+            item.plot_points = plot.points
+            item.plot_step = plot.step
+            reports.append(item)
+            plots.append(plot)
+            offset += plot.ys.nbytes
+
+        plot_file = pages[page].removesuffix('.html') + '_plots.js'
+        write_plot_file(f'{path}/{plot_file}', plots)
+        with open(f'{path}/{pages[page]}', 'w') as f:
+            f.writelines(template.generate(perf_package = filename,
+                total = len(results), pages = pages, page = page, plot_file = plot_file,
+                reports = reports, **args))
+        print(f'\rRendered page {page + 1}/{len(pages)}', end='')
+    print()
+
+
+def report_env():
+    from jinja2 import Environment, PackageLoader, select_autoescape
+    return Environment(
+        loader=PackageLoader("perflib"),
+        autoescape=select_autoescape()
+    )
 
 
 def generate_report_new(results: list[PerfResult], name, path = '.'):
     """
     Generate HTML report with given `name` under directory `path`,
     from the list of PerfResults.
+    The report is split into pages of `g_page_size` functions, `name.html` being the first page,
+    and plots of each page are stored in `name[_N]_plots.js`.
     Return the number of reports.
     """
     results = dedup_reports(results)
     print(f'Generating report for {len(results)} results...')
-    reports: ReportItemNew = []
-    plots = []
-    to_dump = []
-
-    plot_id = 0
-    for res in results:
-        srcs, src_file = fetch_source_code(res)
-        # print(res.func)
-        ss = ''
-        for s in srcs:
-            ss += s
-        reports.append(ReportItemNew(res.func, res.fid1, res.fid2, ss, src_file, plot_id, res.ratio))
-        plots.append(FuncPlot(plot_id, res.pd1.interval, res.dist1, res.dist2))
-        if g_dump:
-            to_dump.append([res.func, res.fid1, res.fid2, ss, src_file, res.ratio, res.pd1.interval, res.dist1, res.dist2])
-
-        plot_id += 1
 
-    if reports == []:
-        return
+    if results == []:
+        return 0
 
     # filename = Path(reports[0].file).parts[0]
     filename = name
 
-    from jinja2 import Environment, PackageLoader, select_autoescape
-    env = Environment(
-        loader=PackageLoader("perflib"),
-        autoescape=select_autoescape()
-    )
+    env = report_env()
     template = env.get_template('report_new.html')
-    with open(f'{path}/{filename}.html', 'w') as f:
-        print('Rendering report...')
-        f.write(template.render(perf_package = filename,
-            interval = results[0].pd1.interval, buckets = results[0].pd1.buckets,
-            arch1 = results[0].pd1.arch.name, arch2 = results[0].pd2.arch.name,
-            reports = reports, plots = plots))
-    template = env.get_template('report_new_bubble.html')
-    with open(f'{path}/{filename}_bubble.html', 'w') as f:
-        print('Rendering bubble report...')
-        f.write(template.render(perf_package = filename,
-            interval = results[0].pd1.interval, buckets = results[0].pd1.buckets,
-            arch1 = results[0].pd1.arch.name, arch2 = results[0].pd2.arch.name,
-            reports = reports, plots = plots))
+    if g_dump:
+        # vectors are float throughout if compensated or merged from compensated ones
+        fractional = any(isinstance(r.dist1[0], float) or isinstance(r.dist2[0], float) for r in results)
+        dump = ResultsWriter(f'{path}/{name}', len(results),
+                             max(max(len(r.dist1), len(r.dist2)) for r in results),
+                             np.float64 if fractional else np.int64)
+
+    def make_report(plot_id, res, ss, src_file):
+        if g_dump:
+            dump.add(res.func, res.fid1, res.fid2, ss, src_file, res.ratio, res.pd1.interval, res.dist1, res.dist2,
+                     res.pd2.interval)
+        # plot both on the same time grid
+        interval, buckets = common_grid([(res.pd1.interval, len(res.dist1)), (res.pd2.interval, len(res.dist2))])
+        return ReportItemNew(res.func, res.fid1, res.fid2, ss, src_file, plot_id, res.ratio), \
+               FuncPlot(plot_id, interval, rebin(res.dist1, res.pd1.interval, interval, buckets),
+                        rebin(res.dist2, res.pd2.interval, interval, buckets))
+
+    render_pages(template, results, filename, path, make_report,
+        interval = results[0].pd1.interval, buckets = results[0].pd1.buckets,
+        arch1 = results[0].pd1.arch.name, arch2 = results[0].pd2.arch.name,
+        merge_stats = g_merge_stats, self_time = g_self_time, compensate = g_compensate,
+        metric = g_metric_labels.get(g_metric))
+
     print('Rendered.')
     if g_dump:
-        dump_result(to_dump, name, path)
+        dump.close()
     return len(results)
 
 
+def generate_report_star(results: list[PerfResultStar], name, labels: list[str], baseline: int, path = '.'):
+    """
+    Generate one HTML report of several datasets, with a column per dataset,
+    from the list of PerfResultStars.
+    Pages and plots are as in `generate_report_new`.
+    Return the number of reports.
+    """
+    results = dedup_reports(results)
+    print(f'Generating report for {len(results)} results...')
+
+    if results == []:
+        return 0
+
+    def make_report(plot_id, res, ss, src_file):
+        # times and plots on the common grid, as in the analysis
+        interval, buckets = common_grid([(pd.interval, len(d)) for pd, d in zip(res.pds, res.dists)])
+        dists = [rebin(d, pd.interval, interval, buckets) for pd, d in zip(res.pds, res.dists)]
+        times = [(d @ (np.arange(buckets) * interval)).item() for d in dists]
+        return ReportItemStar(res.func, res.fids, ss, src_file, plot_id, res.ratio, res.ratios.tolist(), times), \
+               FuncPlot(plot_id, interval, *dists)
+
+    pds = results[0].pds
+    render_pages(report_env().get_template('report_star.html'), results, name, path, make_report,
+        datasets = [{ 'label': l, 'arch': pd.arch.name, 'interval': pd.interval, 'buckets': pd.buckets }
+                    for l, pd in zip(labels, pds)],
+        baseline = baseline, merge_stats = g_merge_stats, self_time = g_self_time, compensate = g_compensate,
+        metric = g_metric_labels.get(g_metric))
+    print('Rendered.')
+    return len(results)
+
+
+def merge_runs(perf_data_list_list: list[list[PerfData]], labels: list[str]):
+    """
+    Merge repeated runs in each dataset, and record the numbers before and after in `g_merge_stats`.
+    """
+    global g_merge_stats
+    g_merge_stats = []
+    res = []
+    for pds, label in zip(perf_data_list_list, labels):
+        merged = merge_perf_data(pds)
+        print(f'{label}: merged {len(pds)} data files into {len(merged)} testcases')
+        g_merge_stats.append({ 'label': label, 'files': len(pds), 'testcases': len(merged) })
+        res.append(merged)
+    return res
+
+
 def main(dir1: str, dir2: str, name: str, path = '.'):
     dataDir1 = dir1 + "/perf_data"
     dataDir2 = dir2 + "/perf_data"
@@ -181,10 +313,69 @@ def main(dir1: str, dir2: str, name: str, path = '.'):
         pd.dbDir = dbDir2
         pd.srcDir = srcDir2
 
+    if g_metric != 'time':
+        perfDatas1 = [metric_perf_data(pd, g_metric) for pd in perfDatas1]
+        perfDatas2 = [metric_perf_data(pd, g_metric) for pd in perfDatas2]
+    if g_compensate:
+        perfDatas1 = list(map(compensate_overhead, perfDatas1))
+        perfDatas2 = list(map(compensate_overhead, perfDatas2))
+    if g_self_time:
+        perfDatas1 = list(map(self_time_perf_data, perfDatas1))
+        perfDatas2 = list(map(self_time_perf_data, perfDatas2))
+    if g_merge:
+        perfDatas1, perfDatas2 = merge_runs([perfDatas1, perfDatas2], ['架构1', '架构2'])
+
     res, good_res = analyze_all(perfDatas1, perfDatas2)
     return generate_report_new(res, name, path)
 
 
+def main_star(dirs: list[str], name: str, path = '.', baseline: int = 0, jobs: int = None):
+    """
+    Compare several datasets against the `baseline`-th one in one report,
+    each dataset being read once.
+    """
+    def list_one_dir(p: str):
+        dataDir = p + "/perf_data"
+        dbDir   = p + "/debuginfo"
+        srcDir  = p + "/src/"
+
+        checkDir(dataDir)
+        checkDir(dbDir)
+        checkDir(srcDir)
+
+        # name must be aligned with that in perfRT
+        perfDataFiles = [os.path.join(dataDir, x) for x in os.listdir(dataDir) if x.startswith('trec_perf_')]
+        if perfDataFiles == []:
+            print(f"{dataDir} has no data files")
+            exit(0)
+
+        return perfDataFiles, dbDir, srcDir
+
+    if not 0 <= baseline < len(dirs):
+        print(f'Bad baseline {baseline}, must be in [0, {len(dirs)})')
+        exit(-1)
+
+    listed = list(map(list_one_dir, dirs))
+    perf_data_list_list = read_perf_data_lists([files for files, _, _ in listed], jobs)
+    for pds, (_, dbDir, srcDir) in zip(perf_data_list_list, listed):
+        for pd in pds:
+            pd.dbDir = dbDir
+            pd.srcDir = srcDir
+    if g_metric != 'time':
+        perf_data_list_list = [[metric_perf_data(pd, g_metric) for pd in pds] for pds in perf_data_list_list]
+    if g_compensate:
+        perf_data_list_list = [list(map(compensate_overhead, pds)) for pds in perf_data_list_list]
+    if g_self_time:
+        perf_data_list_list = [list(map(self_time_perf_data, pds)) for pds in perf_data_list_list]
+
+    labels = [os.path.basename(os.path.normpath(d)) for d in dirs]
+    if g_merge:
+        perf_data_list_list = merge_runs(perf_data_list_list, labels)
+
+    res, good_res = analyze_all_star(perf_data_list_list, baseline)
+    return generate_report_star(res, name, labels, baseline, path)
+
+
 ###
 ### start of program
 ###
@@ -194,11 +385,24 @@ if __name__ == '__main__':
         description='Analyze program performance across architectures.')
     parser.add_argument('dataDir1', type=str, help='directory of perf data and debuginfo from the 1st archtecture')
     parser.add_argument('dataDir2', type=str, help='directory of perf data and debuginfo from the 2nd archtecture')
+    parser.add_argument('dataDirs', nargs='*', type=str,
+                        help='directories of more archtectures, compared all together in one report')
+    parser.add_argument('-b', '--baseline', type=int,
+                        help='index of the directory the others are compared against in one report, default: 0')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes reading perf data, default: number of CPUs')
     parser.add_argument('-p', '--prefix', type=str, help='path prefix inside OBS environemnt')
     parser.add_argument('-t', '--threshold', type=float, help='bad performance threshold, default: 0.8')
     parser.add_argument('-n', '--name', type=str, help='name of package')
     parser.add_argument('-o', '--output', type=str, help='path to report')
-    parser.add_argument('--dump', action='store_true', help='dump results to yaml for later processing')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge repeated runs of the same testcase by summing their data before analysis')
+    parser.add_argument('--self', action='store_true',
+                        help='compare self time (time minus callees, recorded with TREC_PERF_SELF_TIME=1) instead of time')
+    parser.add_argument('--compensate', action='store_true',
+                        help='take the probe cost (measured with TREC_PERF_CALIBRATE=1) out of the times')
+    parser.add_argument('--metric', type=str, choices=['time', 'cycles', 'instructions'], default='time',
+                        help='metric to compare, cycles and instructions are recorded with TREC_PERF_MODE=multi, default: time')
+    parser.add_argument('--dump', action='store_true', help='dump results of two directories to NAME.results.db and NAME.results.npy for later processing')
 
     args = parser.parse_args()
     if not args.prefix == None:
@@ -214,4 +418,15 @@ if __name__ == '__main__':
     else:
         path = args.output
     g_dump = args.dump
-    main(args.dataDir1, args.dataDir2, name, path)
\ No newline at end of file
+    g_merge = args.merge
+    g_self_time = args.self
+    g_compensate = args.compensate
+    g_metric = args.metric
+    if g_metric != 'time' and (g_self_time or g_compensate):
+        print('--self and --compensate only apply to time')
+        exit(-1)
+    if args.dataDirs != [] or args.baseline is not None:
+        main_star([args.dataDir1, args.dataDir2] + args.dataDirs, name, path,
+                  0 if args.baseline is None else args.baseline, args.jobs)
+    else:
+        main(args.dataDir1, args.dataDir2, name, path)
\ No newline at end of file
@@ -0,0 +1,256 @@
+#! /usr/bin/env python3
+
+####################################################
+#
+#
+# long-lived analysis server that keeps perf data and symbols resident
+#
+# Author: Mao Yifu, maoif@ios.ac.cn
+#
+#
+####################################################
+
+
+
+import os
+import sys
+import json
+import math
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from perflib import *
+
+
+g_jobs = None
+
+
+class Dataset:
+    """
+    Perf data and debuginfo of one directory (with perf_data, debuginfo and src),
+    loaded once and reloaded when any of their files change.
+    """
+    def __init__(self, dir: str):
+        self.dir = dir
+        self.dataDir = dir + "/perf_data"
+        self.dbDir   = dir + "/debuginfo"
+        self.srcDir  = dir + "/src/"
+        self.perf_datas: list[PerfData] = []
+        self.signature = None
+        # symbol -> [time, calls], computed on first top-K query
+        self.totals: dict[str, list[int]] = None
+        self.load()
+
+
+    def scan_signature(self):
+        """
+        (name, size, mtime) of every perf data file and debuginfo database.
+        """
+        sig = []
+        for d, is_ours in [(self.dataDir, lambda x: x.startswith('trec_perf_')),
+                           (self.dbDir,   lambda x: x.endswith('.db'))]:
+            with os.scandir(d) as it:
+                for e in it:
+                    if is_ours(e.name):
+                        st = e.stat()
+                        sig.append((e.path, st.st_size, st.st_mtime_ns))
+        sig.sort()
+        return sig
+
+
+    def load(self):
+        checkDir(self.dataDir)
+        checkDir(self.dbDir)
+        print(f'Loading {self.dir}')
+        self.signature = self.scan_signature()
+        files = [p for p, _, _ in self.signature if p.startswith(self.dataDir)]
+        self.perf_datas = read_perf_data_lists([files], g_jobs)[0]
+        for pd in self.perf_datas:
+            pd.dbDir = self.dbDir
+            pd.srcDir = self.srcDir
+        # symbols may have changed with the databases
+        symtab = g_symbol_tables.pop(self.dbDir, None)
+        if symtab is not None:
+            symtab.close()
+        for pd in self.perf_datas:
+            for fid in pd.rawData.keys():
+                pd.get_symbol_name(fid)
+        self.totals = None
+
+
+    def refresh(self):
+        if self.scan_signature() != self.signature:
+            self.load()
+
+
+    def find(self, cmd: str) -> list[PerfData]:
+        return [pd for pd in self.perf_datas if cmd in str_mod_arch(pd.cmd).replace('\0', ' ')]
+
+
+    def top_k(self, k: int):
+        if self.totals is None:
+            self.totals = {}
+            for pd in self.perf_datas:
+                weights = np.arange(pd.buckets, dtype=np.int64) * pd.interval
+                for fid, vec in pd.rawData.items():
+                    counts = np.asarray(vec)
+                    name = pd.get_symbol_name(fid)
+                    t, c = (counts @ weights).item(), counts.sum().item()
+                    if name in self.totals:
+                        self.totals[name][0] += t
+                        self.totals[name][1] += c
+                    else:
+                        self.totals[name] = [t, c]
+        top = heapq.nlargest(k, self.totals.items(), key=lambda kv: kv[1][0])
+        return [{ 'symbol': name, 'time': t, 'count': c } for name, (t, c) in top]
+
+
+# dir -> Dataset
+g_datasets: dict[str, Dataset] = {}
+g_lock = threading.Lock()
+
+
+def get_dataset(dir: str) -> Dataset:
+    dir = os.path.abspath(dir)
+    if dir not in g_datasets:
+        g_datasets[dir] = Dataset(dir)
+    else:
+        g_datasets[dir].refresh()
+    return g_datasets[dir]
+
+
+def query_compare(q):
+    """
+    Compare the testcases matching `cmd` (all matching testcases if not given) of `dir1` and `dir2`.
+    """
+    ds1 = get_dataset(q['dir1'])
+    ds2 = get_dataset(q['dir2'])
+    cmd = q.get('cmd', '')
+    matches = find_matches(ds1.find(cmd), ds2.find(cmd))
+    res = []
+    for pd1, pd2 in matches:
+        bad, good = analyze_time(pd1, pd2)
+        for r, is_bad in [(r, True) for r in bad] + [(r, False) for r in good]:
+            res.append({ 'cmd': pd1.cmd.replace('\0', ' ').strip(), 'func': r.func,
+                         'fid1': r.fid1, 'fid2': r.fid2, 'ratio': r.ratio, 'bad': is_bad })
+    res.sort(key=lambda r: -math.inf if math.isnan(r['ratio']) else r['ratio'], reverse=True)
+    for r in res:
+        # the ratio is inf or nan if the function took no time on dir1, which JSON cannot hold
+        if not math.isfinite(r['ratio']):
+            r['ratio'] = None
+    return { 'testcases': len(matches), 'results': res }
+
+
+def query_top_k(q):
+    ds = get_dataset(q['dir'])
+    return { 'results': ds.top_k(int(q.get('k', 20))) }
+
+
+def query_hist(q):
+    """
+    Histogram of function `func` summed over the testcases matching `cmd` in `dir`.
+    """
+    ds = get_dataset(q['dir'])
+    func = q['func']
+    hist = None
+    interval = None
+    for pd in ds.find(q.get('cmd', '')):
+        for fid, vec in pd.rawData.items():
+            if pd.get_symbol_name(fid) == func:
+                hist = np.asarray(vec) if hist is None else hist + np.asarray(vec)
+                interval = pd.interval
+    if hist is None:
+        return { 'error': f'{func} not found' }
+    return { 'func': func, 'interval': interval, 'counts': hist.tolist() }
+
+
+def query_report(q):
+    """
+    Regenerate the HTML report of `dir1` vs. `dir2` as `name` under `out`.
+    """
+    import perf_func
+
+    ds1 = get_dataset(q['dir1'])
+    ds2 = get_dataset(q['dir2'])
+    if find_matches(ds1.perf_datas, ds2.perf_datas) == []:
+        return { 'error': 'No match found' }
+    res, good_res = analyze_all(ds1.perf_datas, ds2.perf_datas)
+    n = perf_func.generate_report_new(res, q.get('name', 'unknown_package'), q.get('out', '.'))
+    return { 'reports': n }
+
+
+def query_datasets(q):
+    return { 'datasets': [{ 'dir': d.dir, 'files': len(d.perf_datas) } for d in g_datasets.values()] }
+
+
+# path -> (query, required parameters)
+g_queries = {
+    '/datasets': (query_datasets, []),
+    '/load':     (lambda q: { 'files': len(get_dataset(q['dir']).perf_datas) }, ['dir']),
+    '/compare':  (query_compare, ['dir1', 'dir2']),
+    '/topk':     (query_top_k, ['dir']),
+    '/hist':     (query_hist, ['dir', 'func']),
+    '/report':   (query_report, ['dir1', 'dir2']),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = { k: v[-1] for k, v in parse_qs(url.query).items() }
+        if url.path not in g_queries:
+            self.reply(404, { 'error': f'unknown query {url.path}', 'queries': list(g_queries.keys()) })
+            return
+        query, required = g_queries[url.path]
+        missing = [k for k in required if k not in q]
+        if missing != []:
+            self.reply(400, { 'error': f'missing {", ".join(missing)}' })
+            return
+        try:
+            with g_lock:
+                self.reply(200, query(q))
+        except (Exception, SystemExit) as e:
+            # perflib exit()s on bad input, do not let it kill the server
+            self.reply(500, { 'error': repr(e) })
+
+
+    def reply(self, status, obj):
+        body = json.dumps(obj, allow_nan=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+###
+### start of program
+###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve performance queries over HTTP on localhost, keeping perf data and symbols loaded.')
+    parser.add_argument('dataDirs', nargs='*', type=str, help='directories of perf data and debuginfo to load at start')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on, default: 8765')
+    parser.add_argument('-p', '--prefix', type=str, help='path prefix inside OBS environemnt')
+    parser.add_argument('-t', '--threshold', type=float, help='bad performance threshold, default: 0.8')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes reading perf data, default: number of CPUs')
+
+    args = parser.parse_args()
+    if not args.prefix == None:
+        set_g_obs_prefix(args.prefix)
+    if not args.threshold == None:
+        set_g_bad_threshold(args.threshold)
+    g_jobs = args.jobs
+
+    for d in args.dataDirs:
+        get_dataset(d)
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print(f'Serving on http://127.0.0.1:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -9,18 +9,21 @@
 ####################################################
 
 
-import shutil
 import os
-import subprocess
 from enum import Enum
-import yaml
-import argparse
 import sqlite3
 import struct
+import mmap
+import re
+import heapq
+import sys
+import json
+import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from contextlib import closing
+from collections import OrderedDict
 from pathlib import Path
-import matplotlib.pyplot as plt
-import hashlib
+import numpy as np
 
 
 g_obs_prefix = '/home/abuild/rpmbuild/BUILD/'
@@ -63,6 +66,14 @@ class PerfDataType(Enum):
     TIME_BBL = 4
 
 
+# metric -> (section tag, type of a PerfData with that metric as its vectors)
+# of the hardware counters recorded with TREC_PERF_MODE=multi, aligned with perfRT
+g_metric_sections = {
+    'cycles':       ('CYCL', PerfDataType.CYCLE),
+    'instructions': ('INST', PerfDataType.INSN),
+}
+
+
 class PerfData:
     # dict[fid, list[counts]]
     rawData: dict[int, list[int]]
@@ -74,6 +85,10 @@ class PerfData:
     dbDir: str = None
     srcDir: str = None
     symbol_dict: dict[int, str] = None
+    # records in the file
+    num_records: int = 0
+    # tag -> (offset, size) of the sections of an extended data file
+    sections: dict[str, tuple[int, int]] = None
 
 
     def __init__(self, dataPath: str, cmd: str, exe: str, pwd: str, interval: int):
@@ -92,21 +107,120 @@ class PerfData:
         self.package = None
         self.arch = None
         self.type = None
+        # number of runs merged into this data by `merge_perf_data`
+        self.runs = 1
+        # dict[fid, list[counts]] of self time, recorded with TREC_PERF_SELF_TIME=1
+        self.selfData = {}
+        # per-thread counters recorded with TREC_PERF_THREADS=N:
+        # (tid, name) of each thread index, other threads share the index len(threads)
+        self.threads: list[tuple[int, str]] = []
+        # thread index, fid and counts of each record
+        self.threadIndex: np.ndarray = None
+        self.threadFids: np.ndarray = None
+        self.threadCounts: np.ndarray = None
+        # recorded with TREC_PERF_CALIBRATE=1:
+        # probe cost of a call as seen by its caller, in the unit of the intervals
+        self.probeCost: float = None
+        # dict[fid, (calls, direct callees, all calls below)]
+        self.childCalls: dict[int, tuple[int, int, int]] = {}
+        # recorded with TREC_PERF_MODE=multi:
+        # metric -> dict[fid, list[counts]] for the metrics in g_metric_sections
+        self.metricData: dict[str, dict[int, list[int]]] = {}
+        # dict[fid, (calls, total cycles, total instructions)]
+        self.counterTotals: dict[int, tuple[int, int, int]] = {}
+
+
+    def derive(self, interval: int = None, buckets: int = None, type: PerfDataType = None) -> 'PerfData':
+        """
+        PerfData of the same run without function data, to be filled with vectors derived from this one,
+        on the grid (`interval`, `buckets`) and of `type` if given.
+        """
+        res = PerfData(self.dataPath, self.cmd, self.exe, self.pwd, self.interval if interval is None else interval)
+        res.type = self.type if type is None else type
+        res.mode = self.mode if type is None else type.value
+        res.buckets = self.buckets if buckets is None else buckets
+        res.arch = self.arch
+        res.package = self.package
+        res.dbDir = self.dbDir
+        res.srcDir = self.srcDir
+        res.symbol_dict = self.symbol_dict
+        res.runs = self.runs
+        res.probeCost = self.probeCost
+        return res
+
 
-    
     def addRawData(self, fid, vec):
         """
         Add raw frequency vector for a function and make a dict
         for frequency values > 0.
         """
-        times = {}
-        start = 0
-        for c in vec:
-            if c > 0:
-                times[start] = c
-                start += self.interval
+        counts = np.asarray(vec)
+        counts = counts[counts > 0].tolist()
         self.rawData[fid] = vec
-        self.data[fid] = times
+        self.data[fid] = {i * self.interval: c for i, c in enumerate(counts)}
+
+
+    def check_threads(self):
+        if self.threadCounts is None:
+            print(f'{self.dataPath} has no per-thread counters, record them with TREC_PERF_THREADS=N')
+            exit(-1)
+
+
+    def thread_names(self) -> list[str]:
+        """
+        Name of each thread index, the last one is for the other threads.
+        """
+        return [f'{name} ({tid})' for tid, name in self.threads] + ['other']
+
+
+    def thread_matrix(self, fid) -> np.ndarray:
+        """
+        (threads, buckets) counts of `fid`, a row per thread index.
+        """
+        self.check_threads()
+        res = np.zeros((len(self.threads) + 1, self.buckets), dtype=np.int64)
+        m = self.threadFids == fid
+        res[self.threadIndex[m]] = self.threadCounts[m]
+        return res
+
+
+    def collapse_threads(self) -> dict[int, np.ndarray]:
+        """
+        Counts of each fid summed over threads, i.e., `rawData` rebuilt from per-thread counters.
+        """
+        self.check_threads()
+        fids, inverse = np.unique(self.threadFids, return_inverse=True)
+        totals = np.zeros((len(fids), self.buckets), dtype=np.int64)
+        np.add.at(totals, inverse, self.threadCounts)
+        return dict(zip(fids.tolist(), totals))
+
+
+    def check_metrics(self):
+        if self.metricData == {}:
+            print(f'{self.dataPath} has no hardware counters, record them with TREC_PERF_MODE=multi '
+                  'where perf_event_open() is allowed')
+            exit(-1)
+
+
+    def metric_matrix(self, metric: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        fids and (fids, buckets) counts of `metric`, 'time' or one in `g_metric_sections`.
+        """
+        if metric == 'time':
+            data = self.rawData
+        else:
+            self.check_metrics()
+            data = self.metricData[metric]
+        fids = np.fromiter(data.keys(), dtype=np.uint64, count=len(data))
+        return fids, np.array(list(data.values()), dtype=np.int64).reshape(len(data), self.buckets)
+
+
+    def ipc(self) -> dict[int, float]:
+        """
+        Instructions per cycle of each function over all its calls.
+        """
+        self.check_metrics()
+        return { fid: insns / cycles for fid, (_, cycles, insns) in self.counterTotals.items() if cycles > 0 }
 
 
     def get_symbol_name(self, sid):
@@ -118,27 +232,10 @@ class PerfData:
             return self.symbol_dict[sid]
         elif self.mode == 4:
             # BBL mode
-            dbID, bbid = decodeBBLid(sid)
-            dbName = f"{self.dbDir}/debuginfo{dbID}.db"
-            if dbID < 0:
-                print(f"Less than 0: {dbID}")
-            checkDB(dbName)
-            with closing(sqlite3.connect(dbName)) as connection:
-                with closing(connection.cursor()) as cursor:
-                    rows = cursor.execute("select FID from BBLS where ID=?", (bbid,)).fetchall()
-                    _, funcID, _ = decodeFid(rows[0][0])
-                    rows = cursor.execute("select NAME from FUNCNAMES where ID=?", (funcID,)).fetchall()
-                    return rows[0][0]
+            symtab = get_symbol_table(self.dbDir)
+            return symtab.get_symbol_name(symtab.get_bbl_fid(sid))
         else:
-            dbID, funcID, _ = decodeFid(sid)
-            dbName = f"{self.dbDir}/debuginfo{dbID}.db"
-            if dbID < 0:
-                print(f"Less than 0: {dbID}")
-            checkDB(dbName)
-            with closing(sqlite3.connect(dbName)) as connection:
-                with closing(connection.cursor()) as cursor:
-                    rows = cursor.execute("select NAME from FUNCNAMES where ID=?", (funcID,)).fetchall()
-                    return rows[0][0]
+            return get_symbol_table(self.dbDir).get_symbol_name(sid)
 
 
     def get_bbl_lines(self, bblid):
@@ -146,15 +243,7 @@ class PerfData:
             print(f'get_bbl_lines() is only available in BBL mode.')
             exit(-1)
 
-        dbID, bbid = decodeBBLid(bblid)
-        dbName = f"{self.dbDir}/debuginfo{dbID}.db"
-        if dbID < 0:
-            print(f"Less than 0: {dbID}")
-        checkDB(dbName)
-        with closing(sqlite3.connect(dbName)) as connection:
-            with closing(connection.cursor()) as cursor:
-                rows = cursor.execute("select LINESTART,LINEEND from BBLS where ID=?", (bbid,)).fetchall()
-                return rows[0][0], rows[0][1]
+        return get_symbol_table(self.dbDir).get_bbl_lines(bblid)
 
 
     def get_bbl_fid(self, bblid):
@@ -162,27 +251,11 @@ class PerfData:
             print(f'get_bbl_fid() is only available in BBL mode.')
             exit(-1)
 
-        dbID, bbid = decodeBBLid(bblid)
-        dbName = f"{self.dbDir}/debuginfo{dbID}.db"
-        if dbID < 0:
-            print(f"Less than 0: {dbID}")
-        checkDB(dbName)
-        with closing(sqlite3.connect(dbName)) as connection:
-            with closing(connection.cursor()) as cursor:
-                rows = cursor.execute("select FID from BBLS where ID=?", (bbid,)).fetchall()
-                return rows[0][0]
+        return get_symbol_table(self.dbDir).get_bbl_fid(bblid)
 
 
     def get_file_name(self, fid):
-        dbID, funcID, fileID = decodeFid(fid)
-        dbName = f"{self.dbDir}/debuginfo{dbID}.db"
-        if dbID < 0:
-            print(f"Less than 0: {dbID}")
-        checkDB(dbName)
-        with closing(sqlite3.connect(dbName)) as connection:
-            with closing(connection.cursor()) as cursor:
-                rows = cursor.execute("select NAME from FILENAMES where ID=?", (fileID,)).fetchall()
-                return rows[0][0]
+        return get_symbol_table(self.dbDir).get_file_name(fid)
 
 
 class PerfResult:
@@ -197,110 +270,880 @@ class PerfResult:
         self.ratio = ratio
 
 
-def read_perf_data(data_path: str) -> PerfData:
+# all debuginfo{dbID}.db merged by perf_debuginfo_merge.py
+g_merged_debuginfo = 'debuginfo.db'
+g_debuginfo_shard = re.compile(r'debuginfo(\d+)\.db')
+
+
+def find_merged_debuginfo(db_dir: str):
+    """
+    Path of the merged debuginfo database under `db_dir`,
+    None if there is none or any shard in `db_dir` is not in it or has changed since it was merged.
+    Shards may be deleted once merged.
+    """
+    path = os.path.join(db_dir, g_merged_debuginfo)
+    if not os.path.isfile(path):
+        return None
+    # dbID -> (mtime, size)
+    shards = {}
+    with os.scandir(db_dir) as it:
+        for e in it:
+            m = g_debuginfo_shard.fullmatch(e.name)
+            if m is not None:
+                st = e.stat()
+                shards[int(m.group(1))] = (st.st_mtime_ns, st.st_size)
+    try:
+        with closing(sqlite3.connect(f'file:{path}?mode=ro', uri=True)) as connection:
+            merged = { r[0]: (r[1], r[2]) for r in connection.execute("select DBID,MTIME,SIZE from SHARDS") }
+    except sqlite3.Error:
+        print(f'{path} is not a merged debuginfo database, run perf_debuginfo_merge.py again')
+        return None
+    if any(merged.get(dbID) != st for dbID, st in shards.items()):
+        print(f'{path} is out of date, run perf_debuginfo_merge.py again')
+        return None
+    return path
+
+
+class SymbolTable:
+    """
+    Symbols in the debuginfo databases under `db_dir`.
+    Each debuginfo{dbID}.db, or its part in the merged debuginfo.db if there is an up-to-date one,
+    is read with one query per table on first use, later lookups are served from memory.
+    """
+    def __init__(self, db_dir: str):
+        self.db_dir = db_dir
+        self.merged = find_merged_debuginfo(db_dir)
+        # dbID -> {funcID: name}
+        self.funcnames: dict[int, dict[int, str]] = {}
+        # dbID -> {fileID: name}
+        self.filenames: dict[int, dict[int, str]] = {}
+        # dbID -> {bbid: (fid, linestart, lineend)}
+        self.bblinfo: dict[int, dict[int, tuple[int, int, int]]] = {}
+        self.connection = None
+
+
+    def query_db(self, dbID: int, sql: str):
+        if self.merged is not None:
+            if self.connection is None:
+                self.connection = sqlite3.connect(f'file:{self.merged}?mode=ro', uri=True, check_same_thread=False)
+            return self.connection.execute(sql + " where DBID = ?", (dbID,)).fetchall()
+
+        dbName = f"{self.db_dir}/debuginfo{dbID}.db"
+        if dbID < 0:
+            print(f"Less than 0: {dbID}")
+        checkDB(dbName)
+        with closing(sqlite3.connect(dbName)) as connection:
+            with closing(connection.cursor()) as cursor:
+                return cursor.execute(sql).fetchall()
+
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+    def func_names(self, dbID: int) -> dict[int, str]:
+        if dbID not in self.funcnames:
+            self.funcnames[dbID] = dict(self.query_db(dbID, "select ID,NAME from FUNCNAMES"))
+        return self.funcnames[dbID]
+
+
+    def file_names(self, dbID: int) -> dict[int, str]:
+        if dbID not in self.filenames:
+            self.filenames[dbID] = dict(self.query_db(dbID, "select ID,NAME from FILENAMES"))
+        return self.filenames[dbID]
+
+
+    def bbls(self, dbID: int) -> dict[int, tuple[int, int, int]]:
+        if dbID not in self.bblinfo:
+            rows = self.query_db(dbID, "select ID,FID,LINESTART,LINEEND from BBLS")
+            self.bblinfo[dbID] = { r[0]: (r[1], r[2], r[3]) for r in rows }
+        return self.bblinfo[dbID]
+
+
+    def get_symbol_name(self, fid: int) -> str:
+        dbID, funcID, _ = decodeFid(fid)
+        return self.func_names(dbID)[funcID]
+
+
+    def get_file_name(self, fid: int) -> str:
+        dbID, _, fileID = decodeFid(fid)
+        return self.file_names(dbID)[fileID]
+
+
+    def get_bbl_fid(self, bblid: int) -> int:
+        dbID, bbid = decodeBBLid(bblid)
+        return self.bbls(dbID)[bbid][0]
+
+
+    def get_bbl_lines(self, bblid: int) -> tuple[int, int]:
+        dbID, bbid = decodeBBLid(bblid)
+        _, linestart, lineend = self.bbls(dbID)[bbid]
+        return linestart, lineend
+
+
+    def match_fids(self, fids: np.ndarray, symbol_regex: str, bbl=False) -> np.ndarray:
+        """
+        Return a mask of `fids` (or BBL ids if `bbl`) whose function names match `symbol_regex`.
+        """
+        pattern = re.compile(symbol_regex)
+        if bbl:
+            fids = np.array([self.get_bbl_fid(i) for i in fids.tolist()], dtype=np.uint64)
+        mask = np.zeros(len(fids), dtype=bool)
+        dbIDs   = (fids >> np.uint64(48)) & np.uint64(0xffff)
+        funcIDs = fids & np.uint64(0xffffff)
+        for dbID in np.unique(dbIDs).tolist():
+            matched = [i for i, n in self.func_names(dbID).items() if pattern.search(n)]
+            in_db = dbIDs == dbID
+            mask[in_db] = np.isin(funcIDs[in_db], np.array(matched, dtype=np.uint64))
+        return mask
+
+
+# db_dir -> SymbolTable
+g_symbol_tables: dict[str, SymbolTable] = {}
+
+
+def get_symbol_table(db_dir: str) -> SymbolTable:
+    if db_dir not in g_symbol_tables:
+        g_symbol_tables[db_dir] = SymbolTable(db_dir)
+    return g_symbol_tables[db_dir]
+
+
+# set in the mode byte of extended data files, aligned with perfRT
+g_extended_format = 0x80
+
+
+def read_data_file(data_path: str) -> bytes:
+    """
+    Read a perf data file into memory.
+    perfRT truncates and rewrites it every second, so it is not mapped:
+    touching a mapping of a truncated file raises SIGBUS.
+    """
     with open(data_path, mode='rb') as file:
-        bs = file.read()
-        # cmdline
-        rawCmd = []
-        i = 0
-        while not bs[i] == 3:
-            c = struct.unpack('<c', bs[i:i+1])[0]
-            # note that '\0' exists
-            rawCmd.append(c.decode('utf-8'))
-            i += 1
-        i += 1
-        # exe path
-        rawExe = []
-        while not bs[i] == 3:
-            # print(i)
-            c = struct.unpack('<c', bs[i:i+1])[0]
-            rawExe.append(c.decode('utf-8'))
-            i += 1
-        i += 1
-        # working dir
-        rawPwd = []
-        while not bs[i] == 3:
-            # print(i)
-            c = struct.unpack('<c', bs[i:i+1])[0]
-            rawPwd.append(c.decode('utf-8'))
-            i += 1
-        i += 1
-
-        cmd = "".join(rawCmd)
-        exe = "".join(rawExe)
-        pwd = "".join(rawPwd)
-        # print(f"cmd: {cmd}, exe: {exe}, pwd: {pwd}")
-        # print(f"exeParams: {exeParams}")
-
-        # <: little endian
-        mode   = struct.unpack('<b', bs[i   : i+1])[0]
-        arch   = struct.unpack('<b', bs[i+1 : i+2])[0]
-        length = struct.unpack('<i', bs[i+2 : i+6])[0]
-        interval = struct.unpack('<i', bs[i+6 : i+10])[0]
-        # print(f"mode: {mode}, bucket length: {length}")
-
-        perfData = PerfData(data_path, cmd, exe, pwd, interval)
-        perfData.mode = mode
-        perfData.buckets = length
-        perfData.type = PerfDataType(mode)
-        perfData.arch = PerfArch(arch)
-
-        # read each function's counts
-        len_fid_buckets = (length + 1) * 8
-        num_func  = (len(bs) - (1 + 4)) // len_fid_buckets
-        # print(f"Number of functions: {num_func}")
-
-        # data : fid -> bucket
-        data = {}
-        start = i + 10
-        for i in range(num_func):
-            fid = struct.unpack('<Q', bs[start:start + 8])[0]
-            start += 8
-            vec = []
-            for bucket_i in range(length):
-                vec.append(struct.unpack('<q', bs[start:start + 8])[0])
-                start += 8
-
-            perfData.addRawData(fid, vec)
-        
-        return perfData
+        return file.read()
+
+
+def parse_perf_header(data_path: str, bs) -> tuple[PerfData, int]:
+    """
+    Parse the header of perf data in `bs` into a PerfData without function data.
+    Return the PerfData and the offset of the first record.
+
+    In the extended format (`g_extended_format` set in the mode), the header is followed by
+    the number of records (u32), and the records by sections of
+    4-byte tag, payload size (u64) and payload.
+    """
+    # cmdline, exe path, working dir, delimited by End of Text
+    # note that '\0' exists in cmdline
+    i = bs.find(b'\3')
+    cmd = bs[0:i].decode('utf-8')
+    j = bs.find(b'\3', i + 1)
+    exe = bs[i+1:j].decode('utf-8')
+    i = bs.find(b'\3', j + 1)
+    pwd = bs[j+1:i].decode('utf-8')
+    i += 1
+
+    # <: little endian
+    mode, arch, length, interval = struct.unpack('<Bbii', bs[i:i+10])
+    # print(f"mode: {mode}, bucket length: {length}")
+    start = i + 10
+
+    perfData = PerfData(data_path, cmd, exe, pwd, interval)
+    perfData.mode = mode & ~g_extended_format
+    perfData.buckets = length
+    perfData.type = PerfDataType(perfData.mode)
+    perfData.arch = PerfArch(arch)
+    perfData.sections = {}
+
+    record_size = (length + 1) * 8
+    if mode & g_extended_format:
+        perfData.num_records, = struct.unpack('<I', bs[start:start+4])
+        start += 4
+        i = start + perfData.num_records * record_size
+        while i + 12 <= len(bs):
+            tag = bs[i:i+4].decode('ascii')
+            size, = struct.unpack('<Q', bs[i+4:i+12])
+            perfData.sections[tag] = (i + 12, size)
+            i += 12 + size
+    else:
+        perfData.num_records = (len(bs) - start) // record_size
 
+    return perfData, start
 
-def dump_perf_data(p: str, src_dir:str, db_path: str):
-    d = read_perf_data(p)
+
+def record_matrix(bs, offset: int, count: int, length: int) -> np.ndarray:
+    """
+    `count` records (fid, `length` buckets) at `offset` of `bs` as a (count, length + 1) view.
+    """
+    return np.frombuffer(bs, dtype='<i8', count=count * (length + 1), offset=offset) \
+             .reshape(count, length + 1)
+
+
+def section_records(perfData: PerfData, bs, tag: str):
+    """
+    Records of section `tag`, which are in the same layout as the main ones,
+    or None if the file has no such section.
+    """
+    if tag not in perfData.sections:
+        return None
+    offset, size = perfData.sections[tag]
+    return record_matrix(bs, offset, size // ((perfData.buckets + 1) * 8), perfData.buckets)
+
+
+def read_threads(perfData: PerfData, bs, fids: np.ndarray):
+    """
+    Read the thread table (THRD) and the per-thread counters (TCNT) of `fids` into `perfData`.
+    """
+    # the index of other threads (u32) is followed by (tid, name) of the threads before it
+    offset, size = perfData.sections['THRD']
+    table = np.frombuffer(bs, dtype=[('tid', '<i4'), ('name', 'S16')], count=(size - 4) // 20, offset=offset + 4)
+    perfData.threads = [(tid, name.decode('utf-8', errors='replace')) for tid, name in table.tolist()]
+
+    offset, size = perfData.sections['TCNT']
+    length = perfData.buckets
+    n = size // ((length + 2) * 8)
+    records = np.frombuffer(bs, dtype='<i8', count=n * (length + 2), offset=offset).reshape(n, length + 2)
+    records = records[np.isin(records[:, 1], fids)]
+    # the index of other threads follows the named ones
+    perfData.threadIndex = np.minimum(records[:, 0], len(perfData.threads))
+    perfData.threadFids = records[:, 1].view('<u8')
+    perfData.threadCounts = records[:, 2:]
+
+
+def read_calibration(perfData: PerfData, bs, fids: np.ndarray):
+    """
+    Read the probe cost (CALB) and the calls made by the calls (CHLD) of `fids` into `perfData`.
+    """
+    offset, _ = perfData.sections['CALB']
+    perfData.probeCost, = struct.unpack('<d', bs[offset:offset+8])
+
+    offset, size = perfData.sections['CHLD']
+    records = np.frombuffer(bs, dtype='<i8', count=size // 8, offset=offset).reshape(-1, 4)
+    records = records[np.isin(records[:, 0], fids)]
+    for row in records.tolist():
+        perfData.childCalls[row[0] & 0xffffffffffffffff] = tuple(row[1:])
+
+
+def read_counters(perfData: PerfData, bs, fids: np.ndarray):
+    """
+    Read the histograms (CYCL, INST) and the totals (CSUM) of the hardware counters of `fids` into `perfData`.
+    The sections are empty if perfRT could not open the counters.
+    """
+    offset, size = perfData.sections['CSUM']
+    if size == 0:
+        return
+    totals = np.frombuffer(bs, dtype='<i8', count=size // 8, offset=offset).reshape(-1, 4)
+    totals = totals[np.isin(totals[:, 0], fids)]
+    for row in totals.tolist():
+        perfData.counterTotals[row[0] & 0xffffffffffffffff] = tuple(row[1:])
+    for metric, (tag, _) in g_metric_sections.items():
+        records = section_records(perfData, bs, tag)
+        records = records[np.isin(records[:, 0], fids)]
+        perfData.metricData[metric] = { int(row[0].view(np.uint64)): row[1:].tolist() for row in records }
+
+
+def read_perf_data(data_path: str, fids = None, symbol_regex: str = None, db_dir: str = None) -> PerfData:
+    """
+    Read a perf data file.
+    By default all functions are loaded.
+    If `fids` (an iterable of fids, or BBL ids in BBL mode) and/or `symbol_regex` are given,
+    only the records of matching functions are loaded.
+    Resolving `symbol_regex` needs the debuginfo dir `db_dir`.
+    Records have a fixed size, so only the fid column is scanned to select records.
+    """
+    if symbol_regex is not None and db_dir is None:
+        print('read_perf_data: symbol_regex requires db_dir')
+        exit(-1)
+
+    bs = read_data_file(data_path)
+    perfData, start = parse_perf_header(data_path, bs)
+    mode = perfData.mode
+    length = perfData.buckets
+
+    # each record: fid, buckets
+    num_func = perfData.num_records
+    # print(f"Number of functions: {num_func}")
+
+    records = record_matrix(bs, start, num_func, length)
+    # only the fid column is scanned
+    all_fids = records[:, 0].view('<u8')
+    mask = np.ones(num_func, dtype=bool)
+    if fids is not None:
+        mask &= np.isin(all_fids, np.fromiter(fids, dtype=np.uint64))
+    if symbol_regex is not None:
+        mask &= get_symbol_table(db_dir).match_fids(all_fids, symbol_regex, mode == 4)
+
+    selected = records[mask] if not mask.all() else records.copy()
+    self_records = section_records(perfData, bs, 'SELF')
+    if self_records is not None:
+        self_records = self_records[np.isin(self_records[:, 0], selected[:, 0])]
+    if 'THRD' in perfData.sections:
+        read_threads(perfData, bs, selected[:, 0])
+    if 'CALB' in perfData.sections:
+        read_calibration(perfData, bs, selected[:, 0])
+    if 'CSUM' in perfData.sections:
+        read_counters(perfData, bs, selected[:, 0])
+
+    for row in selected:
+        perfData.addRawData(int(row[0].view(np.uint64)), row[1:].tolist())
+    if self_records is not None:
+        for row in self_records:
+            perfData.selfData[int(row[0].view(np.uint64))] = row[1:].tolist()
+
+    return perfData
+
+
+def read_perf_data_lists(path_lists: list[list[str]], jobs: int = None) -> list[list[PerfData]]:
+    """
+    Read several lists of perf data files concurrently.
+    Parsing is CPU-bound, so files are read on a process pool with `jobs` workers
+    (default: number of CPUs); `jobs=1` reads serially in this process.
+    The result has the same shape and order as `path_lists`, i.e., it is identical to
+    `[list(map(read_perf_data, ps)) for ps in path_lists]`.
+    """
+    paths = [p for ps in path_lists for p in ps]
+    total = len(paths)
+    pds: list[PerfData] = [None] * total
+
+    def report(done):
+        print(f'\rRead {done}/{total} data files', end='', flush=True)
+
+    if jobs == 1 or total <= 1:
+        for i, p in enumerate(paths):
+            pds[i] = read_perf_data(p)
+            report(i + 1)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(read_perf_data, p): i for i, p in enumerate(paths)}
+            done = 0
+            for fut in as_completed(futures):
+                pds[futures[fut]] = fut.result()
+                done += 1
+                report(done)
+    if total > 0:
+        print()
+
+    res = []
+    start = 0
+    for ps in path_lists:
+        res.append(pds[start:start + len(ps)])
+        start += len(ps)
+
+    return res
+
+
+def scan_weighted_times(data_path: str):
+    """
+    Compute the weighted time (sum of bucket left edge * count) and call count of
+    every record of a perf data file without loading the records.
+    Return the header-only PerfData, fids, times and calls.
+    """
+    bs = read_data_file(data_path)
+    perfData, start = parse_perf_header(data_path, bs)
+    length = perfData.buckets
+    records = record_matrix(bs, start, perfData.num_records, length)
+    fids  = records[:, 0].view('<u8').copy()
+    times = records[:, 1:] @ (np.arange(length, dtype=np.int64) * perfData.interval)
+    calls = records[:, 1:].sum(axis=1)
+
+    return perfData, fids, times, calls
+
+
+def symbol_totals(data_files: list[str], db_dir: str, jobs: int = None, modes = None) -> dict[str, list[int]]:
+    """
+    Sum the weighted time and call count of `data_files` by symbol name,
+    skipping files whose mode is not in `modes` (if given).
+    Files are scanned one at a time (on a process pool of `jobs` workers unless `jobs` is 1),
+    so memory only depends on the number of distinct symbols, not on the number of files.
+    Return {symbol: [time, calls]}.
+    """
+    symtab = get_symbol_table(db_dir)
+    # symbol -> [time, calls]
+    totals: dict[str, list[int]] = {}
+
+    def add(scanned):
+        pd, fids, times, calls = scanned
+        if modes is not None and pd.mode not in modes:
+            return
+        for fid, t, c in zip(fids.tolist(), times.tolist(), calls.tolist()):
+            if pd.mode == 4:
+                fid = symtab.get_bbl_fid(fid)
+            name = symtab.get_symbol_name(fid)
+            if name in totals:
+                totals[name][0] += t
+                totals[name][1] += c
+            else:
+                totals[name] = [t, c]
+
+    if jobs == 1:
+        for p in data_files:
+            add(scan_weighted_times(p))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for scanned in executor.map(scan_weighted_times, data_files):
+                add(scanned)
+
+    return totals
+
+
+def top_k_functions(data_files: list[str], db_dir: str, k: int, jobs: int = None) -> list[tuple[str, int, int]]:
+    """
+    Find the `k` functions with the most weighted time in `data_files`,
+    aggregated by symbol name.
+    Return a list of (symbol, time, calls), the most time-consuming first.
+    """
+    totals = symbol_totals(data_files, db_dir, jobs)
+    top = heapq.nlargest(k, totals.items(), key=lambda kv: kv[1][0])
+    return [(name, t, c) for name, (t, c) in top]
+
+
+def dump_top_k(data_dir: str, db_path: str, k: int, jobs: int = None):
+    # name must be aligned with that in perfRT
+    files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.startswith('trec_perf_')]
+    print(f'dir:   {data_dir}')
+    print(f'files: {len(files)}')
+    print(f'top {k} functions by weighted time:')
+    print(f'\t{'#':<5} {'time':<20} {'count':<12} symbol')
+    for i, (name, t, c) in enumerate(top_k_functions(files, db_path, k, jobs)):
+        print(f'\t{i:<5} {t:<20} {c:<12} {name}')
+
+
+def cheap_hot_functions(data_files: list[str], db_dir: str, min_calls: int, max_mean: float,
+                        jobs: int = None) -> list[tuple[str, int, float]]:
+    """
+    Functions called at least `min_calls` times in `data_files` with a mean time of at most `max_mean` ns,
+    whose probes likely cost more than their bodies. Only time mode data is used.
+    The mean is taken at the left edges of the buckets, so it is 0 if all calls fall in the first one.
+    Return a list of (symbol, calls, mean), the most called first.
+    """
+    totals = symbol_totals(data_files, db_dir, jobs, modes=[0])
+    res = [(name, c, t / c) for name, (t, c) in totals.items() if c >= min_calls and t <= max_mean * c]
+    res.sort(key=lambda x: x[1], reverse=True)
+    return res
+
+
+def never_regressed_functions(perfDatas1: list[PerfData], perfDatas2: list[PerfData]) -> list[str]:
+    """
+    Functions compared in the matching testcases of `perfDatas1` and `perfDatas2`
+    and never found bad in any of them, empty if no testcase matches.
+    """
+    if find_matches(perfDatas1, perfDatas2) == []:
+        print('Warning: no matching testcase to compare, no function is denied for never regressing')
+        return []
+    bad, good = analyze_all(perfDatas1, perfDatas2)
+    return sorted({r.func for r in good} - {r.func for r in bad})
+
+
+def write_instr_filter(path: str, entries: list[tuple[str, str]], header: str = ''):
+    """
+    Write (symbol, reason) `entries` as denied names of an instrumentation filter,
+    the file that `TREC_PERF_FILTER` names when building with PerfInstrPass.
+    """
+    with open(path, 'w') as f:
+        f.write('# instrumentation filter, lines are `allow|deny name|fid VALUE`\n')
+        if header != '':
+            f.write(f'# {header}\n')
+        for name, reason in entries:
+            f.write(f'\n# {reason}\ndeny name {name}\n')
+
+
+# an edge of the CGRF section, aligned with CallEdge in perfRT
+g_call_edge_dtype = np.dtype([('caller', '<u8'), ('callee', '<u8'), ('count', '<i8'), ('time', '<i8')])
+
+
+def read_call_graph(data_paths: list[str]) -> np.ndarray:
+    """
+    Call graph edges of perf data files recorded with TREC_PERF_CALL_GRAPH=1,
+    summed over the files and sorted by (caller, callee).
+    The caller of calls at the bottom of a stack is 0.
+    Return an array of `g_call_edge_dtype`.
+    """
+    parts = []
+    for p in data_paths:
+        bs = read_data_file(p)
+        perfData, _ = parse_perf_header(p, bs)
+        if 'CGRF' not in perfData.sections:
+            print(f'{p} has no call graph, record it with TREC_PERF_CALL_GRAPH=1')
+            continue
+        offset, size = perfData.sections['CGRF']
+        parts.append(np.frombuffer(bs, dtype=g_call_edge_dtype, count=size // g_call_edge_dtype.itemsize,
+                                   offset=offset))
+    if parts == []:
+        return np.zeros(0, dtype=g_call_edge_dtype)
+
+    edges = np.concatenate(parts)
+    order = np.lexsort((edges['callee'], edges['caller']))
+    edges = edges[order]
+    first = np.ones(len(edges), dtype=bool)
+    first[1:] = (edges['caller'][1:] != edges['caller'][:-1]) | (edges['callee'][1:] != edges['callee'][:-1])
+    starts = np.flatnonzero(first)
+    res = edges[starts]
+    res['count'] = np.add.reduceat(edges['count'], starts)
+    res['time']  = np.add.reduceat(edges['time'], starts)
+    return res
+
+
+def walk_call_graph(edges: np.ndarray, min_fraction: float = 1e-4, max_depth: int = 64):
+    """
+    Expand call graph `edges` into a call tree from the bottom of the stacks, depth first,
+    yielding (depth, fid, time, self time) of each node before its children.
+
+    Edges only know the direct caller, so the time of a function is split among the paths
+    reaching it in proportion to their time. Recursive calls, subtrees below `min_fraction`
+    of the total time and nodes deeper than `max_depth` are left in the self time of their parents.
+    Only the adjacency of the graph is kept in memory, not the tree.
+    """
+    if len(edges) == 0:
+        return
+    # edges are sorted by caller
+    callers, starts = np.unique(edges['caller'], return_index=True)
+    ends = np.append(starts[1:], len(edges))
+    children = { c: (edges['callee'][s:e].tolist(), edges['time'][s:e].tolist())
+                 for c, s, e in zip(callers.tolist(), starts.tolist(), ends.tolist()) }
+    # time of all calls of each function
+    callees, inverse = np.unique(edges['callee'], return_inverse=True)
+    incoming = dict(zip(callees.tolist(), np.bincount(inverse, weights=edges['time']).tolist()))
+
+    roots, root_times = children.get(0, ([], []))
+    min_time = min_fraction * sum(root_times)
+    # fids from the root to the current node
+    path = []
+    for root, root_time in zip(roots, root_times):
+        if root_time < min_time:
+            continue
+        todo = [(0, root, float(root_time))]
+        while todo != []:
+            depth, fid, t = todo.pop()
+            del path[depth:]
+            kids = []
+            if depth < max_depth and fid in children:
+                scale = t / incoming[fid] if incoming[fid] > 0 else 0.0
+                for c, ct in zip(*children[fid]):
+                    ct *= scale
+                    if ct >= min_time and c != fid and c not in path:
+                        kids.append((depth + 1, c, ct))
+            yield depth, fid, t, max(t - sum(ct for _, _, ct in kids), 0.0)
+            path.append(fid)
+            todo.extend(reversed(kids))
+
+
+def write_collapsed_stacks(edges: np.ndarray, symbol_name, f, **walk_args):
+    """
+    Write `edges` to file `f` as collapsed stacks (`a;b;c self_time` per line),
+    the input of flamegraph.pl and most flame graph tools.
+    `symbol_name` maps a fid to its name.
+    """
+    names = {}
+    # stack of each depth so far
+    stacks = []
+    for depth, fid, t, self_time in walk_call_graph(edges, **walk_args):
+        if fid not in names:
+            names[fid] = symbol_name(fid).replace(';', ':')
+        del stacks[depth:]
+        stacks.append(f'{stacks[-1]};{names[fid]}' if depth > 0 else names[fid])
+        if round(self_time) > 0:
+            f.write(f'{stacks[-1]} {round(self_time)}\n')
+
+
+def write_speedscope(edges: np.ndarray, symbol_name, f, name: str = '', unit: str = 'nanoseconds', **walk_args):
+    """
+    Write `edges` to file `f` as an evented profile of speedscope (https://www.speedscope.app),
+    events are written while walking the call tree.
+    `symbol_name` maps a fid to its name.
+    """
+    fids = np.unique(edges['callee']).tolist()
+    frame_index = {fid: i for i, fid in enumerate(fids)}
+    f.write('{"$schema":"https://www.speedscope.app/file-format-schema.json","shared":{"frames":[')
+    f.write(','.join(json.dumps({ 'name': symbol_name(fid) }) for fid in fids))
+    f.write(f']}},"profiles":[{{"type":"evented","name":{json.dumps(name)},"unit":"{unit}","startValue":0,"events":[')
+
+    # (frame, end) of open nodes
+    opened = []
+    cursor = 0.0
+    sep = ''
+
+    def close(depth):
+        nonlocal cursor
+        while len(opened) > depth:
+            fid, end = opened.pop()
+            f.write(f'{sep}{{"type":"C","frame":{frame_index[fid]},"at":{end}}}')
+            cursor = end
+
+    for depth, fid, t, _ in walk_call_graph(edges, **walk_args):
+        close(depth)
+        f.write(f'{sep}{{"type":"O","frame":{frame_index[fid]},"at":{cursor}}}')
+        sep = ','
+        opened.append((fid, cursor + t))
+    close(0)
+    f.write(f'],"endValue":{cursor}}}]}}\n')
+
+
+# a change of an epoch, aligned with closeEpoch() in perfRT
+g_epoch_change_dtype = np.dtype([('fid', '<u8'), ('bucket', '<u4'), ('count', '<u4')])
+
+
+class PerfEpochs:
+    """
+    Histograms of each flush interval (epoch) of a run recorded with TREC_PERF_EPOCHS=1,
+    as a sparse (epochs, fids, buckets) array in coordinate format:
+    `counts[k]` calls fell in bucket `bucket[k]` of `fids[fid[k]]` during epoch `epoch[k]`.
+    Epochs are in time order, only changed buckets are stored.
+    """
+    def __init__(self, pd: PerfData, times: np.ndarray, changes: np.ndarray, epoch: np.ndarray):
+        self.pd = pd
+        # end of each epoch, ns since the Epoch
+        self.times = times
+        self.fids, self.fid = np.unique(changes['fid'], return_inverse=True)
+        self.bucket = changes['bucket'].astype(np.int64)
+        self.counts = changes['count'].astype(np.int64)
+        self.epoch = epoch
+        self.shape = (len(times), len(self.fids), pd.buckets)
+
+
+    def dense(self, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        The dense (epochs, fids, buckets) array of epochs [`start`, `end`).
+        """
+        end = self.shape[0] if end is None else end
+        res = np.zeros((end - start, self.shape[1], self.shape[2]), dtype=np.int64)
+        m = (self.epoch >= start) & (self.epoch < end)
+        np.add.at(res, (self.epoch[m] - start, self.fid[m], self.bucket[m]), self.counts[m])
+        return res
+
+
+    def window(self, start: int = 0, end: int = None) -> PerfData:
+        """
+        PerfData of the calls during epochs [`start`, `end`) only, e.g., without warm-up and teardown,
+        to be compared like whole runs.
+        """
+        end = self.shape[0] if end is None else end
+        m = (self.epoch >= start) & (self.epoch < end)
+        hists = np.zeros((self.shape[1], self.shape[2]), dtype=np.int64)
+        np.add.at(hists, (self.fid[m], self.bucket[m]), self.counts[m])
+
+        pd = self.pd
+        res = pd.derive()
+        called = hists.any(axis=1)
+        for fid, row in zip(self.fids[called].tolist(), hists[called].tolist()):
+            res.addRawData(fid, row)
+        return res
+
+
+def _parse_epochs(bs, offset: int, end: int) -> tuple[list[int], list[np.ndarray]]:
+    times = []
+    parts = []
+    i = offset
+    while i + 12 <= end:
+        t, n = struct.unpack('<QI', bs[i:i+12])
+        if i + 12 + n * g_epoch_change_dtype.itemsize > end:
+            # being appended
+            break
+        times.append(t)
+        parts.append(np.frombuffer(bs, dtype=g_epoch_change_dtype, count=n, offset=i + 12).copy())
+        i += 12 + n * g_epoch_change_dtype.itemsize
+    return times, parts
+
+
+def read_epochs(data_path: str) -> PerfEpochs:
+    """
+    Read the epochs of a perf data file recorded with TREC_PERF_EPOCHS=1
+    from trec_epoch_comm_pid.bin next to it, None if it has none.
+    """
+    base = os.path.basename(data_path)
+    if not base.startswith('trec_perf_'):
+        return None
+    epoch_path = os.path.join(os.path.dirname(data_path), 'trec_epoch_' + base[len('trec_perf_'):])
+    if not os.path.exists(epoch_path) or os.path.getsize(epoch_path) == 0:
+        return None
+    perfData, _ = parse_perf_header(data_path, read_data_file(data_path))
+    # only appended to, so it can be mapped
+    with open(epoch_path, mode='rb') as file, \
+         mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as bs:
+        times, parts = _parse_epochs(bs, 0, len(bs))
+
+    changes = np.concatenate(parts) if parts != [] else np.zeros(0, dtype=g_epoch_change_dtype)
+    epoch = np.repeat(np.arange(len(parts)), [len(c) for c in parts])
+    return PerfEpochs(perfData, np.array(times, dtype=np.int64), changes, epoch)
+
+
+# name must be aligned with that in perfRT: trec_snap_comm_pid_time.bin
+g_snapshot_name = re.compile(r'trec_snap_(.*)_(\d+)_(\d+)\.bin')
+
+
+def list_snapshots(data_dir: str, pid: int = None) -> list[tuple[int, int, str]]:
+    """
+    (pid, time in ns since the epoch, path) of the snapshots taken with TREC_PERF_SNAPSHOT=1 in `data_dir`,
+    only those of process `pid` if given, in time order.
+    """
+    res = []
+    for name in os.listdir(data_dir):
+        m = g_snapshot_name.fullmatch(name)
+        if m is not None and (pid is None or int(m.group(2)) == pid):
+            res.append((int(m.group(2)), int(m.group(3)), os.path.join(data_dir, name)))
+    return sorted(res, key=lambda s: (s[1], s[0]))
+
+
+def diff_counts(after: dict, before: dict) -> dict:
+    """
+    Counts of `after` minus those of `before` for each key of `after`, keys without new counts are dropped.
+    """
+    res = {}
+    for k, vec in after.items():
+        d = np.subtract(vec, before[k]) if k in before else np.asarray(vec)
+        if np.any(d > 0):
+            res[k] = d.tolist()
+    return res
+
+
+def diff_snapshots(before: PerfData, after: PerfData) -> PerfData:
+    """
+    PerfData of the calls between two snapshots of a process, e.g., during a load test only,
+    to be compared like whole runs.
+    Functions are kept only if they are called in between.
+    """
+    if (before.cmd, before.exe, before.mode, before.interval, before.buckets) != \
+       (after.cmd, after.exe, after.mode, after.interval, after.buckets):
+        print(f'{before.dataPath} and {after.dataPath} are not snapshots of the same program')
+        exit(-1)
+
+    res = after.derive()
+    for fid, vec in diff_counts(after.rawData, before.rawData).items():
+        res.addRawData(fid, vec)
+    res.selfData = diff_counts(after.selfData, before.selfData)
+    res.probeCost = after.probeCost
+    res.childCalls = { fid: tuple(c) for fid, c in diff_counts(after.childCalls, before.childCalls).items() }
+    res.metricData = { metric: diff_counts(data, before.metricData.get(metric, {}))
+                       for metric, data in after.metricData.items() }
+    res.counterTotals = { fid: tuple(c) for fid, c in diff_counts(after.counterTotals, before.counterTotals).items() }
+    if after.threadCounts is not None:
+        def thread_counts(pd):
+            if pd.threadCounts is None:
+                return {}
+            return dict(zip(zip(pd.threadIndex.tolist(), pd.threadFids.tolist()), pd.threadCounts))
+        d = diff_counts(thread_counts(after), thread_counts(before))
+        res.threads = after.threads
+        res.threadIndex = np.array([i for i, _ in d], dtype=np.int64)
+        res.threadFids = np.array([fid for _, fid in d], dtype=np.uint64)
+        res.threadCounts = np.array(list(d.values()), dtype=np.int64).reshape(len(d), after.buckets)
+    return res
+
+
+g_mode_names = {
+    0: 'time',
+    1: 'cycle',
+    2: 'instruction',
+    3: 'perf command',
+    4: 'time bbl',
+}
+
+
+def dump_perf_data(p: str, src_dir:str, db_path: str, fmt = 'text', sort = None, top = None,
+                   mode = None, fids = None, symbol_regex = None, output = None):
+    """
+    Dump the count, weighted time and symbol of each record in perf data file `p`.
+    `fmt` is one of text, jsonl, csv or bin (NumPy .npz, requires `output`).
+    Records can be filtered by `fids` and `symbol_regex`, sorted by `sort`
+    (fid, count, time or name; time is descending) and cut to the first `top` ones.
+    If `mode` is given, nothing is dumped unless the file is in that mode.
+    Symbols are resolved with one query per debuginfo database.
+    """
+    d, all_fids, times, counts = scan_weighted_times(p)
     d.srcDir = src_dir
     d.dbDir = db_path
 
-    print(f'file: {p}')
-    print(f'cmd:  {d.cmd}')
-    print(f'exe:  {d.exe}')
-    print(f'pwd:  {d.pwd}')
-    if d.mode == 0:
-        print('mode: time')
-    elif d.mode == 1:
-        print('mode: cycle')
-    elif d.mode == 2:
-        print('mode: instruction')
-    elif d.mode == 3:
-        print('mode: perf command')
-    elif d.mode == 4:
-        print('mode: time bbl')
-    else:
-        print('invalid mode: ' + d.mode)
+    if d.mode not in g_mode_names:
+        print(f'invalid mode: {d.mode}')
         exit(-1)
-    print(f'interval: {d.interval}ns')
-    print(f'#buckets: {d.buckets}')
-    print('Data:')
-    print(f'\tentries: {len(d.data.keys())}')
-    if d.type == PerfDataType.TIME:
-        print(f'\t{'id':<30} {'count':<10} symbol')
-        for fid, times in d.data.items():
-            print(f'\t{fid:<30} {sum(times.values()):<10} {d.get_symbol_name(fid)}')
-    elif d.type == PerfDataType.TIME_BBL:
-        print(f'\t{'bblid':<30} {'fid':<30} {'count':<10} symbol')
-        for bblid, times in d.data.items():
-            fid = d.get_bbl_fid(bblid)
-            print(f'\t{bblid:<30} {fid:<30} {sum(times.values()):<10} {d.get_symbol_name(bblid)}')
+    if mode is not None and g_mode_names[d.mode] != mode:
+        print(f'{p} is in mode {g_mode_names[d.mode]}, skipped')
+        return
+
+    symtab = get_symbol_table(db_path)
+    is_bbl = d.type == PerfDataType.TIME_BBL
+
+    mask = np.ones(len(all_fids), dtype=bool)
+    if fids is not None:
+        mask &= np.isin(all_fids, np.array(list(fids), dtype=np.uint64))
+    if symbol_regex is not None:
+        mask &= symtab.match_fids(all_fids, symbol_regex, is_bbl)
+    ids, times, counts = all_fids[mask], times[mask], counts[mask]
+
+    if is_bbl:
+        func_fids = [symtab.get_bbl_fid(i) for i in ids.tolist()]
+    else:
+        func_fids = ids.tolist()
+    names = [symtab.get_symbol_name(f) for f in func_fids]
+
+    if sort is None and top is not None:
+        sort = 'time'
+    if sort is not None:
+        if sort == 'fid':
+            order = np.argsort(ids, kind='stable')
+        elif sort == 'count':
+            order = np.argsort(-counts, kind='stable')
+        elif sort == 'time':
+            order = np.argsort(-times, kind='stable')
+        else:
+            order = np.array(sorted(range(len(names)), key=lambda i: names[i]), dtype=np.int64)
+    else:
+        order = np.arange(len(ids))
+    if top is not None:
+        order = order[:top]
+
+    ids, times, counts = ids[order], times[order], counts[order]
+    func_fids = [func_fids[i] for i in order.tolist()]
+    names = [names[i] for i in order.tolist()]
+
+    if fmt == 'bin':
+        if output is None:
+            print('binary output requires an output file')
+            exit(-1)
+        np.savez(output, ids = ids, fids = np.array(func_fids, dtype=np.uint64),
+                 counts = counts, times = times, symbols = np.array(names, dtype=str))
+        return
+
+    # buffered writer, flushed once at the end
+    f = open(output, 'w', buffering=1 << 20) if output is not None else sys.stdout
+    lines = []
+    if fmt == 'text':
+        lines.append(f'file: {p}\n')
+        lines.append(f'cmd:  {d.cmd}\n')
+        lines.append(f'exe:  {d.exe}\n')
+        lines.append(f'pwd:  {d.pwd}\n')
+        lines.append(f'mode: {g_mode_names[d.mode]}\n')
+        lines.append(f'interval: {d.interval}ns\n')
+        lines.append(f'#buckets: {d.buckets}\n')
+        lines.append('Data:\n')
+        lines.append(f'\tentries: {len(ids)}\n')
+        if is_bbl:
+            lines.append(f'\t{'bblid':<30} {'fid':<30} {'count':<10} symbol\n')
+            for bblid, fid, c, n in zip(ids.tolist(), func_fids, counts.tolist(), names):
+                lines.append(f'\t{bblid:<30} {fid:<30} {c:<10} {n}\n')
+        else:
+            lines.append(f'\t{'id':<30} {'count':<10} symbol\n')
+            for fid, c, n in zip(ids.tolist(), counts.tolist(), names):
+                lines.append(f'\t{fid:<30} {c:<10} {n}\n')
+        f.writelines(lines)
+    elif fmt == 'jsonl':
+        for i, fid, c, t, n in zip(ids.tolist(), func_fids, counts.tolist(), times.tolist(), names):
+            rec = { 'fid': fid, 'count': c, 'time': t, 'symbol': n }
+            if is_bbl:
+                rec['bblid'] = i
+            lines.append(json.dumps(rec) + '\n')
+        f.writelines(lines)
+    elif fmt == 'csv':
+        writer = csv.writer(f)
+        if is_bbl:
+            writer.writerow(['bblid', 'fid', 'count', 'time', 'symbol'])
+            writer.writerows(zip(ids.tolist(), func_fids, counts.tolist(), times.tolist(), names))
+        else:
+            writer.writerow(['fid', 'count', 'time', 'symbol'])
+            writer.writerows(zip(func_fids, counts.tolist(), times.tolist(), names))
+
+    if output is not None:
+        f.close()
+    else:
+        f.flush()
 
 
 def decodeFid(fid):
@@ -433,10 +1276,42 @@ def find_matches_star(perf_data_list_list: list[list[PerfData]]):
     return matches
 
 
-import numpy as np
-from scipy.stats import ttest_ind, mannwhitneyu, ks_2samp, chisquare
-from sklearn import preprocessing
-from scipy import stats
+def merge_perf_data(perf_datas: list[PerfData]) -> list[PerfData]:
+    """
+    Merge repeated runs of the same testcase, i.e., perf data with the same cmd (without arch strings),
+    interval, bucket count and mode, into one PerfData whose vectors are the sums of theirs.
+    Perf data of mode 3 (perf) are not merged since their ids are local to each file.
+    The order of the first run of each testcase is kept.
+    """
+    groups: dict[tuple, list[PerfData]] = {}
+    for pd in perf_datas:
+        key = (str_mod_arch(pd.cmd), pd.interval, pd.buckets, pd.mode)
+        if pd.mode == 3:
+            key = (pd.dataPath,)
+        groups.setdefault(key, []).append(pd)
+
+    res: list[PerfData] = []
+    for group in groups.values():
+        if len(group) == 1:
+            res.append(group[0])
+            continue
+
+        first = group[0]
+        group_fids = [np.fromiter(pd.rawData.keys(), dtype=np.uint64, count=len(pd.rawData)) for pd in group]
+        fids = np.unique(np.concatenate(group_fids))
+        # float if any of them is, e.g., compensated
+        group_rows = [np.array(list(pd.rawData.values())).reshape(-1, first.buckets) for pd in group]
+        sums = np.zeros((len(fids), first.buckets), dtype=np.result_type(np.int64, *group_rows))
+        for rows, pd_fids in zip(group_rows, group_fids):
+            sums[np.searchsorted(fids, pd_fids)] += rows
+
+        merged = first.derive()
+        merged.runs = sum(pd.runs for pd in group)
+        for fid, row in zip(fids.tolist(), sums.tolist()):
+            merged.addRawData(fid, row)
+        res.append(merged)
+
+    return res
 
 
 def normalize(arr1):
@@ -453,6 +1328,8 @@ def prepare_data(data):
 
 
 def analyze_data(d1, d2):
+    from scipy.stats import ks_2samp
+
     d1 = prepare_data(d1)
     d2 = prepare_data(d2)
 
@@ -469,6 +1346,8 @@ def analyze_data(d1, d2):
 
 
 def analyze(pd1: PerfData, pd2: PerfData) -> list[PerfResult]:
+    from scipy.stats import ks_2samp
+
     # print('cmd:', pd1.cmd)
     pd1_data = {}
     pd2_data = {}
@@ -532,15 +1411,176 @@ def analyze(pd1: PerfData, pd2: PerfData) -> list[PerfResult]:
     return results, good_ones
 
 
+def common_grid(grids: list[tuple[int, int]]) -> tuple[int, int]:
+    """
+    The grid, (interval, buckets), onto which histograms of all `grids` are rebinned for comparison:
+    the coarsest interval, and enough buckets to cover the longest of them.
+    """
+    interval = max(i for i, _ in grids)
+    span = max(i * b for i, b in grids)
+    return interval, -(-span // interval)
+
+
+def rebin(hist, interval: int, new_interval: int, new_buckets: int) -> np.ndarray:
+    """
+    Map histograms, the rows of `hist` with buckets [k*interval, (k+1)*interval),
+    onto `new_buckets` buckets of `new_interval`.
+    Counts of a bucket are taken as spread evenly over it, so that the counts are preserved;
+    the last bucket of both is the overflow bucket that takes all longer times,
+    the overflow bucket of `hist` is added to the new one as a whole.
+    When `new_interval` is a multiple of `interval` buckets are summed exactly as integers,
+    otherwise the result is float.
+    """
+    hist = np.asarray(hist)
+    n = hist.shape[-1]
+    if interval == new_interval and n == new_buckets:
+        return hist
+
+    # only the finite buckets [0, (n-1)*interval) are spread, the overflow bucket of `hist`
+    # goes to the new overflow bucket as it has no upper edge
+    m = n - 1
+    cum = np.concatenate([np.zeros(hist.shape[:-1] + (1,), dtype=hist.dtype), np.cumsum(hist[..., :-1], axis=-1)],
+                         axis=-1)
+    # cumulative counts at the edges of the new buckets, the last edge at infinity
+    if new_interval % interval == 0:
+        k = np.minimum(np.arange(new_buckets + 1) * (new_interval // interval), m)
+        k[-1] = m
+        res = np.diff(cum[..., k], axis=-1)
+    else:
+        edges = np.arange(new_buckets + 1, dtype=np.float64) * new_interval / interval
+        edges[-1] = m
+        edges = np.minimum(edges, m)
+        k = np.minimum(edges.astype(np.int64), m - 1)
+        frac = edges - k
+        c = cum[..., k] + frac * (cum[..., k + 1] - cum[..., k])
+        res = np.diff(c, axis=-1)
+    res[..., -1] += hist[..., -1]
+    return res
+
+
+def rebin_perf_data(pd: PerfData, interval: int, buckets: int) -> PerfData:
+    """
+    PerfData with the vectors of `pd` rebinned onto the grid (`interval`, `buckets`),
+    `pd` itself if it is already on the grid.
+    """
+    if pd.interval == interval and pd.buckets == buckets:
+        return pd
+
+    res = pd.derive(interval=interval, buckets=buckets)
+    if len(pd.rawData) > 0:
+        rows = rebin(np.array(list(pd.rawData.values())).reshape(-1, pd.buckets), pd.interval, interval, buckets)
+        for fid, row in zip(pd.rawData.keys(), rows.tolist()):
+            res.addRawData(fid, row)
+    return res
+
+
+def rebin_perf_data_lists(perf_data_list_list: list[list[PerfData]]) -> list[list[PerfData]]:
+    """
+    Rebin all perf data onto their common grid.
+    """
+    pds = [pd for pds in perf_data_list_list for pd in pds]
+    if pds == []:
+        return perf_data_list_list
+    interval, buckets = common_grid([(pd.interval, pd.buckets) for pd in pds])
+    return [[rebin_perf_data(pd, interval, buckets) for pd in pds] for pds in perf_data_list_list]
+
+
+def thread_perf_data(pd: PerfData, thread: int) -> PerfData:
+    """
+    PerfData with the counters of thread index `thread` of `pd` only.
+    """
+    pd.check_threads()
+    res = pd.derive()
+    m = pd.threadIndex == thread
+    for fid, row in zip(pd.threadFids[m].tolist(), pd.threadCounts[m].tolist()):
+        res.addRawData(fid, row)
+    return res
+
+
+def self_time_perf_data(pd: PerfData) -> PerfData:
+    """
+    PerfData with the self time (time minus callees) of `pd` as its vectors,
+    so that callers are not ranked by the time of their slow callees.
+    Functions are kept only if they have self time.
+    """
+    if pd.selfData == {} and pd.rawData != {}:
+        print(f'{pd.dataPath} has no self time, record it with TREC_PERF_SELF_TIME=1')
+        exit(-1)
+
+    res = pd.derive()
+    for fid, vec in pd.selfData.items():
+        res.addRawData(fid, vec)
+    return res
+
+
+def metric_perf_data(pd: PerfData, metric: str) -> PerfData:
+    """
+    PerfData with the histograms of `metric`, one in `g_metric_sections`, of `pd` as its vectors.
+    """
+    pd.check_metrics()
+    _, type = g_metric_sections[metric]
+    res = pd.derive(type=type)
+    res.metricData = pd.metricData
+    res.counterTotals = pd.counterTotals
+    for fid, vec in pd.metricData[metric].items():
+        res.addRawData(fid, vec)
+    return res
+
+
+def shift_hist(hist, shift: float) -> np.ndarray:
+    """
+    Histogram `hist` with its times reduced by `shift` buckets,
+    counts of a bucket are taken as spread evenly over it.
+    Counts shifted below 0 go to the first bucket, the overflow bucket (the last one) is kept.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    if shift <= 0:
+        return hist
+
+    n = len(hist) - 1
+    cum = np.concatenate([[0.0], np.cumsum(hist[:-1])])
+    # edges of the new buckets 1..n on the old ones
+    edges = np.minimum(np.arange(1, n + 1) + shift, n)
+    k = np.minimum(edges.astype(np.int64), n - 1)
+    c = cum[k] + (edges - k) * (cum[k + 1] - cum[k])
+    return np.concatenate([np.diff(c, prepend=0.0), hist[-1:]])
+
+
+def compensate_overhead(pd: PerfData) -> PerfData:
+    """
+    PerfData with the probe cost measured with TREC_PERF_CALIBRATE=1 taken out of the vectors of `pd`:
+    each call of a function is shortened by the probe cost of the mean number of calls below it,
+    and its self time by that of the mean number of its direct callees.
+    Vectors become float.
+    """
+    if pd.probeCost is None and pd.rawData != {}:
+        print(f'{pd.dataPath} has no probe cost, record it with TREC_PERF_CALIBRATE=1')
+        exit(-1)
+
+    res = pd.derive()
+    res.childCalls = pd.childCalls
+    cost = pd.probeCost / pd.interval if pd.probeCost is not None else 0
+    for fid, vec in pd.rawData.items():
+        calls, callees, descendants = pd.childCalls.get(fid, (0, 0, 0))
+        shift = cost * descendants / calls if calls > 0 else 0
+        res.addRawData(fid, shift_hist(vec, shift).tolist())
+    for fid, vec in pd.selfData.items():
+        calls, callees, descendants = pd.childCalls.get(fid, (0, 0, 0))
+        shift = cost * callees / calls if calls > 0 else 0
+        res.selfData[fid] = shift_hist(vec, shift).tolist()
+    return res
+
+
 def compare_time(buckets, interval1, raw_data1: list[int], interval2, raw_data2: list[int]):
     # raw_data1 should come from the faster machine
-    interv1 = np.array([i for i in range(0, buckets * interval1, interval1)])
-    interv2 = np.array([i for i in range(0, buckets * interval2, interval2)])
-    d1 = np.array(raw_data1)
-    d2 = np.array(raw_data2)
+    # data with different intervals or bucket counts are compared on their common grid
+    interval, buckets = common_grid([(interval1, len(raw_data1)), (interval2, len(raw_data2))])
+    d1 = rebin(raw_data1, interval1, interval, buckets)
+    d2 = rebin(raw_data2, interval2, interval, buckets)
+    interv = np.arange(buckets, dtype=np.int64) * interval
 
-    t1 = np.sum(interv1 * d1)
-    t2 = np.sum(interv2 * d2)
+    t1 = np.sum(interv * d1)
+    t2 = np.sum(interv * d2)
 
     r = (t2 / t1) - 1
     if r >= get_g_bad_threshold():
@@ -643,23 +1683,142 @@ def analyze_all(perfDatas1: list[PerfData], perfDatas2: list[PerfData]):
     return res, goods_res
 
 
-# TODO arr name should be arch
-def generate_plot(res: PerfResult, path: str, arr1_name='', arr2_name=''):
-    # to avoid file name too long error and colon (cannot appear in file name on Windows)
-    image_name = hashlib.sha256(str.encode(res.func)).hexdigest()
-    file = f'{path}/{image_name}'
-    arr1 = res.dist1
-    arr2 = res.dist2
+class PerfResultStar:
+    """
+    A function in matching perf data of several datasets,
+    with its time relative to that of the baseline dataset in each of them.
+    """
+    def __init__(self, func: str, pds: list[PerfData], dists: list, fids: list, ratios: np.ndarray, baseline: int):
+        self.func = func
+        self.pds = pds
+        self.dists = dists
+        self.fids = fids
+        # ratios[i] = time[i] / time[baseline] - 1
+        self.ratios = ratios
+        # the worst slowdown
+        self.ratio = np.delete(ratios, baseline).max().item()
+        # baseline, used to look up source code
+        self.pd1 = pds[baseline]
+        self.fid1 = fids[baseline]
+
+
+def analyze_time_star(pds: list[PerfData], baseline: int = 0):
+    """
+    `analyze_time` of matching perf data of several datasets against the `baseline`-th one.
+    Functions are aligned by name and the times of all of them are computed at once.
+    A result is bad if any dataset is slower than the baseline by the threshold.
+    """
+    # func -> fid in each perf data
+    fids: list[dict[str, int]] = []
+    for pd in pds:
+        d = {}
+        for fid in pd.data.keys():
+            if len(pd.data[fid])<=1:
+                continue
+            d[pd.get_symbol_name(fid)] = fid
+        fids.append(d)
+
+    funcs = [f for f in fids[baseline].keys() if all(f in d for d in fids)]
+    if funcs == []:
+        return [], []
+
+    # (funcs, datasets) times, on the common grid of all datasets
+    interval, buckets = common_grid([(pd.interval, pd.buckets) for pd in pds])
+    interv = np.arange(buckets, dtype=np.int64) * interval
+    times = np.empty((len(funcs), len(pds)))
+    raws = []
+    for j, pd in enumerate(pds):
+        raw = np.array([pd.rawData[fids[j][f]] for f in funcs], dtype=np.int64).reshape(len(funcs), pd.buckets)
+        times[:, j] = rebin(raw, pd.interval, interval, buckets) @ interv
+        raws.append(raw)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = times / times[:, [baseline]] - 1
+    bad = np.delete(ratios, baseline, axis=1).max(axis=1) >= get_g_bad_threshold()
+
+    bad_ones:  list[PerfResultStar] = []
+    good_ones: list[PerfResultStar] = []
+    for i, f in enumerate(funcs):
+        r = PerfResultStar(f, pds, [raw[i] for raw in raws], [d[f] for d in fids], ratios[i], baseline)
+        (bad_ones if bad[i] else good_ones).append(r)
 
-    # 创建画布，并设置大小和背景颜色
-    fig, ax = plt.subplots(figsize=(8, 5.5), facecolor='white')
+    return bad_ones, good_ones
 
-    # 绘制两个直方图：alpha控制透明度
+
+def analyze_all_star(perf_data_list_list: list[list[PerfData]], baseline: int = 0):
+    """
+    `analyze_all` of several datasets against the `baseline`-th one.
+    """
+    print('Preparing to analyze...')
+
+    matches = find_matches_star(perf_data_list_list)
+    if matches == []:
+        print('No match found')
+        exit(0)
+    res: list[PerfResultStar] = []
+    goods_res: list[PerfResultStar] = []
+
+    print('Analyzing...')
+
+    for pds in matches:
+        bad, good = analyze_time_star(pds, baseline)
+        res += bad
+        goods_res += good
+
+    print('Done.')
+
+    res.sort(key=lambda pr: pr.ratio, reverse=True)
+
+    return res, goods_res
+
+
+# figure reused by every plot rendered in this process
+g_plot_figure = None
+
+
+def plot_figure():
+    global g_plot_figure
+    if g_plot_figure is None:
+        import matplotlib
+        # no display needed, also safe in worker processes
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        # 创建画布，并设置大小和背景颜色
+        g_plot_figure = plt.subplots(figsize=(8, 5.5), facecolor='white')
+    return g_plot_figure
+
+
+def plot_bins(arr, precompute: bool):
     num_bins = 100
-    if len(arr1)<100:
-        num_bins=len(arr1)
-    n1, bins1, patches1 = ax.hist(arr1, bins=num_bins, density=True, alpha=0.5, color='blue')
-    n2, bins2, patches2 = ax.hist(arr2, bins=num_bins, density=True, alpha=0.5, color='green')
+    if len(arr)<100:
+        num_bins=len(arr)
+    if not precompute:
+        return arr, num_bins, None
+    # histogram of the values computed here, so that matplotlib only draws the bars
+    n, bins = np.histogram(np.asarray(arr), bins=num_bins, density=True)
+    return bins[:-1], bins, n
+
+
+def render_plot(job):
+    """
+    Render a plot of `generate_plot` from `job`, the (path of png, data hash, arr1, arr2, arr1_name, arr2_name).
+    The data hash is stored next to the png, so that plots of unchanged data are not rendered again.
+    """
+    p, digest, arr1, arr2, arr1_name, arr2_name = job
+    hash_file = p + '.sha256'
+    if os.path.exists(p) and os.path.exists(hash_file):
+        with open(hash_file, 'r') as f:
+            if f.read() == digest:
+                return p
+
+    fig, ax = plot_figure()
+    ax.clear()
+
+    # 绘制两个直方图：alpha控制透明度
+    xs1, bins1, w1 = arr1
+    xs2, bins2, w2 = arr2
+    ax.hist(xs1, bins=bins1, weights=w1, density=w1 is None, alpha=0.5, color='blue')
+    ax.hist(xs2, bins=bins2, weights=w2, density=w2 is None, alpha=0.5, color='green')
 
     # 设置坐标轴范围和标签
     ax.set_xlim([0, 1])
@@ -669,81 +1828,225 @@ def generate_plot(res: PerfResult, path: str, arr1_name='', arr2_name=''):
 
     # 添加标题和图例
     # plt.title('Normal Distribution Histogram Comparison')
+    ax.legend([arr1_name, arr2_name], prop = {'size':25})
+
+    # 显示图形
+    fig.tight_layout()
+    fig.savefig(p)
+    with open(hash_file, 'w') as f:
+        f.write(digest)
+    return p
+
+
+def plot_job(res: PerfResult, path: str, arr1_name='', arr2_name='', precompute_bins=False):
+    import hashlib
+
+    # to avoid file name too long error and colon (cannot appear in file name on Windows)
+    image_name = hashlib.sha256(str.encode(res.func)).hexdigest()
+    file = f'{path}/{image_name}'
+    p = os.path.join(path, '%s.png' % file)
+
     if arr1_name=='':
         arr1_name='arch1'
     if arr2_name == '':
         arr2_name = 'arch2'
-    ax.legend([arr1_name, arr2_name], prop = {'size':25})
+    h = hashlib.sha256()
+    for arr in [res.dist1, res.dist2]:
+        # dists may be fractional after rebin or compensate_overhead
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(len(arr).to_bytes(8, 'little'))
+        h.update(arr.tobytes())
+    h.update(f'{arr1_name}\0{arr2_name}\0{precompute_bins}'.encode())
 
-    # 显示图形
-    plt.tight_layout()
+    return (p, h.hexdigest(), plot_bins(res.dist1, precompute_bins), plot_bins(res.dist2, precompute_bins),
+            arr1_name, arr2_name)
+
+
+# TODO arr name should be arch
+def generate_plot(res: PerfResult, path: str, arr1_name='', arr2_name='', precompute_bins=False):
     if not os.path.exists(path):
         os.makedirs(path)
-    p = os.path.join(path, '%s.png' % file)
-    plt.savefig(p)
-    plt.close(fig)
-    return p
-    # plt.show()
+    return render_plot(plot_job(res, path, arr1_name, arr2_name, precompute_bins))
 
 
-def fetch_source_code(res: PerfResult) -> list[str]:
-    # NAME from db is like: /home/abuild/rpmbuild/BUILD/aide-0.18.5/lex.yy.c
-    # remove prefix and concat with srcDir
-    bare_name = res.pd1.get_file_name(res.fid1).removeprefix(get_g_obs_prefix())
-    src_file = res.pd1.srcDir + bare_name
-    # get line, for perf-instr, line num is in `func`
-    # use rsplit() instead of split() because of names like "OptionStorageTemplate<gmx::BooleanOption>: 401"
-    nameline = res.func.rsplit(':', 1)
-    name = nameline[0]
-    # -1 to include the function name decl
-    line = int(nameline[1].strip()) - 1
-
-    if checkFileNoExit(src_file):
-        # open file and read several lines
-        with open(src_file, 'r') as f:
-            lines = f.readlines()
-            linenum = len(lines)
-            lcount = 19
-            # select only 5 lines or so
-            if line < linenum:
-                if line + lcount >= linenum:
-                    srcs = lines[line:linenum]
-                else:
-                    srcs = lines[line:line+lcount]
-            else:
-                print(f'Error: func {name} line {line} exceeding file lines ({linenum})')
-        srcs.append('[...]')
+def generate_plots(results: list[PerfResult], path: str, jobs: int = None, precompute_bins=False) -> list[str]:
+    """
+    `generate_plot` of every result, rendered on a process pool with `jobs` workers
+    (default: number of CPUs); `jobs=1` renders serially in this process.
+    With `precompute_bins`, histograms are computed with NumPy before rendering.
+    Return paths of the plots in the order of `results`.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    plot_jobs = [plot_job(res, path, precompute_bins=precompute_bins) for res in results]
+    # results of the same function share a plot, of which the last one is kept as before
+    pics = [job[0] for job in plot_jobs]
+    plot_jobs = list({ job[0]: job for job in plot_jobs }.values())
+    total = len(plot_jobs)
+
+    def report(done):
+        print(f'\rRendered {done}/{total} plots', end='', flush=True)
+
+    if jobs == 1 or total <= 1:
+        for i, job in enumerate(plot_jobs):
+            render_plot(job)
+            report(i + 1)
     else:
-        srcs = ['src not found']
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            done = 0
+            for fut in as_completed([executor.submit(render_plot, job) for job in plot_jobs]):
+                fut.result()
+                done += 1
+                report(done)
+    if total > 0:
+        print()
 
-    return srcs, bare_name
+    return pics
 
-def fetch_source_code_by_id(d: PerfData, sym_name: str, id: int, src_prefix: str) -> list[str]:
+
+class SourceCache:
+    """
+    Source files mapped in memory with an index of line offsets,
+    keeping at most `capacity` most recently used files open.
+    """
+    def __init__(self, capacity: int = 32):
+        self.capacity = capacity
+        # path -> (mmap or bytes, offsets of line starts and the end of file, (size, mtime))
+        self.files: OrderedDict[str, tuple] = OrderedDict()
+
+
+    def index(self, path: str):
+        st = os.stat(path)
+        if path in self.files:
+            # re-index files changed on disk
+            if self.files[path][2] == (st.st_size, st.st_mtime_ns):
+                self.files.move_to_end(path)
+                return self.files[path]
+            self.close(path)
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # empty files cannot be mapped
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n')) + 1
+        # last line without trailing newline
+        if size > 0 and (len(nl) == 0 or nl[-1] != size):
+            nl = np.append(nl, size)
+        offsets = np.concatenate(([0], nl))
+
+        self.files[path] = (buf, offsets, (st.st_size, st.st_mtime_ns))
+        if len(self.files) > self.capacity:
+            self.close(next(iter(self.files)))
+        return self.files[path]
+
+
+    def close(self, path: str):
+        buf = self.files.pop(path)[0]
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+    def line_count(self, path: str) -> int:
+        return len(self.index(path)[1]) - 1
+
+
+    def get_lines(self, path: str, start: int, end: int) -> list[str]:
+        """
+        Lines [start, end) of file, with line endings, like `readlines()[start:end]`.
+        """
+        return self.get_ranges(path, [(start, end)])[0]
+
+
+    def get_ranges(self, path: str, ranges: list[tuple[int, int]]) -> list[list[str]]:
+        """
+        Lines of each of the [start, end) ranges in file.
+        """
+        buf, offsets, _ = self.index(path)
+        n = len(offsets) - 1
+        res = []
+        for start, end in ranges:
+            start = max(0, min(start, n))
+            end = max(start, min(end, n))
+            lines = []
+            for i in range(start, end):
+                line = buf[offsets[i]:offsets[i + 1]].decode('utf-8', errors='replace')
+                # universal newlines as in text mode
+                if line.endswith('\r\n'):
+                    line = line[:-2] + '\n'
+                elif line.endswith('\r'):
+                    line = line[:-1] + '\n'
+                lines.append(line)
+            res.append(lines)
+        return res
+
+
+g_source_cache = SourceCache()
+
+
+def source_path(pd: PerfData, fid, src_prefix: str):
     # NAME from db is like: /home/abuild/rpmbuild/BUILD/aide-0.18.5/lex.yy.c
     # remove prefix and concat with srcDir
-    bare_name = d.get_file_name(id).removeprefix(src_prefix)
-    src_file = d.srcDir + bare_name
+    bare_name = pd.get_file_name(fid).removeprefix(src_prefix)
+    return pd.srcDir + bare_name, bare_name
+
+
+def source_snippet_range(sym_name: str, src_file: str):
+    """
+    Range of lines of function `sym_name` shown in reports, None if out of file.
+    """
     # get line, for perf-instr, line num is in `func`
     # use rsplit() instead of split() because of names like "OptionStorageTemplate<gmx::BooleanOption>: 401"
     nameline = sym_name.rsplit(':', 1)
     name = nameline[0]
     # -1 to include the function name decl
     line = int(nameline[1].strip()) - 1
+    lcount = 19
+
+    linenum = g_source_cache.line_count(src_file)
+    if line >= linenum:
+        print(f'Error: func {name} line {line} exceeding file lines ({linenum})')
+        return None
+    return (line, line + lcount)
+
+
+def fetch_source_codes(results: list[PerfResult]) -> list[tuple[list[str], str]]:
+    """
+    `fetch_source_code` of all results, extracting the snippets of each source file at once.
+    """
+    res = [None] * len(results)
+    # src_file -> [(index of result, range)]
+    by_file: dict[str, list] = {}
+    for i, r in enumerate(results):
+        src_file, bare_name = source_path(r.pd1, r.fid1, get_g_obs_prefix())
+        if not checkFileNoExit(src_file):
+            res[i] = (['src not found'], bare_name)
+            continue
+        res[i] = ([], bare_name)
+        rg = source_snippet_range(r.func, src_file)
+        if rg is not None:
+            by_file.setdefault(src_file, []).append((i, rg))
+
+    for src_file, items in by_file.items():
+        snippets = g_source_cache.get_ranges(src_file, [rg for _, rg in items])
+        for (i, _), srcs in zip(items, snippets):
+            res[i][0].extend(srcs)
+
+    for srcs, _ in res:
+        if srcs != ['src not found']:
+            srcs.append('[...]')
+    return res
+
+
+def fetch_source_code(res: PerfResult) -> list[str]:
+    return fetch_source_codes([res])[0]
+
+
+def fetch_source_code_by_id(d: PerfData, sym_name: str, id: int, src_prefix: str) -> list[str]:
+    src_file, _ = source_path(d, id, src_prefix)
 
     if checkFileNoExit(src_file):
-        # open file and read several lines
-        with open(src_file, 'r') as f:
-            lines = f.readlines()
-            linenum = len(lines)
-            lcount = 19
-            # select only 5 lines or so
-            if line < linenum:
-                if line + lcount >= linenum:
-                    srcs = lines[line:linenum]
-                else:
-                    srcs = lines[line:line+lcount]
-            else:
-                print(f'Error: func {name} line {line} exceeding file lines ({linenum})')
+        rg = source_snippet_range(sym_name, src_file)
+        srcs = g_source_cache.get_lines(src_file, *rg) if rg is not None else []
         srcs.append('[...]')
     else:
         srcs = ['src not found']
@@ -752,24 +2055,86 @@ def fetch_source_code_by_id(d: PerfData, sym_name: str, id: int, src_prefix: str
 
 
 def fetch_source_code_range(pd: PerfData, func: str, fid, start, end):
-    # NAME from db is like: /home/abuild/rpmbuild/BUILD/aide-0.18.5/lex.yy.c
-    # remove prefix and concat with srcDir
-    bare_name = pd.get_file_name(fid).removeprefix(get_g_obs_prefix())
-    src_file = pd.srcDir + bare_name
+    src_file, bare_name = source_path(pd, fid, get_g_obs_prefix())
 
     if checkFileNoExit(src_file):
-        # open file and read several lines
-        with open(src_file, 'r') as f:
-            lines = f.readlines()
-            srcs = lines[start:end+1]
-            if srcs == []:
-                srcs = ['src not found']
+        srcs = g_source_cache.get_lines(src_file, start, end + 1)
+        if srcs == []:
+            srcs = ['src not found']
     else:
         srcs = ['src not found']
 
     return srcs, bare_name
 
 
+SQL_CREATE_RESULTS = \
+    "CREATE TABLE RESULTS (" \
+        "ID       INTEGER PRIMARY KEY," \
+        "FUNC     TEXT," \
+        "FID1     INTEGER," \
+        "FID2     INTEGER," \
+        "FILE     TEXT," \
+        "RATIO    REAL," \
+        "INTERVAL INTEGER," \
+        "LEN1     INTEGER," \
+        "LEN2     INTEGER," \
+        "CODE     TEXT," \
+        "INTERVAL2 INTEGER);"
+
+
+class ResultsWriter:
+    """
+    Write results to `{prefix}.results.db`, a SQLite table of everything but the distributions,
+    and `{prefix}.results.npy`, an array of shape (n, 2, buckets) of the distributions,
+    one row per result as they are added; int64, or float64 for fractional counts.
+    Read them back with `load_results`.
+    """
+    def __init__(self, prefix: str, n: int, buckets: int, dtype = np.int64):
+        db = f'{prefix}.results.db'
+        if os.path.exists(db):
+            os.remove(db)
+        self.connection = sqlite3.connect(db)
+        self.connection.execute(SQL_CREATE_RESULTS)
+        self.dists = np.lib.format.open_memmap(f'{prefix}.results.npy', mode='w+',
+                                               dtype=dtype, shape=(n, 2, buckets))
+        self.n = 0
+
+
+    def add(self, func: str, fid1, fid2, code: str, file: str, ratio, interval, dist1, dist2, interval2 = None):
+        """
+        `interval2` is the interval of `dist2` if it differs from `interval`, that of `dist1`.
+        """
+        self.dists[self.n, 0, :len(dist1)] = dist1
+        self.dists[self.n, 1, :len(dist2)] = dist2
+        self.connection.execute("INSERT INTO RESULTS VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (self.n, func, fid1, fid2, file, ratio, interval, len(dist1), len(dist2), code,
+                                 interval if interval2 is None else interval2))
+        self.n += 1
+
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+        self.dists.flush()
+        del self.dists
+
+
+def load_results(prefix: str):
+    """
+    Load results written by `ResultsWriter`.
+    Return a list of dicts with keys `func`, `fid1`, `fid2`, `file`, `ratio`, `interval`, `interval2` and `code`,
+    and the distributions (memory-mapped), `dists[i, 0]` and `dists[i, 1]` being those of the i-th result
+    padded with zeros to the same length, on the grids of `interval` and `interval2` respectively.
+    """
+    checkFile(f'{prefix}.results.db')
+    with closing(sqlite3.connect(f'{prefix}.results.db')) as connection:
+        rows = connection.execute(
+            "SELECT FUNC, FID1, FID2, FILE, RATIO, INTERVAL, INTERVAL2, CODE FROM RESULTS ORDER BY ID").fetchall()
+    keys = ['func', 'fid1', 'fid2', 'file', 'ratio', 'interval', 'interval2', 'code']
+    dists = np.load(f'{prefix}.results.npy', mmap_mode='r')
+    return [dict(zip(keys, r)) for r in rows], dists[:len(rows)]
+
+
 class ReportItem:
     def __init__(self, func: str, code: str, file: str, pic: str):
         self.func = func
@@ -807,18 +2172,17 @@ class BBLReport:
 
 
 
-def generate_report(results: list[PerfResult], path = '.'):
+def generate_report(results: list[PerfResult], path = '.', jobs: int = None, precompute_bins=False):
     # gen HTML
     # gen plot
     print(f'Generating report for {len(results)} results...')
     reports: ReportItem = []
-    for res in results:
-        srcs, src_file = fetch_source_code(res)
+    pics = generate_plots(results, path, jobs, precompute_bins)
+    for res, (srcs, src_file), pic in zip(results, fetch_source_codes(results), pics):
         # print(res.func)
         ss = ''
         for s in srcs:
             ss += s
-        pic = generate_plot(res, path)
         reports.append(ReportItem(res.func, ss, src_file, pic))
 
     if reports == []:
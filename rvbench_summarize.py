@@ -8,15 +8,16 @@ import sqlite3
 from contextlib import closing
 from collections import defaultdict
 import numpy as np
-import scipy
-import xlsxwriter
 
 
-class Data:
-    def __init__(self, pkg, arch, sums: list[float]):
-        self.pkg = pkg
-        self.arch = arch
-        self.sums = sums
+SQL_CREATE_SCORES = \
+    "CREATE TABLE IF NOT EXISTS SCORES (" \
+        "ARCH   TEXT," \
+        "PKG    TEXT," \
+        "SCORER TEXT," \
+        "IDX    INTEGER," \
+        "SCORE  REAL," \
+        "PRIMARY KEY (ARCH, PKG, SCORER)) WITHOUT ROWID;"
 
 
 def read_total_file(p):
@@ -28,17 +29,87 @@ def read_total_file(p):
             ns  = line.strip().split(',')[0]
             res = line.strip().split(',')[1]
             names.append(ns)
-            sums.append(res)
+            sums.append(float(res))
 
         return names, sums
 
 
-def find_data(ds, p, a):
-    for d in ds:
-        if d.pkg == p and d.arch == a:
-            return d
-    print(f'Bad {p} and {a}')
-    exit(-1)
+def open_store(db: str):
+    connection = sqlite3.connect(db)
+    connection.execute(SQL_CREATE_SCORES)
+    return connection
+
+
+def ingest_total_files(connection, paths: list[str]):
+    """
+    Add the scores in `total.csv` files to the store.
+    A path is like `rv64_milkv/gzip/total.csv`, i.e., `arch/pkg/total.csv`.
+    Scores of an (arch, pkg) that is already in the store are replaced.
+    """
+    rows = []
+    replaced = set()
+    for p in paths:
+        tokens = p.split('/')
+        arch = tokens[0]
+        pkg = tokens[1]
+        names, sums = read_total_file(p)
+        replaced.add((arch, pkg))
+        for idx, (n, s) in enumerate(zip(names, sums)):
+            rows.append((arch, pkg, n, idx, s))
+
+    with connection:
+        # scorers dropped from a re-ingested total.csv must not linger
+        connection.executemany("DELETE FROM SCORES WHERE ARCH=? AND PKG=?", replaced)
+        connection.executemany("INSERT OR REPLACE INTO SCORES VALUES (?, ?, ?, ?, ?)", rows)
+
+    return len(rows)
+
+
+def pivot_scores(connection):
+    """
+    Pivot all scores in the store into a (scorer, arch, pkg) matrix.
+    Return scorer names, archs, pkgs and the matrix.
+    """
+    rows = connection.execute("SELECT ARCH, PKG, SCORER, IDX, SCORE FROM SCORES").fetchall()
+    if rows == []:
+        print('No scores in store')
+        exit(-1)
+
+    cols = list(zip(*rows))
+    archs, arch_i = np.unique(np.array(cols[0]), return_inverse=True)
+    pkgs,  pkg_i  = np.unique(np.array(cols[1]), return_inverse=True)
+    # order scorers as they appear in total.csv
+    scorers, first, scorer_i = np.unique(np.array(cols[2]), return_index=True, return_inverse=True)
+    order = np.argsort(np.array(cols[3])[first], kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    scorers = scorers[order]
+    scorer_i = rank[scorer_i]
+
+    scores = np.full((len(scorers), len(archs), len(pkgs)), np.nan)
+    scores[scorer_i, arch_i, pkg_i] = np.array(cols[4], dtype=np.float64)
+
+    missing = np.argwhere(np.isnan(scores))
+    if len(missing) > 0:
+        i, a, p = missing[0]
+        print(f'Bad {pkgs[p]} and {archs[a]}: no {scorers[i]} score')
+        exit(-1)
+
+    return scorers.tolist(), archs.tolist(), pkgs.tolist(), scores
+
+
+def write_summary(path: str, scorers, archs, pkgs, scores):
+    totals = scores.sum(axis=2)
+    lines = []
+    for i in range(len(scorers)):
+        lines.append(f'{scorers[i]}\n')
+        lines.append(f',{','.join(pkgs)},total\n')
+        for a in range(len(archs)):
+            lines.append(f'{archs[a]},{','.join(map(str, scores[i, a].tolist()))},{totals[i, a].item()}\n')
+        lines.append('\n')
+
+    with open(path, 'w') as outf:
+        outf.writelines(lines)
 
 
 """
@@ -49,6 +120,10 @@ rv64_milkv/gzip/total.csv
 and aggregates the data in these files.
 The csv data is produced by `rvbench_test_start.py`.
 
+Scores are added to a SQLite store (`sum.db` under the output dir by default),
+so totals of new packages or archs can be added later by listing only the new files;
+the summary is always computed from everything in the store.
+
 This script current must be invoked in a dir such that the paths can be read directly.
 
 Output format:
@@ -57,47 +132,26 @@ arch2,score_of_p1,score_of_p2,score_of_p3,...
 """
 
 if __name__ == '__main__':
-    files = sys.argv[1]
-    out   = sys.argv[2]
+    parser = argparse.ArgumentParser(
+        description='Summarize scores in total.csv files of rvbench.')
+    parser.add_argument('files', type=str, help='file that contains paths to total.csv')
+    parser.add_argument('out', type=str, help='dir to store sum.csv')
+    parser.add_argument('--db', type=str, help='path to score store, default: OUT/sum.db')
+
+    args = parser.parse_args()
+    out = args.out
 
     if not os.path.isdir(out):
         print(f'Not a dir: {out}')
         exit(-1)
 
-    with open(files, 'r') as f:
-        lines = f.readlines()
-        ds = []
-
-        names = None
-        for l in lines:
-            tokens = l.split('/')
-            arch = tokens[0]
-            pkg = tokens[1]
-            ns, sums = read_total_file(l.strip())
-            if names is None:
-                names = ns
-            ds.append(Data(pkg, arch, sums))
-
-        # print(ds)
-        pkgs  = list(set(map(lambda d: d.pkg, ds)))
-        archs = list(set(map(lambda d: d.arch, ds)))
-        # print(pkgs)
-        # print(archs)
-
-        with open(f'{out}/sum.csv', 'w') as outf:
-            for i in range(len(ds[0].sums)):
-                outf.write(f'{names[i]}\n')
-                outf.write(',')
-                for p in pkgs:
-                    outf.write(f'{p},')
-                outf.write('total\n')
-                for a in archs:
-                    outf.write(f'{a},')
-                    scores = 0
-                    for p in pkgs:
-                        d = find_data(ds, p, a)
-                        outf.write(f'{d.sums[i]},')
-                        scores += float(d.sums[i])
-                    outf.write(f'{scores}\n')
-                outf.write('\n')
+    db = args.db if args.db is not None else f'{out}/sum.db'
+
+    with open(args.files, 'r') as f:
+        paths = [l.strip() for l in f.readlines() if l.strip() != '']
+
+    with closing(open_store(db)) as connection:
+        ingest_total_files(connection, paths)
+        scorers, archs, pkgs, scores = pivot_scores(connection)
 
+    write_summary(f'{out}/sum.csv', scorers, archs, pkgs, scores)
@@ -20,8 +20,6 @@ import argparse
 import sqlite3
 from contextlib import closing
 import numpy as np
-import scipy
-import xlsxwriter
 
 from perflib import *
 
@@ -55,7 +53,7 @@ def sum_time_all(buckets, raw_data: dict[int, list[int]]) -> int:
 
 
 def kl_div(buckets, raw_data1: list[int], raw_data2: list[int]):
-    div = sum(scipy.special.rel_entr(raw_data1, raw_data2))
+    div = kl_div_batch(np.array([raw_data1]), np.array([raw_data2]))[0]
     return div.item()
 
 
@@ -70,29 +68,38 @@ def cdf(buckets, raw_data1: list[int], raw_data2: list[int]):
 
 
 def diff_time(buckets, interval1, interval2, raw_data1: list[int], raw_data2: list[int]):
-    interv1 = np.array([i for i in range(0, buckets * interval1, interval1)])
-    interv2 = np.array([i for i in range(0, buckets * interval2, interval2)])
-    d1 = np.array(raw_data1)
-    d2 = np.array(raw_data2)
+    interval, buckets = common_grid([(interval1, len(raw_data1)), (interval2, len(raw_data2))])
+    interv = np.arange(buckets, dtype=np.int64) * interval
+    d1 = rebin(raw_data1, interval1, interval, buckets)
+    d2 = rebin(raw_data2, interval2, interval, buckets)
 
     # bigger positive s means arch1 is faster than arch2
-    s = np.sum(interv2 * d2) - np.sum(interv1 * d1)
+    s = np.sum(interv * d2) - np.sum(interv * d1)
     return s.item()
 
 
-def rvbench_test(pd1: PerfData, pd2: PerfData, path: str):
+# pseudo-count added to every bucket before computing KL divergence,
+# so that a bucket being zero on only one side does not make it inf
+g_kl_smoothing = 1.0
+
+
+def kl_div_batch(data1: np.ndarray, data2: np.ndarray, alpha=g_kl_smoothing) -> np.ndarray:
     """
-    Compare the performance of PerfData from two platforms.
-    pd1 is the collected data; pd2 is the reference data.
+    KL divergence of each row of `data1` from the same row of `data2`.
+    Rows are smoothed by `alpha` and normalized to distributions.
     """
+    p = data1 + alpha
+    q = data2 + alpha
+    p = p / p.sum(axis=1, keepdims=True)
+    q = q / q.sum(axis=1, keepdims=True)
+    return (p * np.log(p / q)).sum(axis=1)
 
-    # find function name and matching data
-    # compare using raw data
-    f = open(path, 'w')
-    # print(pd1.cmd)
-    # f.write(f'{pd1.cmd}\n')
-    f.write(f'symbol,cdf,kl_div,diff_time,data\n')
 
+def align_funcs(pd1: PerfData, pd2: PerfData):
+    """
+    Find functions in both PerfData by symbol name and
+    stack their raw data into two (funcs, buckets) matrices.
+    """
     # store data by function names
     funcs_and_data1 = {}
     for fid, data in pd1.rawData.items():
@@ -102,34 +109,71 @@ def rvbench_test(pd1: PerfData, pd2: PerfData, path: str):
     for fid, data in pd2.rawData.items():
         funcs_and_data2[pd2.get_symbol_name(fid)] = data
 
-    total_cdf = 0
-    total_diff_time = 0
-
-    for f1, data1 in funcs_and_data1.items():
-        if f1 in funcs_and_data2.keys():
-            data2 = funcs_and_data2[f1]
-            assert len(data1) == len(data2)
-            # t1 = sum_time(pd1.buckets, data1)
-            # t2 = sum_time(pd2.buckets, data2)
-            score_cdf = cdf(pd1.buckets, data1, data2)
-            score_kldiv = kl_div(pd1.buckets, data1, data2)
-            score_diff_time = diff_time(pd1.buckets, pd1.interval, pd2.interval, data1, data2)
-            total_cdf += score_cdf
-            total_diff_time += score_diff_time
-            # output CSV
-            # TODO generate plot?
-            f.write(f'{f1},{score_cdf},{score_kldiv},{score_diff_time},{','.join(map(str, data1))}\n')
-            f.write(f',,,,{','.join(map(str, data2))}\n')
-            
-
-    f.write(f'total cdf,{total_cdf}\n')
-    f.write(f'total diff_time,{total_diff_time}\n')
-    f.close()
-
-    # return s1, s2
-
-
-def main(dir1: str, dir2: str, path: str):
+    funcs = [f for f in funcs_and_data1.keys() if f in funcs_and_data2]
+    data1 = np.array([funcs_and_data1[f] for f in funcs]).reshape(len(funcs), pd1.buckets)
+    data2 = np.array([funcs_and_data2[f] for f in funcs]).reshape(len(funcs), pd2.buckets)
+
+    return funcs, data1, data2
+
+
+def score_batch(pd1: PerfData, pd2: PerfData, data1: np.ndarray, data2: np.ndarray):
+    """
+    Compute cdf, kl_div and diff_time of all rows of `data1` and `data2` in one pass.
+    """
+    assert data1.shape == data2.shape
+    buckets = data1.shape[1]
+    weights = np.arange(buckets - 1, -1, -1, dtype=np.int64)
+    interv1 = np.arange(buckets, dtype=np.int64) * pd1.interval
+    interv2 = np.arange(buckets, dtype=np.int64) * pd2.interval
+
+    # bigger positive s means arch1 is faster than arch2
+    scores_cdf = (data1 - data2) @ weights
+    scores_kldiv = kl_div_batch(data1, data2)
+    scores_diff_time = data2 @ interv2 - data1 @ interv1
+
+    return scores_cdf, scores_kldiv, scores_diff_time
+
+
+def rvbench_test(pd1: PerfData, pd2: PerfData, path: str, fmt = 'csv'):
+    """
+    Compare the performance of PerfData from two platforms.
+    pd1 is the collected data; pd2 is the reference data.
+    Results are written to `path` as CSV, or as compressed NumPy arrays if `fmt` is 'npz'.
+    """
+
+    # compare on the common grid of both
+    interval, buckets = common_grid([(pd1.interval, pd1.buckets), (pd2.interval, pd2.buckets)])
+    pd1 = rebin_perf_data(pd1, interval, buckets)
+    pd2 = rebin_perf_data(pd2, interval, buckets)
+
+    # find function name and matching data
+    # compare using raw data
+    funcs, data1, data2 = align_funcs(pd1, pd2)
+    scores_cdf, scores_kldiv, scores_diff_time = score_batch(pd1, pd2, data1, data2)
+    total_cdf = scores_cdf.sum().item()
+    total_diff_time = scores_diff_time.sum().item()
+
+    if fmt == 'npz':
+        np.savez_compressed(path,
+            symbols = np.array(funcs, dtype=str),
+            cdf = scores_cdf, kl_div = scores_kldiv, diff_time = scores_diff_time,
+            data1 = data1, data2 = data2,
+            total_cdf = total_cdf, total_diff_time = total_diff_time)
+        return
+
+    lines = ['symbol,cdf,kl_div,diff_time,data\n']
+    # TODO generate plot?
+    for i, f1 in enumerate(funcs):
+        lines.append(f'{f1},{scores_cdf[i]},{scores_kldiv[i]},{scores_diff_time[i]},{','.join(map(str, data1[i].tolist()))}\n')
+        lines.append(f',,,,{','.join(map(str, data2[i].tolist()))}\n')
+    lines.append(f'total cdf,{total_cdf}\n')
+    lines.append(f'total diff_time,{total_diff_time}\n')
+
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def main(dir1: str, dir2: str, path: str, fmt = 'csv'):
     dataDir1 = dir1 + "/perf_data"
     dataDir2 = dir2 + "/perf_data"
     dbDir1   = dir1 + "/debug_info"
@@ -178,7 +222,7 @@ def main(dir1: str, dir2: str, path: str):
     sum2 = 0
     i = 0
     for pd1, pd2 in matches:
-        rvbench_test(pd1, pd2, f'{path}/{i}.csv')
+        rvbench_test(pd1, pd2, f'{path}/{i}.{fmt}', fmt)
         i = i + 1
 
     
@@ -194,6 +238,7 @@ if __name__ == '__main__':
     parser.add_argument('--dataDir2', type=str, help='directory of perf data and debuginfo from the 2nd archtecture')
     parser.add_argument('-p', '--prefix', type=str, help='path prefix inside OBS environemnt')
     parser.add_argument('-o', '--output', type=str, help='path to store CSV')
+    parser.add_argument('-f', '--format', type=str, choices=['csv', 'npz'], default='csv', help='output format, default: csv')
 
     args = parser.parse_args()
     if args.dataDir1 == None or args.dataDir2 == None:
@@ -201,4 +246,4 @@ if __name__ == '__main__':
         exit(-1)
     if not args.prefix == None:
         set_g_obs_prefix(args.prefix)
-    main(args.dataDir1, args.dataDir2, args.output)
+    main(args.dataDir1, args.dataDir2, args.output, args.format)
@@ -20,8 +20,6 @@ import sqlite3
 from contextlib import closing
 from collections import defaultdict
 import numpy as np
-import scipy
-import xlsxwriter
 
 from perflib import *
 
@@ -57,13 +55,13 @@ def cdf(buckets, raw_data1: list[int], raw_data2: list[int]):
 
 
 def diff_time(buckets, interval1, interval2, raw_data1: list[int], raw_data2: list[int]):
-    interv1 = np.array([i for i in range(0, buckets * interval1, interval1)])
-    interv2 = np.array([i for i in range(0, buckets * interval2, interval2)])
-    d1 = np.array(raw_data1)
-    d2 = np.array(raw_data2)
+    interval, buckets = common_grid([(interval1, len(raw_data1)), (interval2, len(raw_data2))])
+    interv = np.arange(buckets, dtype=np.int64) * interval
+    d1 = rebin(raw_data1, interval1, interval, buckets)
+    d2 = rebin(raw_data2, interval2, interval, buckets)
 
     # bigger positive s means arch1 is faster than arch2
-    s = np.sum(interv2 * d2) - np.sum(interv1 * d1)
+    s = np.sum(interv * d2) - np.sum(interv * d1)
     return s.item()
 
 
@@ -191,8 +189,8 @@ def rvbench_test_star(pds: list[PerfData], path):
 
 
 
-def main(dirs: list[str], path: str):
-    def read_one_dir(p: str):
+def main(dirs: list[str], path: str, jobs: int = None, grid: tuple[int, int] = None):
+    def list_one_dir(p: str):
         print(f'Reading data under {p}')
 
         dataDir = p + "/perf_data"
@@ -214,15 +212,24 @@ def main(dirs: list[str], path: str):
             print(f"{dataDir} has no data files")
             exit(0)
 
-        perfDatas = list(map(read_perf_data, perfDataFiles))
+        return perfDataFiles, dbDir, srcDir
+
+    listed = list(map(list_one_dir, dirs))
+    # read files of all dirs on one pool
+    perf_data_list_list: list[list[PerfData]] = \
+        read_perf_data_lists(list(map(lambda x: x[0], listed)), jobs)
 
+    for perfDatas, (_, dbDir, srcDir) in zip(perf_data_list_list, listed):
         for pd in perfDatas:
             pd.dbDir = dbDir
             pd.srcDir = srcDir
 
-        return perfDatas
+    # scores are computed on one grid, so that data with different intervals and bucket counts are comparable
+    if grid is None:
+        perf_data_list_list = rebin_perf_data_lists(perf_data_list_list)
+    else:
+        perf_data_list_list = [[rebin_perf_data(pd, *grid) for pd in pds] for pds in perf_data_list_list]
 
-    perf_data_list_list: list[list[PerfData]] = list(map(read_one_dir, dirs))
     matches: list[list[PerfData]] = find_matches_star(perf_data_list_list)
 
     print('Computing score...')
@@ -257,7 +264,19 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compute the sum and average performance scores from the list of performance data of the same set of programs.')
     parser.add_argument('-o', '--output', type=str, help='path to store CSV')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes reading perf data, default: number of CPUs')
+    parser.add_argument('-g', '--grid', type=str,
+                        help='INTERVAL:BUCKETS, rebin all data onto this grid before scoring, e.g., 250:4096, '
+                             'default: the coarsest interval of the data')
     parser.add_argument('dataDirs', nargs='+', type=str, help='directories of perf data and debuginfo')
 
     args = parser.parse_args()
-    main(args.dataDirs, args.output)
+    grid = None
+    if args.grid is not None:
+        try:
+            grid = tuple(map(int, args.grid.split(':')))
+            assert len(grid) == 2 and grid[0] > 0 and grid[1] > 0
+        except (ValueError, AssertionError):
+            print(f'Bad grid: {args.grid}')
+            exit(-1)
+    main(args.dataDirs, args.output, args.jobs, grid)